@@ -0,0 +1,207 @@
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Optional, Tuple
+from linebot.models import FileMessage
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_REJECTED = REGISTRY.counter(
+    "line_uploader_admission_rejected_total", "在下載前被拒絕的上傳數（依原因）", ["reason"])
+
+# 圖片訊息沒有大小資訊，以此估計值計入位元組配額
+ESTIMATED_IMAGE_SIZE = 2 * 1024 * 1024
+
+BUSY_MESSAGE = "⏳ 目前上傳量較大，請稍後再傳送一次"
+
+
+class _SlidingWindow:
+    """滑動時間窗內的位元組累計"""
+
+    def __init__(self):
+        self.entries = collections.deque()
+        self.total = 0
+
+    def expire(self, cutoff):
+        while self.entries and self.entries[0][0] < cutoff:
+            self.total -= self.entries.popleft()[1]
+
+    def add(self, now, amount):
+        self.entries.append((now, amount))
+        self.total += amount
+
+    def remove(self, entry):
+        """移除一筆仍在時間窗內的紀錄（已過期時不處理）"""
+        try:
+            self.entries.remove(entry)
+        except ValueError:
+            return
+        self.total -= entry[1]
+
+
+class AdmissionController:
+    """
+    上傳前的准入檢查
+
+    只用 webhook 事件裡的中繼資料（檔名、宣告大小）判斷，不下載任何內容：
+    檔案大小與類型、每個使用者／群組在時間窗內的位元組配額，以及佇列積壓或
+    暫存磁碟用量過高時的降載。被拒絕的事件立即回覆原因，不進入佇列。
+
+    每個使用者／群組同時處理的數量由 JobStore.claim() 控制（超過時延後處理）。
+    """
+
+    def __init__(self, max_file_size: int, supported_extensions, user_quota_bytes: int, group_quota_bytes: int,
+                 quota_window_seconds: int, shed_queue_depth: int, shed_temp_disk_percent: float, temp_dir: str):
+        """
+        Args:
+            max_file_size: 單一檔案大小上限（bytes）
+            supported_extensions: 支援的副檔名（小寫、含點）；空的代表不限制
+            user_quota_bytes: 每個使用者在時間窗內可上傳的位元組數（0 代表不限制）
+            group_quota_bytes: 每個群組／聊天室在時間窗內可上傳的位元組數（0 代表不限制）
+            quota_window_seconds: 配額的時間窗秒數
+            shed_queue_depth: 待處理工作達到此數量時拒絕新工作
+            shed_temp_disk_percent: 暫存磁碟使用率（%）達到此值時拒絕新工作
+            temp_dir: 暫存檔所在目錄
+        """
+        self._max_file_size = max_file_size
+        self._supported_extensions = set(supported_extensions)
+        self._user_quota = user_quota_bytes
+        self._group_quota = group_quota_bytes
+        self._window = quota_window_seconds
+        self._shed_queue_depth = shed_queue_depth
+        self._shed_disk_percent = shed_temp_disk_percent
+        self._temp_dir = temp_dir
+        self._usage = collections.defaultdict(_SlidingWindow)
+        self._charges = {}  # 訊息 ID -> (計入的紀錄, 計入的配額 key)，供 refund() 退還
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        self._disk_checked_at = 0.0
+        self._disk = None
+        self._admitted = 0
+        self._refunded = 0
+        self._rejected = collections.Counter()
+
+    def _disk_usage(self):
+        # 同一批 webhook 事件共用一次查詢結果
+        now = time.monotonic()
+        if self._disk is None or now - self._disk_checked_at > 1.0:
+            self._disk = shutil.disk_usage(self._temp_dir)
+            self._disk_checked_at = now
+        return self._disk
+
+    @staticmethod
+    def _describe(event) -> Tuple[str, Optional[int]]:
+        if isinstance(event.message, FileMessage):
+            return event.message.file_name or "", event.message.file_size
+        return "image.jpg", None
+
+    def check(self, event, chat_id: str, queue_depth: int) -> Optional[Tuple[str, str]]:
+        """
+        判斷事件是否可以進入佇列；通過時同時計入配額
+
+        Args:
+            event: FileMessage 或 ImageMessage 的 MessageEvent
+            chat_id: 聊天室 ID
+            queue_depth: 目前的待處理工作數
+
+        Returns:
+            None 代表通過；否則為 (原因代碼, 回覆給使用者的訊息)
+        """
+        rejection = self._evaluate(event, chat_id, queue_depth)
+        if rejection is None:
+            self._admitted += 1
+            return None
+        reason, _ = rejection
+        self._rejected[reason] += 1
+        ADMISSION_REJECTED.inc(reason=reason)
+        logger.info(f"🚫 拒絕上傳（{reason}）: {self._describe(event)[0]}")
+        return rejection
+
+    def _evaluate(self, event, chat_id, queue_depth):
+        file_name, declared_size = self._describe(event)
+
+        if declared_size is not None and declared_size > self._max_file_size:
+            return "too_large", f"❌ 檔案超過 {self._max_file_size / (1024 * 1024):.0f} MB 上限，未上傳：{file_name}"
+
+        if isinstance(event.message, FileMessage) and self._supported_extensions:
+            extension = os.path.splitext(file_name)[1].lower()
+            if extension not in self._supported_extensions:
+                return "unsupported_type", f"❌ 不支援的檔案類型（{extension or '無副檔名'}），未上傳：{file_name}"
+
+        if queue_depth >= self._shed_queue_depth:
+            return "queue_backlog", BUSY_MESSAGE
+
+        size = declared_size if declared_size is not None else ESTIMATED_IMAGE_SIZE
+        disk = self._disk_usage()
+        if disk.used / disk.total * 100 >= self._shed_disk_percent or size > disk.free:
+            return "temp_disk", BUSY_MESSAGE
+
+        user_id = getattr(event.source, "user_id", None)
+        now = time.monotonic()
+        with self._lock:
+            checks = []
+            if self._user_quota and user_id:
+                checks.append((f"user:{user_id}", self._user_quota, "你"))
+            if self._group_quota and event.source.type in ("group", "room"):
+                checks.append((f"chat:{chat_id}", self._group_quota, "這個群組"))
+            for key, quota, who in checks:
+                usage = self._usage[key]
+                usage.expire(now - self._window)
+                if usage.total + size > quota:
+                    minutes = max(1, round(self._window / 60))
+                    return "quota", f"⏳ {who}在 {minutes} 分鐘內上傳的檔案已達上限，請稍後再傳送"
+            entry = (now, size)
+            for key, _, _ in checks:
+                self._usage[key].add(now, size)
+            if checks:
+                self._charges[event.message.id] = (entry, [key for key, _, _ in checks])
+            self._prune(now)
+        return None
+
+    def refund(self, message_id: str):
+        """
+        退還 check() 計入的位元組配額
+
+        用於事件最後沒有上傳的情況：其他 uvicorn worker 已收下同一個事件，或上傳失敗。
+        已離開時間窗或不是由這個程序計入的配額不處理。
+        """
+        with self._lock:
+            charge = self._charges.pop(message_id, None)
+            if charge is None:
+                return
+            entry, keys = charge
+            for key in keys:
+                if key in self._usage:
+                    self._usage[key].remove(entry)
+            self._refunded += 1
+
+    def _prune(self, now):
+        # 定期移除時間窗內已沒有用量的使用者／群組
+        if now - self._pruned_at < self._window:
+            return
+        self._pruned_at = now
+        for key in list(self._usage):
+            self._usage[key].expire(now - self._window)
+            if not self._usage[key].entries:
+                del self._usage[key]
+        for message_id, (entry, _) in list(self._charges.items()):
+            if entry[0] < now - self._window:
+                del self._charges[message_id]
+
+    def stats(self) -> dict:
+        """准入統計"""
+        with self._lock:
+            tracked = len(self._usage)
+        return {
+            "admitted": self._admitted,
+            "refunded": self._refunded,
+            "rejected": dict(self._rejected),
+            "tracked_quota_keys": tracked,
+            "max_file_size": self._max_file_size,
+            "shed_queue_depth": self._shed_queue_depth,
+            "shed_temp_disk_percent": self._shed_disk_percent,
+        }
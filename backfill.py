@@ -0,0 +1,257 @@
+"""
+批次補傳工具
+
+把本機目錄（聊天匯出、封存資料夾等）中的檔案平行上傳到 bot 使用的同一個 Drive 資料夾，
+沿用 drive_uploader 的上傳流程（多個 Service Account、速率限制、斷路器）。
+
+    python backfill.py /path/to/export --workers 8 --manifest export.manifest.jsonl
+
+每個檔案的結果逐筆寫入 manifest（JSON Lines）；中斷後用同一個 manifest 重新執行，
+已完成的檔案不會再處理。Drive 資料夾中已有同名同內容的檔案、或內容已在去重索引中的檔案會略過。
+
+檔案一律放在上傳資料夾本身，不套用 FOLDER_LAYOUT 的分區；略過已存在檔案時也只列出上傳資料夾本身，
+不含分區資料夾（分區資料夾中的相同內容仍會由去重索引略過）。
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import (
+    SUPPORTED_EXTENSIONS, MAX_FILE_SIZE, UPLOAD_WORKERS, DEDUP_ENABLED, DEDUP_DB_PATH, DEDUP_VERIFY_ON_HIT,
+    LOG_LEVEL, LOG_FORMAT,
+)
+from dedup_index import DedupIndex
+from drive_uploader import upload_file_to_drive, list_upload_folder_files, drive_file_exists, breaker
+from log_utils import setup_logging
+
+logger = logging.getLogger("backfill")
+
+# manifest 中視為已完成的狀態；failed 的檔案下次執行會重試
+DONE_STATUSES = ("uploaded", "exists", "duplicate")
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class BackfillManifest:
+    """
+    補傳進度紀錄（JSON Lines，每處理完一個檔案附加一行）
+
+    同一個路徑有多筆紀錄時以最後一筆為準；檔案大小或修改時間改變後視為新檔案重新處理。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 上次中斷時寫到一半的最後一行
+                        continue
+                    self._entries[entry["path"]] = entry
+        self._file = open(path, "a", encoding="utf-8")
+
+    def is_done(self, rel_path: str, size: int, mtime_ns: int) -> bool:
+        entry = self._entries.get(rel_path)
+        return (entry is not None and entry["status"] in DONE_STATUSES
+                and entry["size"] == size and entry["mtime_ns"] == mtime_ns)
+
+    def record(self, entry: dict):
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            self._entries[entry["path"]] = entry
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def scan(directory: str, extensions=SUPPORTED_EXTENSIONS, max_size: int = MAX_FILE_SIZE, skip=()):
+    """
+    依路徑順序列出目錄中要上傳的檔案
+
+    Yields:
+        (相對路徑, 絕對路徑, 大小, 修改時間 ns, 略過原因)；略過原因為 unsupported、too_large 或 None
+    """
+    skip = {os.path.abspath(path) for path in skip}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            path = os.path.abspath(os.path.join(root, name))
+            if name.startswith(".") or path in skip:
+                continue
+            rel_path = os.path.relpath(path, directory)
+            if extensions and os.path.splitext(name)[1].lower() not in extensions:
+                yield rel_path, path, None, None, "unsupported"
+                continue
+            stat = os.stat(path)
+            if stat.st_size > max_size:
+                yield rel_path, path, stat.st_size, None, "too_large"
+                continue
+            yield rel_path, path, stat.st_size, stat.st_mtime_ns, None
+
+
+def hash_file(path: str):
+    """回傳 (SHA-256, MD5)；MD5 用來與 Drive 的 md5Checksum 比對"""
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+class Backfill:
+    """以 ThreadPoolExecutor 平行上傳，並統計結果"""
+
+    def __init__(self, directory: str, manifest: BackfillManifest, workers: int, skip_existing: bool = True):
+        self.directory = directory
+        self.manifest = manifest
+        self.workers = max(1, workers)
+        self.dedup_index = DedupIndex(DEDUP_DB_PATH) if DEDUP_ENABLED else None
+        self.existing = {}
+        if skip_existing:
+            # 一次列出資料夾內容，之後不必每個檔案都查詢 Drive
+            for file in list_upload_folder_files():
+                self.existing.setdefault(file["name"], []).append(file)
+            logger.info(f"📂 上傳資料夾中已有 {sum(map(len, self.existing.values()))} 個檔案")
+        self.counts = dict.fromkeys(
+            ("uploaded", "exists", "duplicate", "resumed", "unsupported", "too_large", "failed"), 0)
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def _find_existing(self, name, size, md5):
+        for file in self.existing.get(name, ()):
+            if file.get("size") is not None and int(file["size"]) != size:
+                continue
+            if file.get("md5Checksum") and file["md5Checksum"] != md5:
+                continue
+            return file
+        return None
+
+    def _find_duplicate(self, sha256, size):
+        if self.dedup_index is None:
+            return None
+        existing = self.dedup_index.lookup(sha256, size)
+        if existing and DEDUP_VERIFY_ON_HIT and not drive_file_exists(existing["file_id"]):
+            self.dedup_index.forget(existing["file_id"])
+            return None
+        return existing
+
+    def _wait_for_drive(self):
+        # 斷路器開啟時等 Drive 恢復，避免整批檔案都記成失敗
+        while not breaker.accepting():
+            time.sleep(1)
+
+    def _process(self, rel_path, path, size, mtime_ns):
+        name = os.path.basename(path)
+        entry = {"path": rel_path, "size": size, "mtime_ns": mtime_ns}
+        started = time.monotonic()
+        try:
+            sha256, md5 = hash_file(path)
+            entry["sha256"] = sha256
+            existing = self._find_existing(name, size, md5)
+            if existing is not None:
+                entry.update(status="exists", file_id=existing["id"])
+            else:
+                duplicate = self._find_duplicate(sha256, size)
+                if duplicate is not None:
+                    entry.update(status="duplicate", file_id=duplicate["file_id"], web_link=duplicate["web_link"])
+                else:
+                    self._wait_for_drive()
+                    file_id, web_link = upload_file_to_drive(path, name)
+                    entry.update(status="uploaded", file_id=file_id, web_link=web_link)
+                    if self.dedup_index is not None:
+                        self.dedup_index.record(sha256, size, file_id, web_link, name)
+        except Exception as e:
+            entry.update(status="failed", error=f"{type(e).__name__}: {e}"[:300])
+            logger.error(f"🚨 {rel_path} 上傳失敗: {str(e)}")
+        entry["seconds"] = round(time.monotonic() - started, 3)
+        entry["at"] = time.time()
+        self.manifest.record(entry)
+        with self._lock:
+            self.counts[entry["status"]] += 1
+            if entry["status"] == "uploaded":
+                self.uploaded_bytes += size
+        if entry["status"] != "failed":
+            logger.info(f"{'✅' if entry['status'] == 'uploaded' else '⏭️'} {entry['status']}: {rel_path}")
+
+    def run(self) -> dict:
+        """
+        處理目錄中的所有檔案
+
+        Returns:
+            統計結果；被 Ctrl+C 中斷時 interrupted 為 True（進行中的上傳會先完成）
+        """
+        started = time.monotonic()
+        interrupted = False
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backfill")
+        try:
+            futures = []
+            for rel_path, path, size, mtime_ns, skip_reason in scan(self.directory, skip=[self.manifest.path]):
+                if skip_reason is not None:
+                    self.counts[skip_reason] += 1
+                elif self.manifest.is_done(rel_path, size, mtime_ns):
+                    self.counts["resumed"] += 1
+                else:
+                    futures.append(executor.submit(self._process, rel_path, path, size, mtime_ns))
+            for future in as_completed(futures):
+                future.result()
+        except KeyboardInterrupt:
+            interrupted = True
+            logger.warning("⏹️ 已中斷，等待進行中的上傳完成；重新執行同一個指令即可繼續")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        elapsed = time.monotonic() - started
+        return {
+            "counts": dict(self.counts),
+            "uploaded_bytes": self.uploaded_bytes,
+            "elapsed_seconds": round(elapsed, 2),
+            "files_per_second": round(self.counts["uploaded"] / elapsed, 2) if elapsed else 0,
+            "mb_per_second": round(self.uploaded_bytes / (1024 * 1024) / elapsed, 3) if elapsed else 0,
+            "interrupted": interrupted,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把本機目錄中的檔案批次上傳到 bot 使用的 Drive 資料夾")
+    parser.add_argument("directory", help="要上傳的目錄（包含子目錄）")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="同時上傳的檔案數")
+    parser.add_argument("--manifest", help="進度紀錄檔路徑（預設為 backfill-<目錄名稱>.jsonl）")
+    parser.add_argument("--no-skip-existing", dest="skip_existing", action="store_false",
+                        help="不比對 Drive 資料夾中已有的檔案")
+    args = parser.parse_args()
+
+    setup_logging(LOG_LEVEL, LOG_FORMAT)
+    directory = os.path.abspath(args.directory)
+    if not os.path.isdir(directory):
+        parser.error(f"找不到目錄: {args.directory}")
+    manifest = BackfillManifest(args.manifest or f"backfill-{os.path.basename(directory)}.jsonl")
+    try:
+        result = Backfill(directory, manifest, args.workers, args.skip_existing).run()
+    finally:
+        manifest.close()
+
+    counts = result["counts"]
+    print(f"📊 上傳 {counts['uploaded']}、已存在 {counts['exists']}、重複內容 {counts['duplicate']}、"
+          f"先前已完成 {counts['resumed']}、失敗 {counts['failed']}、"
+          f"略過 {counts['unsupported'] + counts['too_large']}（不支援或過大）")
+    print(f"   上傳 {result['uploaded_bytes'] / (1024 * 1024):.1f} MB，耗時 {result['elapsed_seconds']} 秒")
+    print(f"   吞吐量 {result['files_per_second']} files/s、{result['mb_per_second']} MB/s")
+    print(f"   進度紀錄: {manifest.path}")
+    if counts["failed"] or result["interrupted"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
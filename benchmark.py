@@ -0,0 +1,390 @@
+"""
+離線壓測工具
+
+在本機啟動模擬的 LINE（內容下載、reply／push）與 Google Drive v3（files、上傳）伺服器，
+把 main.app 指向它們，再以指定速率與檔案大小分佈送出帶簽章的 webhook，
+量測 webhook → 下載 → 上傳 → 回覆 整條流程的延遲與吞吐量。不需要真實的 LINE 或 Google 帳號。
+
+    python benchmark.py --count 200 --rate 20 --sizes "256KB:6,4MB:3,32MB:1" \\
+        --drive-latency 0.05 --drive-bandwidth 20MB --drive-error-rate 0.02 \\
+        --output benchmark_results.json --baseline previous.json
+
+UPLOAD_WORKERS、DRIVE_REQUESTS_PER_MINUTE 等設定照常從環境變數讀取，可用來比較不同設定。
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import platform
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from fake_services import FakeLineServer, FakeDriveServer, FaultProfile
+
+logger = logging.getLogger("benchmark")
+
+_SIZE_PATTERN = re.compile(r"^\s*([\d.]+)\s*([KMG]?B?)\s*$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}
+
+BENCH_CHANNEL_SECRET = "benchmark-channel-secret"
+
+
+def parse_size(text: str) -> int:
+    """把 256KB、4MB、1.5GB 等字串轉成位元組數"""
+    match = _SIZE_PATTERN.match(text)
+    if not match:
+        raise ValueError(f"無法解析大小: {text}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_distribution(text: str) -> list:
+    """
+    解析檔案大小分佈
+
+    Args:
+        text: 例如 "256KB:6,4MB:3,32MB:1"（大小:權重，權重省略時為 1）
+
+    Returns:
+        [(size_bytes, weight), ...]
+    """
+    distribution = []
+    for item in text.split(","):
+        size, _, weight = item.partition(":")
+        distribution.append((parse_size(size), float(weight or 1)))
+    return distribution
+
+
+def percentile(values, p: float):
+    """線性內插的百分位數；沒有資料時回傳 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(seconds) -> dict:
+    """延遲統計（毫秒）"""
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "count": len(seconds),
+        "p50": ms(percentile(seconds, 50)),
+        "p95": ms(percentile(seconds, 95)),
+        "p99": ms(percentile(seconds, 99)),
+        "mean": ms(sum(seconds) / len(seconds)) if seconds else None,
+        "max": ms(max(seconds)) if seconds else None,
+    }
+
+
+def _service_account_info(token_uri: str, index: int = 0) -> dict:
+    """產生一組只對模擬 Drive 有效的 Service Account（真的 RSA 金鑰，google-auth 才能簽 JWT）"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("utf-8")
+    return {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": pem,
+        "client_email": f"benchmark{index}@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _prepare_environment(line: FakeLineServer, drive: FakeDriveServer, workdir: str, log_level: str,
+                         accounts: int = 1):
+    """在 import main 之前設定環境變數，讓 app 使用模擬伺服器與暫存的資料庫"""
+    os.environ.update({
+        "LINE_CHANNEL_ACCESS_TOKEN": "benchmark-token",
+        "LINE_CHANNEL_SECRET": BENCH_CHANNEL_SECRET,
+        "LINE_API_ENDPOINT": line.url,
+        "LINE_DATA_ENDPOINT": line.url,
+        "GOOGLE_SERVICE_ACCOUNT_JSON": json.dumps(
+            [_service_account_info(drive.token_uri, index) for index in range(max(1, accounts))]),
+        "DRIVE_API_ENDPOINT": drive.api_endpoint,
+        "SHARED_DRIVE_ID": "",
+        "JOB_DB_PATH": os.path.join(workdir, "upload_jobs.sqlite3"),
+        "DEDUP_DB_PATH": os.path.join(workdir, "dedup_index.sqlite3"),
+        "DRIVE_PROBE_CACHE_FILE": os.path.join(workdir, "drive_probe_cache.json"),
+        "LOG_LEVEL": log_level,
+    })
+
+
+def _start_app(port: int):
+    """在背景執行緒以 uvicorn 啟動 main.app"""
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="benchmark-app", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("main.app 啟動失敗")
+        time.sleep(0.05)
+    return main, server, thread
+
+
+def _record_rejections(main) -> set:
+    """
+    記錄被准入檢查拒絕的訊息 ID
+
+    /callback 一律回 200，被拒絕（忙碌、配額、檔案過大等）的事件只會收到文字回覆，
+    無法從 HTTP 狀態或回覆類型分辨，所以直接包裝 app 的准入檢查。
+    """
+    rejected = set()
+    check = main.admission.check
+
+    def recording_check(event, chat_id, queue_depth):
+        rejection = check(event, chat_id, queue_depth)
+        if rejection is not None:
+            rejected.add(event.message.id)
+        return rejection
+
+    main.admission.check = recording_check
+    return rejected
+
+
+def _webhook_body(run_id: str, index: int, size: int) -> bytes:
+    """單一檔案訊息事件；每個事件用不同的使用者與 reply token，方便對應回覆"""
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": f"{run_id}-{index}",
+        "deliveryContext": {"isRedelivery": False},
+        "source": {"type": "user", "userId": f"U{run_id}{index}"},
+        "replyToken": f"{run_id}-reply-{index}",
+        "message": {
+            "id": f"{run_id}{index}",
+            "type": "file",
+            "fileName": f"bench-{index}.pdf",
+            "fileSize": size,
+        },
+    }
+    return json.dumps({"destination": "Ubenchmark", "events": [event]}).encode("utf-8")
+
+
+def _sign(body: bytes) -> str:
+    digest = hmac.new(BENCH_CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def run(args) -> dict:
+    """執行一次壓測並回傳結果"""
+    line = FakeLineServer(FaultProfile(args.line_latency, args.line_bandwidth, args.line_error_rate)).start()
+    drive = FakeDriveServer(FaultProfile(args.drive_latency, args.drive_bandwidth, args.drive_error_rate)).start()
+    workdir = tempfile.mkdtemp(prefix="line-uploader-bench-")
+    _prepare_environment(line, drive, workdir, args.log_level, args.accounts)
+
+    port = _free_port()
+    main, server, thread = _start_app(port)
+    rejected_ids = _record_rejections(main)
+    import config
+    callback_url = f"http://127.0.0.1:{port}/callback"
+    rng = random.Random(args.seed)
+    sizes, weights = zip(*parse_distribution(args.sizes))
+    run_id = datetime.datetime.now().strftime("%H%M%S")
+
+    events = []
+    for index in range(args.count):
+        size = rng.choices(sizes, weights)[0]
+        line.register_content(f"{run_id}{index}", size)
+        events.append({
+            "index": index,
+            "message_id": f"{run_id}{index}",
+            "size": size,
+            "reply_token": f"{run_id}-reply-{index}",
+            "chat_id": f"U{run_id}{index}",
+        })
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def send(event):
+        body = _webhook_body(run_id, event["index"], event["size"])
+        event["sent_at"] = time.monotonic()
+        try:
+            response = session.post(callback_url, data=body, timeout=30, headers={
+                "Content-Type": "application/json",
+                "X-Line-Signature": _sign(body),
+            })
+            event["status"] = response.status_code
+        except requests.RequestException as e:
+            event["status"] = type(e).__name__
+        event["ack_seconds"] = time.monotonic() - event["sent_at"]
+
+    logger.info(f"🚀 送出 {args.count} 個 webhook（{args.rate}/s）")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for event in events:
+            delay = started + event["index"] / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, event)
+    sent_seconds = time.monotonic() - started
+
+    accepted = [event for event in events if event["status"] == 200 and event["message_id"] not in rejected_ids]
+    keys = [key for event in accepted for key in (event["reply_token"], event["chat_id"])]
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        pending = [event for event in accepted if _delivery(line, event) is None]
+        if not pending:
+            break
+        line.wait_for([key for event in pending for key in (event["reply_token"], event["chat_id"])],
+                      min(1.0, max(0.0, deadline - time.monotonic())))
+
+    latencies, succeeded_bytes, finished_at = [], 0, started
+    outcome = {"sent": len(events), "accepted": len(accepted), "rejected": 0, "errors": 0,
+               "succeeded": 0, "failed": 0, "timed_out": 0, "pushed": 0}
+    for event in events:
+        if event["status"] != 200:
+            outcome["errors"] += 1
+            continue
+        if event["message_id"] in rejected_ids:
+            outcome["rejected"] += 1
+            continue
+        delivery = _delivery(line, event)
+        if delivery is None:
+            outcome["timed_out"] += 1
+            continue
+        finished_at = max(finished_at, delivery["at"])
+        if delivery["via"] == "push":
+            outcome["pushed"] += 1
+        if "flex" in delivery["types"]:
+            outcome["succeeded"] += 1
+            succeeded_bytes += event["size"]
+            latencies.append(delivery["at"] - event["sent_at"])
+        else:
+            outcome["failed"] += 1
+
+    elapsed = max(finished_at - started, 1e-6)
+    result = {
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "upload_workers": config.UPLOAD_WORKERS,
+            "drive_requests_per_minute": config.DRIVE_REQUESTS_PER_MINUTE,
+            "drive_client_pool_size": config.DRIVE_CLIENT_POOL_SIZE,
+            "drive_accounts": len(main.drive_accounts),
+            "drive_account_strategy": config.DRIVE_ACCOUNT_STRATEGY,
+            "upload_chunk_size": config.UPLOAD_CHUNK_SIZE,
+            "reply_coalesce_window_ms": config.REPLY_COALESCE_WINDOW_MS,
+        },
+        "events": outcome,
+        "webhook_ack_ms": summarize([event["ack_seconds"] for event in events if "ack_seconds" in event]),
+        "end_to_end_ms": summarize(latencies),
+        "throughput": {
+            "elapsed_seconds": round(elapsed, 3),
+            "send_seconds": round(sent_seconds, 3),
+            "uploads_per_second": round(outcome["succeeded"] / elapsed, 3),
+            "mb_per_second": round(succeeded_bytes / (1024 * 1024) / elapsed, 3),
+            "uploaded_mb": round(succeeded_bytes / (1024 * 1024), 3),
+        },
+        "app": {
+            "queue": main.upload_queue.stats(),
+            "drive_accounts": main.drive_accounts.stats(),
+        },
+        "fake_line": line.stats(),
+        "fake_drive": drive.stats(),
+    }
+
+    server.should_exit = True
+    thread.join(timeout=30)
+    line.stop()
+    drive.stop()
+    return result
+
+
+def _delivery(line: FakeLineServer, event):
+    return line.delivery(event["reply_token"]) or line.delivery(event["chat_id"])
+
+
+def compare(result: dict, baseline: dict) -> list:
+    """和前一次的結果比較主要指標，回傳可直接輸出的文字"""
+    rows = [
+        ("end_to_end_ms", "p50"), ("end_to_end_ms", "p95"), ("end_to_end_ms", "p99"),
+        ("webhook_ack_ms", "p95"), ("throughput", "uploads_per_second"), ("throughput", "mb_per_second"),
+    ]
+    lines = []
+    for section, key in rows:
+        current = result.get(section, {}).get(key)
+        previous = baseline.get(section, {}).get(key)
+        if current is None or previous is None:
+            continue
+        change = f"{(current - previous) / previous * 100:+.1f}%" if previous else "n/a"
+        lines.append(f"{section}.{key}: {previous} → {current} ({change})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以模擬的 LINE／Drive 伺服器壓測上傳流程")
+    parser.add_argument("--count", type=int, default=100, help="送出的 webhook 事件數")
+    parser.add_argument("--rate", type=float, default=10.0, help="每秒送出的 webhook 數")
+    parser.add_argument("--sizes", default="256KB:6,2MB:3,16MB:1", help="檔案大小分佈，格式為 大小:權重,...")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時送出 webhook 的連線數上限")
+    parser.add_argument("--timeout", type=float, default=300.0, help="送完後等待回覆的秒數上限")
+    parser.add_argument("--seed", type=int, default=0, help="檔案大小抽樣的亂數種子")
+    parser.add_argument("--line-latency", type=float, default=0.0, help="模擬 LINE 每個請求的延遲（秒）")
+    parser.add_argument("--line-bandwidth", type=parse_size, default=0, help="模擬 LINE 下載頻寬（每秒，例如 20MB）")
+    parser.add_argument("--line-error-rate", type=float, default=0.0, help="模擬 LINE 內容下載的錯誤率（0～1）")
+    parser.add_argument("--drive-latency", type=float, default=0.0, help="模擬 Drive 每個請求的延遲（秒）")
+    parser.add_argument("--drive-bandwidth", type=parse_size, default=0, help="模擬 Drive 上傳頻寬（每秒，例如 20MB）")
+    parser.add_argument("--drive-error-rate", type=float, default=0.0, help="模擬 Drive 請求的錯誤率（0～1，回傳 503）")
+    parser.add_argument("--accounts", type=int, default=1, help="模擬的 Service Account 數量")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "WARNING"), help="app 的日誌等級")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果 JSON 檔路徑")
+    parser.add_argument("--baseline", help="前一次的結果 JSON，用來比較")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    result = run(args)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    e2e, throughput, outcome = result["end_to_end_ms"], result["throughput"], result["events"]
+    print(f"📊 事件 {outcome['sent']}：成功 {outcome['succeeded']}、失敗 {outcome['failed']}、"
+          f"拒絕 {outcome['rejected']}、逾時 {outcome['timed_out']}")
+    print(f"   端到端延遲 p50 {e2e['p50']} ms、p95 {e2e['p95']} ms、p99 {e2e['p99']} ms")
+    print(f"   吞吐量 {throughput['uploads_per_second']} uploads/s、{throughput['mb_per_second']} MB/s")
+    print(f"   結果已寫入 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print("📈 與基準比較：")
+        for line in compare(result, baseline):
+            print(f"   {line}")
+
+
+if __name__ == "__main__":
+    main()
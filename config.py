@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -16,4 +17,147 @@ assert LINE_CHANNEL_SECRET, "Missing LINE_CHANNEL_SECRET"
 SHARED_DRIVE_ID = os.getenv("SHARED_DRIVE_ID")  # 可留空；設了就會強制使用這顆 Shared Drive
 
 # 可選的上傳資料夾名稱
-UPLOAD_FOLDER_NAME = os.getenv("UPLOAD_FOLDER_NAME", "LINE Bot 檔案上傳")  # 預設值 
\ No newline at end of file
+UPLOAD_FOLDER_NAME = os.getenv("UPLOAD_FOLDER_NAME", "LINE Bot 檔案上傳")  # 預設值 
+# 背景上傳 worker 數量；UPLOAD_QUEUE_MAX_SIZE 為 SHED_QUEUE_DEPTH 的預設值（待處理工作達此數量時降載）
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_QUEUE_MAX_SIZE = int(os.getenv("UPLOAD_QUEUE_MAX_SIZE", "1000"))
+
+# 上傳資料夾 ID 快取秒數
+FOLDER_CACHE_TTL = int(os.getenv("FOLDER_CACHE_TTL", "3600"))
+# 上傳資料夾底下的分區資料夾樣板，以 / 分隔各層，可用 {chat}、{yyyy}、{mm}、{dd}
+# 例如 "{chat}/{yyyy}-{mm}"；留空代表所有檔案都放在上傳資料夾（不分區）
+FOLDER_LAYOUT = os.getenv("FOLDER_LAYOUT", "")
+# 分區資料夾 {yyyy}、{mm}、{dd} 使用的時區（IANA 名稱，例如 "Asia/Taipei"），不受伺服器時區影響
+FOLDER_TIMEZONE = os.getenv("FOLDER_TIMEZONE", "UTC")
+
+# 超過此大小（bytes）的檔案改用分塊 resumable upload
+RESUMABLE_UPLOAD_THRESHOLD = int(os.getenv("RESUMABLE_UPLOAD_THRESHOLD", str(5 * 1024 * 1024)))
+# 每個區塊大小，需為 256 KB 的倍數
+UPLOAD_CHUNK_SIZE = max(1, int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))) // (256 * 1024)) * 256 * 1024
+# 單一區塊連續失敗的重試次數上限
+UPLOAD_CHUNK_RETRIES = int(os.getenv("UPLOAD_CHUNK_RETRIES", "5"))
+
+# 宣告大小超過此值（bytes）的 LINE 檔案不串流，改用暫存檔上傳
+STREAM_UPLOAD_MAX_SIZE = int(os.getenv("STREAM_UPLOAD_MAX_SIZE", str(100 * 1024 * 1024)))
+
+# Shared Drive 偵測結果快取檔與有效秒數（設為 0 停用快取）
+DRIVE_PROBE_CACHE_FILE = os.getenv("DRIVE_PROBE_CACHE_FILE", ".drive_probe_cache.json")
+DRIVE_PROBE_CACHE_TTL = int(os.getenv("DRIVE_PROBE_CACHE_TTL", str(24 * 60 * 60)))
+# 沒偵測到可用 Shared Drive 時，隔多少秒重新偵測
+DRIVE_PROBE_RETRY_SECONDS = int(os.getenv("DRIVE_PROBE_RETRY_SECONDS", "300"))
+# 服務啟動後是否在背景預熱 Drive client
+DRIVE_WARMUP_ON_STARTUP = os.getenv("DRIVE_WARMUP_ON_STARTUP", "true").lower() == "true"
+
+# 內容去重索引（SHA-256 + 大小 → 既有 Drive 檔案）
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "dedup_index.sqlite3")
+# 命中時先確認 Drive 檔案仍存在（多一次 files().get，避免回覆失效連結）
+DEDUP_VERIFY_ON_HIT = os.getenv("DEDUP_VERIFY_ON_HIT", "true").lower() == "true"
+
+# 持久化工作佇列
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "upload_jobs.sqlite3")
+# 工作租約秒數；處理中的 worker 會定期續約，租約過期代表程序已中斷
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# 已完成工作紀錄保留秒數
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 60 * 60)))
+# reply token 有效秒數（保守估計），超過後改用 push_message
+REPLY_TOKEN_TTL_SECONDS = int(os.getenv("REPLY_TOKEN_TTL_SECONDS", "50"))
+# 記憶體中保留的最近事件鍵數量（webhookEventId、訊息 ID），用來快速略過 LINE 重送的事件
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+# Drive 請求速率限制（依專案配額調整）與重試設定
+DRIVE_REQUESTS_PER_MINUTE = int(os.getenv("DRIVE_REQUESTS_PER_MINUTE", "600"))
+DRIVE_REQUEST_BURST = int(os.getenv("DRIVE_REQUEST_BURST", "20"))
+DRIVE_MAX_RETRIES = int(os.getenv("DRIVE_MAX_RETRIES", "5"))
+DRIVE_MAX_BACKOFF = float(os.getenv("DRIVE_MAX_BACKOFF", "64"))
+# Drive HTTP 連線池大小（同時進行的 Drive 請求數上限）；連線只在單一 HTTP 請求期間借出，
+# 讀取 LINE 內容時不占用，建議約為 UPLOAD_WORKERS + 2，讓上傳之外的查詢（資料夾、去重）不必排隊
+DRIVE_CLIENT_POOL_SIZE = int(os.getenv("DRIVE_CLIENT_POOL_SIZE", str(UPLOAD_WORKERS + 2)))
+# 等待可用 Drive 連線的秒數上限，逾時視為上傳失敗（工作稍後重試）；0 代表不限制
+DRIVE_CONNECTION_TIMEOUT = float(os.getenv("DRIVE_CONNECTION_TIMEOUT", "60"))
+# 多個 Service Account 時（GOOGLE_SERVICE_ACCOUNT_JSON 為 JSON 陣列或目錄），上傳分配策略：least_loaded 或 round_robin
+# 上述速率限制與連線池大小都是「每個帳號」各自計算
+DRIVE_ACCOUNT_STRATEGY = os.getenv("DRIVE_ACCOUNT_STRATEGY", "least_loaded")
+# 帳號回傳配額錯誤時的冷卻秒數（連續發生時加倍，最多到上限；每日配額用盡時直接使用上限）
+DRIVE_ACCOUNT_COOLDOWN_SECONDS = float(os.getenv("DRIVE_ACCOUNT_COOLDOWN_SECONDS", "60"))
+DRIVE_ACCOUNT_MAX_COOLDOWN_SECONDS = float(os.getenv("DRIVE_ACCOUNT_MAX_COOLDOWN_SECONDS", str(60 * 60)))
+# 每個帳號 24 小時內的上傳量上限（bytes，0 代表不限制）；Drive 每個帳號每天可上傳 750 GB
+DRIVE_ACCOUNT_DAILY_UPLOAD_BYTES = int(os.getenv("DRIVE_ACCOUNT_DAILY_UPLOAD_BYTES", str(700 * 1024 ** 3)))
+# Drive 斷路器：連續幾次 Drive 故障（5xx、連線錯誤）後開啟，開啟期間上傳直接失敗、工作留在佇列
+DRIVE_BREAKER_FAILURE_THRESHOLD = int(os.getenv("DRIVE_BREAKER_FAILURE_THRESHOLD", "5"))
+# 斷路器開啟後多久放行一個試探請求（秒）
+DRIVE_BREAKER_RECOVERY_SECONDS = float(os.getenv("DRIVE_BREAKER_RECOVERY_SECONDS", "30"))
+# 背景 Drive 健康檢查的間隔秒數（/diag/drive 回傳最近一次結果；0 代表不在背景檢查）
+DRIVE_HEALTH_PROBE_INTERVAL = float(os.getenv("DRIVE_HEALTH_PROBE_INTERVAL", "60"))
+
+# 同一個聊天室的上傳結果合併回覆：等待視窗（毫秒，0 代表不合併）與單則回覆的結果數上限（最多 12）
+REPLY_COALESCE_WINDOW_MS = int(os.getenv("REPLY_COALESCE_WINDOW_MS", "1500"))
+REPLY_COALESCE_MAX_ITEMS = int(os.getenv("REPLY_COALESCE_MAX_ITEMS", "10"))
+
+# 日誌等級（DEBUG 會輸出每個事件的詳細資訊）與格式（text 或 json）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# 每個 webhook 事件的處理階段（span）輸出成 JSON Lines 的檔案路徑（留空代表不輸出）
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+# 管理 API（/admin/*）的 token，以 Authorization: Bearer <token> 傳入；留空代表停用管理 API
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 取樣 profiling 的輸出目錄
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", "profiles")
+
+# LINE 內容下載：同時下載數上限、串流區塊大小（bytes）與連線／讀取逾時秒數
+LINE_MAX_CONCURRENT_DOWNLOADS = int(os.getenv("LINE_MAX_CONCURRENT_DOWNLOADS", "16"))
+LINE_DOWNLOAD_CHUNK_SIZE = int(os.getenv("LINE_DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+LINE_HTTP_TIMEOUT = float(os.getenv("LINE_HTTP_TIMEOUT", "60"))
+
+# API 端點（壓測或本機測試時可指向 benchmark.py 啟動的模擬伺服器）
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+LINE_DATA_ENDPOINT = os.getenv("LINE_DATA_ENDPOINT", "https://api-data.line.me")
+DRIVE_API_ENDPOINT = os.getenv("DRIVE_API_ENDPOINT")  # 例如 http://127.0.0.1:9100/（取代 https://www.googleapis.com/）；留空使用正式端點
+
+# 上傳准入：單一檔案大小上限（bytes）與支援的副檔名（逗號分隔，留空代表不限制）
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(100 * 1024 * 1024)))
+SUPPORTED_EXTENSIONS = [
+    ext.strip().lower() for ext in os.getenv(
+        "SUPPORTED_EXTENSIONS", ".pdf,.jpg,.jpeg,.png,.gif,.mp4,.avi,.mov,.doc,.docx,.xls,.xlsx"
+    ).split(",") if ext.strip()
+]
+# 每個使用者／群組在時間窗（秒）內可上傳的位元組數（0 代表不限制）
+QUOTA_WINDOW_SECONDS = int(os.getenv("QUOTA_WINDOW_SECONDS", "3600"))
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", "0"))
+GROUP_QUOTA_BYTES = int(os.getenv("GROUP_QUOTA_BYTES", "0"))
+# 每個使用者／聊天室同時處理的上傳數上限（0 代表不限制），超過的工作延後處理
+USER_MAX_CONCURRENT_UPLOADS = int(os.getenv("USER_MAX_CONCURRENT_UPLOADS", "2"))
+GROUP_MAX_CONCURRENT_UPLOADS = int(os.getenv("GROUP_MAX_CONCURRENT_UPLOADS", str(max(1, UPLOAD_WORKERS // 2))))
+# 降載：待處理工作數或暫存磁碟使用率（%）達到門檻時，直接回覆使用者稍後再傳
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", str(UPLOAD_QUEUE_MAX_SIZE)))
+SHED_TEMP_DISK_PERCENT = float(os.getenv("SHED_TEMP_DISK_PERCENT", "90"))
+
+# 暫存目錄（大檔案或串流失敗時先落地再上傳）與其位元組預算（0 代表不限制）
+# 預算由每個程序各自計算：多個 uvicorn worker 共用 TEMP_FOLDER 時，實際上限為 預算 × worker 數
+TEMP_FOLDER = os.getenv("TEMP_FOLDER", "temp_files")
+SPOOL_BUDGET_BYTES = int(os.getenv("SPOOL_BUDGET_BYTES", str(2 * 1024 * 1024 * 1024)))
+# 小於此大小（bytes）的內容留在記憶體，不寫入暫存目錄
+SPOOL_MEMORY_THRESHOLD = int(os.getenv("SPOOL_MEMORY_THRESHOLD", str(4 * 1024 * 1024)))
+# 暫存預算不足時最多等待秒數，逾時後工作稍後重試
+SPOOL_WAIT_SECONDS = float(os.getenv("SPOOL_WAIT_SECONDS", "30"))
+# 背景清理遺留暫存檔的間隔，以及無法判斷建立者的檔案多久未修改後清除（秒）
+SPOOL_SWEEP_INTERVAL = int(os.getenv("SPOOL_SWEEP_INTERVAL", "300"))
+SPOOL_ORPHAN_SECONDS = int(os.getenv("SPOOL_ORPHAN_SECONDS", "3600"))
+
+# 圖片訊息上傳前的轉檔（需要安裝 Pillow）：重新壓縮、限制解析度並產生 Flex 縮圖
+IMAGE_TRANSFORM_ENABLED = os.getenv("IMAGE_TRANSFORM_ENABLED", "false").lower() == "true"
+# 轉檔使用的子程序數
+IMAGE_TRANSFORM_WORKERS = int(os.getenv("IMAGE_TRANSFORM_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# 長邊像素上限（0 代表不縮小）與重新壓縮的 JPEG 品質（1～95）
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2560"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# Flex 縮圖的長邊像素（0 代表不產生縮圖）
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "480"))
+# 各聊天室的轉檔設定覆寫（JSON），例如 {"Cxxxx": {"enabled": false}, "Uxxxx": {"max_dimension": 0, "jpeg_quality": 95}}
+IMAGE_TRANSFORM_OVERRIDES = json.loads(os.getenv("IMAGE_TRANSFORM_OVERRIDES") or "{}")
+# 服務對外的 HTTPS 網址（例如 https://xxx.onrender.com）；設定後 Flex 訊息以縮圖作為 hero 圖片
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+# 縮圖保存目錄與保存秒數
+THUMBNAIL_FOLDER = os.getenv("THUMBNAIL_FOLDER", "thumbnails")
+THUMBNAIL_TTL_SECONDS = int(os.getenv("THUMBNAIL_TTL_SECONDS", str(7 * 24 * 60 * 60)))
@@ -0,0 +1,139 @@
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DedupIndex:
+    """
+    以內容雜湊去重的本地索引
+
+    以 (SHA-256, 檔案大小) 對應到已上傳的 Drive 檔案，
+    相同內容再次傳來時可直接回覆既有連結而不重新上傳。
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    file_id TEXT NOT NULL,
+                    web_link TEXT,
+                    file_name TEXT,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (sha256, size)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS files_file_id ON files (file_id)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, sha256: str, size: int) -> Optional[dict]:
+        """
+        查詢相同內容是否已上傳過
+
+        Returns:
+            包含 file_id、web_link、file_name 的字典，或 None
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT file_id, web_link, file_name FROM files WHERE sha256 = ? AND size = ?",
+                (sha256, size),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            conn.execute(
+                "UPDATE files SET hit_count = hit_count + 1, last_hit_at = ? WHERE sha256 = ? AND size = ?",
+                (time.time(), sha256, size),
+            )
+        return {"file_id": row[0], "web_link": row[1], "file_name": row[2]}
+
+    def record(self, sha256: str, size: int, file_id: str, web_link: str, file_name: str):
+        """記錄一個新上傳的檔案"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (sha256, size, file_id, web_link, file_name, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (sha256, size, file_id, web_link, file_name, time.time()),
+            )
+
+    def forget(self, file_id: str) -> int:
+        """移除指向某個 Drive 檔案的索引，回傳移除筆數"""
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,)).rowcount
+
+    def verify(self, file_exists: Callable[[str], bool], limit: Optional[int] = None) -> dict:
+        """
+        逐筆確認索引中的 Drive 檔案是否還在，移除已刪除的項目
+
+        Args:
+            file_exists: 給定 file_id 回傳檔案是否仍可用
+            limit: 最多檢查幾筆（由最久沒被確認的開始）；None 表示全部
+
+        Returns:
+            檢查與移除的筆數
+        """
+        with self._lock, self._connect() as conn:
+            query = "SELECT DISTINCT file_id FROM files ORDER BY COALESCE(last_hit_at, created_at)"
+            if limit is not None:
+                query += f" LIMIT {int(limit)}"
+            file_ids = [row[0] for row in conn.execute(query)]
+
+        removed = 0
+        for file_id in file_ids:
+            try:
+                if not file_exists(file_id):
+                    removed += self.forget(file_id)
+            except Exception as e:
+                logger.warning(f"⚠️ 無法確認檔案 {file_id}: {str(e)}")
+        return {"checked": len(file_ids), "removed": removed}
+
+    def stats(self) -> dict:
+        """命中率與索引大小"""
+        with self._lock, self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from config import DEDUP_DB_PATH
+
+    arg_parser = argparse.ArgumentParser(description="去重索引維護工具")
+    arg_parser.add_argument("command", choices=["stats", "verify"])
+    arg_parser.add_argument("--limit", type=int, default=None, help="verify 最多檢查幾筆")
+    args = arg_parser.parse_args()
+
+    index = DedupIndex(DEDUP_DB_PATH)
+    if args.command == "verify":
+        from drive_uploader import drive_file_exists
+        print(json.dumps(index.verify(drive_file_exists, args.limit), ensure_ascii=False))
+    else:
+        print(json.dumps(index.stats(), ensure_ascii=False))
@@ -0,0 +1,258 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from drive_pool import DriveHttpPool
+from drive_scheduler import DriveRequestScheduler, quota_error_reason, DAILY_QUOTA_REASONS
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DRIVE_ACCOUNT_UPLOADS = REGISTRY.counter(
+    "line_uploader_drive_account_uploads_total", "各 Service Account 的上傳數", ["account", "result"])
+DRIVE_ACCOUNT_UPLOADED_BYTES = REGISTRY.counter(
+    "line_uploader_drive_account_uploaded_bytes_total", "各 Service Account 上傳的位元組數", ["account"])
+DRIVE_ACCOUNT_COOLDOWNS = REGISTRY.counter(
+    "line_uploader_drive_account_cooldowns_total", "Service Account 因配額錯誤進入冷卻的次數", ["account"])
+DRIVE_ACCOUNT_IN_FLIGHT = REGISTRY.gauge(
+    "line_uploader_drive_account_in_flight", "各 Service Account 進行中的上傳數", ["account"])
+
+# Drive 每個帳號每天的上傳量上限以 24 小時滑動時間窗計算
+_DAY_SECONDS = 24 * 60 * 60
+
+
+class DriveAccount:
+    """
+    單一 Service Account
+
+    各自擁有憑證、Drive client、HTTP 連線池與速率限制（Drive 的每使用者速率限制與
+    每日上傳量都是依帳號計算），並記錄進行中的上傳數、24 小時內的上傳量與冷卻狀態。
+    """
+
+    def __init__(self, name: str, load_credentials, build_service, pool_size: int, requests_per_minute: int,
+                 burst: int, max_retries: int, max_backoff: float, daily_upload_bytes: int,
+                 connection_timeout: float = None):
+        """
+        Args:
+            name: 帳號名稱（Service Account 的 client_email）
+            load_credentials: 讀取憑證的函式（第一次使用時才呼叫）
+            build_service: 以憑證建立 Drive client 的函式
+            pool_size: HTTP 連線池大小
+            requests_per_minute: 每分鐘請求數上限
+            burst: 允許的瞬間請求數
+            max_retries: 單一請求的重試次數上限
+            max_backoff: 退避等待秒數上限
+            daily_upload_bytes: 24 小時內的上傳量上限（0 代表不限制），達到時暫停使用
+            connection_timeout: 等待連線池可用連線的秒數上限
+        """
+        self.name = name
+        self._load_credentials = load_credentials
+        self._build_service = build_service
+        self._daily_limit = daily_upload_bytes
+        self._init_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.credentials = None
+        self._service = None
+        self.http_pool = DriveHttpPool(pool_size, self.get_credentials, connection_timeout)
+        self.scheduler = DriveRequestScheduler(requests_per_minute, burst, max_retries, max_backoff,
+                                               http_pool=self.http_pool)
+        self.init_stats = {"credentials_ms": None, "client_build_ms": None}
+        self.in_flight = 0
+        self.uploads = 0
+        self.failures = 0
+        self.quota_errors = 0
+        self.consecutive_quota_errors = 0
+        self.cooldown_until = 0.0
+        self.last_error = None
+        self._uploaded = collections.deque()  # (時間, bytes)
+        self._uploaded_total = 0
+
+    def service(self):
+        """Drive client（第一次呼叫時建立）"""
+        if self._service is not None:
+            return self._service
+        with self._init_lock:
+            if self._service is None:
+                started = time.monotonic()
+                self.credentials = self._load_credentials()
+                self.init_stats["credentials_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+                started = time.monotonic()
+                self._service = self._build_service(self.credentials)
+                self.init_stats["client_build_ms"] = round((time.monotonic() - started) * 1000, 1)
+                logger.info(f"✅ Google Drive client 已建立（{self.name}）")
+        return self._service
+
+    def get_credentials(self):
+        """所有連線共用的憑證（與 Drive client 一起初始化）"""
+        self.service()
+        return self.credentials
+
+    def _expire(self, now):
+        while self._uploaded and self._uploaded[0][0] < now - _DAY_SECONDS:
+            self._uploaded_total -= self._uploaded.popleft()[1]
+
+    def uploaded_last_day(self) -> int:
+        """24 小時內的上傳量（bytes）"""
+        with self._lock:
+            self._expire(time.time())
+            return self._uploaded_total
+
+    def record_upload(self, size: int):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._uploaded.append((now, size))
+            self._uploaded_total += size
+        DRIVE_ACCOUNT_UPLOADED_BYTES.inc(size, account=self.name)
+
+    def available_at(self) -> float:
+        """可以再使用的時間（time.time()）；現在就能用時回傳 0"""
+        with self._lock:
+            now = time.time()
+            available = self.cooldown_until if self.cooldown_until > now else 0.0
+            if self._daily_limit:
+                self._expire(now)
+                if self._uploaded_total >= self._daily_limit and self._uploaded:
+                    # 最舊的上傳移出時間窗後才會有額度
+                    available = max(available, self._uploaded[0][0] + _DAY_SECONDS)
+            return available
+
+    def stats(self) -> dict:
+        available_at = self.available_at()
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "uploads": self.uploads,
+                "failures": self.failures,
+                "quota_errors": self.quota_errors,
+                "uploaded_bytes_24h": self._uploaded_total,
+                "daily_upload_bytes": self._daily_limit,
+                "cooldown_seconds": round(max(0.0, available_at - time.time()), 1) if available_at else 0,
+                "last_error": self.last_error,
+                "scheduler": self.scheduler.stats(),
+                "http_pool": self.http_pool.stats(),
+            }
+
+
+class DriveAccountPool:
+    """
+    多個 Service Account 的上傳排程
+
+    每次上傳借用一個可用的帳號：least_loaded 選進行中上傳數最少（同數時選 24 小時內
+    上傳量較少）的帳號，round_robin 依序輪流。帳號回傳配額錯誤時進入冷卻，連續發生時
+    冷卻時間加倍；所有帳號都在冷卻時改用最快恢復的帳號。
+
+    資料夾查詢與 Shared Drive 偵測只用第一個帳號（primary），所有帳號都上傳到同一個
+    Shared Drive 資料夾，因此每個帳號都必須是該 Shared Drive 的成員。
+    """
+
+    STRATEGIES = ("least_loaded", "round_robin")
+
+    def __init__(self, accounts, strategy: str, cooldown_seconds: float, max_cooldown_seconds: float):
+        """
+        Args:
+            accounts: DriveAccount 清單（第一個為 primary）
+            strategy: least_loaded 或 round_robin
+            cooldown_seconds: 第一次配額錯誤的冷卻秒數
+            max_cooldown_seconds: 冷卻秒數上限（每日配額用盡時直接使用）
+        """
+        if not accounts:
+            raise ValueError("至少需要一個 Service Account")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"不支援的排程策略: {strategy}（可用：{', '.join(self.STRATEGIES)}）")
+        self.accounts = list(accounts)
+        self._strategy = strategy
+        self._cooldown = cooldown_seconds
+        self._max_cooldown = max_cooldown_seconds
+        self._round_robin = itertools.cycle(range(len(self.accounts)))
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self) -> DriveAccount:
+        return self.accounts[0]
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def _pick(self, exclude):
+        candidates = [account for account in self.accounts if account.name not in exclude] or self.accounts
+        availability = {account.name: account.available_at() for account in candidates}
+        ready = [account for account in candidates if not availability[account.name]]
+        if not ready:
+            account = min(candidates, key=lambda a: availability[a.name])
+            logger.warning(f"⚠️ 所有 Service Account 都在冷卻中，改用最快恢復的帳號: {account.name}")
+            return account
+        if self._strategy == "round_robin":
+            for _ in range(len(self.accounts)):
+                account = self.accounts[next(self._round_robin)]
+                if account in ready:
+                    return account
+        return min(ready, key=lambda a: (a.in_flight, a.uploaded_last_day()))
+
+    def has_ready(self, exclude=()) -> bool:
+        """exclude 以外是否還有不在冷卻中的帳號"""
+        return any(not account.available_at() for account in self.accounts if account.name not in exclude)
+
+    @contextmanager
+    def lease(self, exclude=(), ignore=()):
+        """
+        借用一個帳號執行上傳；發生配額錯誤時讓該帳號進入冷卻
+
+        Args:
+            exclude: 這次不要使用的帳號名稱（例如剛回傳配額錯誤的帳號）
+            ignore: 不是帳號造成的例外類型（例如內容重複），只歸還帳號，不計入成功或失敗
+        """
+        with self._lock:
+            account = self._pick(set(exclude))
+            account.in_flight += 1
+        DRIVE_ACCOUNT_IN_FLIGHT.inc(account=account.name)
+        try:
+            yield account
+        except ignore:
+            self._release(account)
+            raise
+        except BaseException as e:
+            self._finish(account, e)
+            raise
+        self._finish(account, None)
+
+    def _release(self, account):
+        DRIVE_ACCOUNT_IN_FLIGHT.dec(account=account.name)
+        with self._lock:
+            account.in_flight -= 1
+
+    def _finish(self, account, error):
+        DRIVE_ACCOUNT_IN_FLIGHT.dec(account=account.name)
+        reason = quota_error_reason(error) if error is not None else None
+        with self._lock:
+            account.in_flight -= 1
+            if error is None:
+                account.uploads += 1
+                account.consecutive_quota_errors = 0
+            else:
+                account.failures += 1
+                account.last_error = f"{type(error).__name__}: {error}"[:300]
+            if reason is not None:
+                account.quota_errors += 1
+                account.consecutive_quota_errors += 1
+                if reason in DAILY_QUOTA_REASONS:
+                    cooldown = self._max_cooldown
+                else:
+                    cooldown = min(self._max_cooldown, self._cooldown * 2 ** (account.consecutive_quota_errors - 1))
+                account.cooldown_until = time.time() + cooldown
+        if error is None:
+            DRIVE_ACCOUNT_UPLOADS.inc(account=account.name, result="success")
+            return
+        DRIVE_ACCOUNT_UPLOADS.inc(account=account.name, result="quota" if reason else "error")
+        if reason is not None:
+            DRIVE_ACCOUNT_COOLDOWNS.inc(account=account.name)
+            logger.warning(f"🧊 {account.name} 回傳配額錯誤（{reason}），暫停使用 {cooldown:.0f} 秒")
+
+    def stats(self) -> dict:
+        return {
+            "strategy": self._strategy,
+            "accounts": {account.name: account.stats() for account in self.accounts},
+        }
@@ -0,0 +1,258 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from drive_scheduler import is_outage_error
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DRIVE_CIRCUIT_REJECTIONS = REGISTRY.counter(
+    "line_uploader_drive_circuit_rejections_total", "斷路器開啟時直接拒絕的 Drive 上傳數")
+DRIVE_CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    "line_uploader_drive_circuit_transitions_total", "斷路器狀態切換次數", ["state"])
+DRIVE_PROBE_SECONDS = REGISTRY.gauge(
+    "line_uploader_drive_probe_seconds", "最近一次 Drive 健康檢查耗時（秒）")
+DRIVE_PROBE_FAILURES = REGISTRY.counter(
+    "line_uploader_drive_probe_failures_total", "Drive 健康檢查失敗次數")
+
+
+class DriveUnavailableError(Exception):
+    """Drive 斷路器開啟中，上傳直接失敗（不等待逾時）"""
+
+
+class CircuitBreaker:
+    """
+    Drive 上傳的斷路器
+
+    closed：正常放行；連續 failure_threshold 次 Drive 故障（5xx、連線錯誤）後切到 open。
+    open：直接丟出 DriveUnavailableError；recovery_seconds 後（或健康檢查成功時）切到 half_open。
+    half_open：只放行一個試探請求，成功就回到 closed，失敗則重新 open。
+
+    4xx 等 Drive 有正常回應的錯誤代表服務可用，不計入故障。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_seconds: float):
+        """
+        Args:
+            failure_threshold: 連續幾次故障後開啟
+            recovery_seconds: 開啟後多久進入半開、放行試探請求
+        """
+        self._threshold = max(1, failure_threshold)
+        self._recovery = recovery_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._rejected = 0
+        self._last_error = None
+
+    def _transition(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        DRIVE_CIRCUIT_TRANSITIONS.inc(state=state)
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+            logger.warning(f"🔌 Drive 斷路器開啟（連續 {self._failures} 次故障），{self._recovery:.0f} 秒內上傳直接失敗")
+        elif state == self.HALF_OPEN:
+            logger.info("🔌 Drive 斷路器半開，放行試探請求")
+        else:
+            logger.info("🔌 Drive 斷路器關閉，恢復正常上傳")
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._recovery:
+                self._transition(self.HALF_OPEN)
+            return self._state
+
+    def state_code(self) -> int:
+        """狀態的數值（0 關閉、1 半開、2 開啟），給 Prometheus gauge 使用"""
+        return (self.CLOSED, self.HALF_OPEN, self.OPEN).index(self.state)
+
+    def accepting(self) -> bool:
+        """是否會放行新的上傳（給佇列判斷要不要取出工作）"""
+        state = self.state
+        with self._lock:
+            return state == self.CLOSED or (state == self.HALF_OPEN and not self._trial_in_flight)
+
+    def _reject(self, state):
+        with self._lock:
+            self._rejected += 1
+        DRIVE_CIRCUIT_REJECTIONS.inc()
+        raise DriveUnavailableError(f"Drive 暫時無法使用（斷路器{'開啟' if state == self.OPEN else '半開試探中'}）")
+
+    def ensure_available(self):
+        """
+        開啟中時立即丟出 DriveUnavailableError（在下載內容之前先檢查，避免白白下載）
+        """
+        state = self.state
+        if state == self.OPEN:
+            self._reject(state)
+
+    def _before_call(self) -> bool:
+        """回傳這次呼叫是否為半開狀態的試探請求"""
+        state = self.state
+        with self._lock:
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        self._reject(state)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._transition(self.CLOSED)
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failures += 1
+            if error is not None:
+                self._last_error = f"{type(error).__name__}: {error}"[:300]
+            if self._state == self.HALF_OPEN or self._failures >= self._threshold:
+                self._transition(self.OPEN)
+                # 重新計算冷卻時間
+                self._opened_at = time.monotonic()
+
+    def probe_succeeded(self):
+        """背景健康檢查成功：開啟中的斷路器提前進入半開"""
+        with self._lock:
+            if self._state == self.OPEN:
+                self._transition(self.HALF_OPEN)
+
+    @contextmanager
+    def guard(self, ignore=()):
+        """
+        包住一次 Drive 上傳
+
+        Args:
+            ignore: 不是 Drive 造成的錯誤類型（例如讀取 LINE 內容失敗），不計為成功或失敗
+
+        Raises:
+            DriveUnavailableError: 斷路器開啟中
+        """
+        trial = self._before_call()
+        try:
+            yield
+        except ignore:
+            raise
+        except Exception as e:
+            if is_outage_error(e):
+                self.record_failure(e)
+            else:
+                self.record_success()
+            raise
+        else:
+            self.record_success()
+        finally:
+            if trial:
+                with self._lock:
+                    self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self._threshold,
+                "recovery_seconds": self._recovery,
+                "open_for_seconds": round(time.monotonic() - self._opened_at, 1) if state != self.CLOSED else 0,
+                "rejected": self._rejected,
+                "last_error": self._last_error,
+            }
+
+
+class DriveHealthProber:
+    """
+    在背景定期檢查 Drive，快取最近一次結果
+
+    /diag/drive 直接回傳快取，不會在 event loop 中同步呼叫 Drive。
+    檢查結果也回饋給斷路器：故障時計入失敗，斷路器開啟時檢查成功則提前半開。
+    """
+
+    def __init__(self, probe, interval: float, breaker: CircuitBreaker):
+        """
+        Args:
+            probe: 執行檢查的函式，回傳結果字典；reachable 為 False 代表 Drive 故障
+            interval: 檢查間隔秒數
+            breaker: 要回饋的 CircuitBreaker
+        """
+        self._probe = probe
+        self._interval = interval
+        self._breaker = breaker
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._result = None
+
+    def run_once(self) -> dict:
+        """立即檢查一次並更新快取"""
+        started = time.monotonic()
+        try:
+            info = self._probe()
+        except Exception as e:
+            info = {"error": f"{e}", "reachable": not is_outage_error(e)}
+        elapsed = time.monotonic() - started
+        DRIVE_PROBE_SECONDS.set(elapsed)
+        healthy = "error" not in info
+        if healthy:
+            self._breaker.probe_succeeded()
+        else:
+            DRIVE_PROBE_FAILURES.inc()
+            if not info.get("reachable", True):
+                self._breaker.record_failure()
+        result = {
+            **info,
+            "healthy": healthy,
+            "checked_at": time.time(),
+            "probe_ms": round(elapsed * 1000, 1),
+        }
+        with self._lock:
+            self._result = result
+        return result
+
+    def _loop(self, run_immediately):
+        if not run_immediately and self._stop.wait(self._interval):
+            return
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f"⚠️ Drive 健康檢查失敗: {str(e)}")
+            if self._stop.wait(self._interval):
+                return
+
+    def start(self, run_immediately: bool = True):
+        """
+        啟動背景檢查
+
+        Args:
+            run_immediately: 是否立即檢查一次（會順便建立 Drive client 並完成 Shared Drive 偵測）
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, args=(run_immediately,), name="drive-health",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            # 檢查中的 Drive 請求可能要等重試，不無限期等待
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def latest(self) -> dict:
+        """最近一次檢查結果（尚未檢查時為 None）"""
+        with self._lock:
+            if self._result is None:
+                return None
+            return {**self._result, "age_seconds": round(time.time() - self._result["checked_at"], 1)}
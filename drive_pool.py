@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import google_auth_httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DRIVE_CONNECTIONS_IN_USE = REGISTRY.gauge(
+    "line_uploader_drive_connections_in_use", "借出中的 Drive HTTP 連線數")
+DRIVE_CONNECTION_WAIT_SECONDS = REGISTRY.counter(
+    "line_uploader_drive_connection_wait_seconds_total", "等待可用 Drive HTTP 連線的秒數")
+
+
+class DrivePoolTimeoutError(Exception):
+    """等待可用 Drive 連線逾時（連線池被占滿）"""
+
+
+class DriveHttpPool:
+    """
+    Drive API 的 HTTP 連線池
+
+    httplib2.Http 不是執行緒安全的，多個 worker 共用同一個連線會讀到彼此的回應。
+    連線池裡每條連線各有自己的 httplib2.Http（保留 keep-alive），但共用同一份憑證，
+    access token 過期時只由一個執行緒刷新。連線用完就放回池中，不夠時等待，
+    等待超過 checkout_timeout 秒則丟出 DrivePoolTimeoutError，而不是無限期卡住。
+    """
+
+    def __init__(self, size: int, credentials_provider, checkout_timeout: float = None):
+        """
+        Args:
+            size: 連線數上限（同時進行的 Drive 請求數）
+            credentials_provider: 回傳共用憑證的函式（第一次借連線時才呼叫）
+            checkout_timeout: 等待可用連線的秒數上限（None 或 0 代表不限制）
+        """
+        self._size = max(1, size)
+        self._checkout_timeout = checkout_timeout or None
+        self._timeouts = 0
+        self._credentials_provider = credentials_provider
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._refreshes = 0
+        self._available = threading.Condition()
+        self._refresh_lock = threading.Lock()
+
+    def _new_connection(self):
+        logger.debug("🔌 建立新的 Drive 連線（目前 %d 條）", self._created)
+        return google_auth_httplib2.AuthorizedHttp(self._credentials_provider(), http=build_http())
+
+    def _ensure_fresh_credentials(self, connection):
+        # AuthorizedHttp 會在每個請求前自行刷新過期的憑證；先在這裡加鎖刷新，
+        # 避免多條連線同時發現過期而各自換發 token
+        credentials = connection.credentials
+        if credentials.valid:
+            return
+        with self._refresh_lock:
+            if not credentials.valid:
+                credentials.refresh(google_auth_httplib2.Request(connection.http))
+                self._refreshes += 1
+
+    def _checkout(self):
+        started = None
+        with self._available:
+            while not self._idle and self._created >= self._size:
+                if started is None:
+                    started = time.monotonic()
+                    self._waits += 1
+                remaining = None
+                if self._checkout_timeout is not None:
+                    remaining = self._checkout_timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        self._wait_seconds += time.monotonic() - started
+                        DRIVE_CONNECTION_WAIT_SECONDS.inc(time.monotonic() - started)
+                        raise DrivePoolTimeoutError(
+                            f"等待 Drive 連線超過 {self._checkout_timeout:g} 秒（{self._in_use}/{self._size} 條使用中）")
+                self._available.wait(remaining)
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._created += 1
+            self._in_use += 1
+            if started is not None:
+                self._wait_seconds += time.monotonic() - started
+        if started is not None:
+            DRIVE_CONNECTION_WAIT_SECONDS.inc(time.monotonic() - started)
+        if connection is None:
+            try:
+                connection = self._new_connection()
+            except Exception:
+                self._release(None)
+                raise
+        DRIVE_CONNECTIONS_IN_USE.inc()
+        return connection
+
+    def _release(self, connection):
+        with self._available:
+            self._in_use -= 1
+            if connection is None:
+                self._created -= 1
+            else:
+                self._idle.append(connection)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        """借出一條已授權的連線（google_auth_httplib2.AuthorizedHttp）"""
+        connection = self._checkout()
+        try:
+            self._ensure_fresh_credentials(connection)
+            yield connection
+        except HttpError:
+            # API 回傳錯誤時回應已完整讀取，連線仍可重用
+            DRIVE_CONNECTIONS_IN_USE.dec()
+            self._release(connection)
+            raise
+        except BaseException:
+            # 連線層級的錯誤可能讓連線停在讀到一半的回應上，丟棄不再重用
+            DRIVE_CONNECTIONS_IN_USE.dec()
+            self._release(None)
+            raise
+        DRIVE_CONNECTIONS_IN_USE.dec()
+        self._release(connection)
+
+    def stats(self) -> dict:
+        """連線池狀態"""
+        with self._available:
+            return {
+                "size": self._size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waits": self._waits,
+                "wait_timeouts": self._timeouts,
+                "wait_seconds": round(self._wait_seconds, 3),
+                "credential_refreshes": self._refreshes,
+            }
@@ -0,0 +1,220 @@
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import httplib2
+from googleapiclient.errors import HttpError
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DRIVE_REQUESTS = REGISTRY.counter("line_uploader_drive_requests_total", "送出的 Drive API 請求數")
+DRIVE_RETRIES = REGISTRY.counter("line_uploader_drive_retries_total", "Drive API 請求重試次數")
+DRIVE_THROTTLED_SECONDS = REGISTRY.counter(
+    "line_uploader_drive_throttled_seconds_total", "因 token bucket 節流而等待的秒數")
+
+# 可重試的 HTTP 狀態碼
+RETRYABLE_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+# 403 中屬於速率限制（稍後重試即可）的原因；配額用盡等其他 403 不重試
+RETRYABLE_403_REASONS = {"userRateLimitExceeded", "rateLimitExceeded", "backendError"}
+# 代表目前帳號的配額已用完、應改用其他 Service Account 的錯誤原因
+QUOTA_403_REASONS = {
+    "userRateLimitExceeded", "rateLimitExceeded", "dailyLimitExceeded", "quotaExceeded", "storageQuotaExceeded",
+}
+# 其中要等到配額重置（通常是隔天）才會恢復的原因
+DAILY_QUOTA_REASONS = {"dailyLimitExceeded", "quotaExceeded", "storageQuotaExceeded"}
+
+
+def _error_reason(error: HttpError):
+    """取出 Drive API 錯誤的 reason 欄位"""
+    try:
+        details = json.loads(error.content.decode("utf-8"))["error"]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    errors = details.get("errors") or []
+    if errors:
+        return errors[0].get("reason")
+    return details.get("status")
+
+
+def is_retryable_error(error) -> bool:
+    """判斷 Drive 請求錯誤是否可重試（速率限制、伺服器錯誤、連線問題）"""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 403:
+            return _error_reason(error) in RETRYABLE_403_REASONS
+        return status in RETRYABLE_HTTP_STATUSES
+    return isinstance(error, (ConnectionError, socket.timeout, TimeoutError))
+
+
+def is_outage_error(error) -> bool:
+    """是否為 Drive 本身故障（5xx、連線失敗、逾時），而不是請求內容或配額的問題"""
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500
+    return isinstance(error, (ConnectionError, socket.timeout, socket.gaierror, TimeoutError,
+                              httplib2.ServerNotFoundError))
+
+
+def quota_error_reason(error):
+    """帳號配額錯誤的原因（429 回傳 rateLimitExceeded）；不是配額錯誤時回傳 None"""
+    if not isinstance(error, HttpError):
+        return None
+    if error.resp.status == 429:
+        return "rateLimitExceeded"
+    if error.resp.status == 403:
+        reason = _error_reason(error)
+        if reason in QUOTA_403_REASONS:
+            return reason
+    return None
+
+
+def retry_after_seconds(error):
+    """HttpError 回應中的 Retry-After（秒），沒有時回傳 None"""
+    if not isinstance(error, HttpError):
+        return None
+    value = error.resp.get("retry-after")
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """執行緒安全的 token bucket，用來平滑送往 Drive 的請求速率"""
+
+    def __init__(self, rate_per_second: float, capacity: int):
+        self._rate = rate_per_second
+        self._capacity = max(1, capacity)
+        self._tokens = float(self._capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        取得一個 token，不足時等待
+
+        Returns:
+            等待的秒數
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+            waited += delay
+
+
+class DriveRequestScheduler:
+    """
+    所有 Drive API 請求共用的排程器
+
+    以 token bucket 限制每分鐘請求數，遇到可重試的錯誤時以帶 jitter 的
+    指數退避重試，並遵守伺服器回傳的 Retry-After。
+    """
+
+    def __init__(self, requests_per_minute: int, burst: int, max_retries: int, max_backoff: float,
+                 http_pool=None):
+        """
+        Args:
+            requests_per_minute: 每分鐘請求數上限
+            burst: 允許的瞬間請求數
+            max_retries: 單一請求的重試次數上限
+            max_backoff: 退避等待秒數上限
+            http_pool: DriveHttpPool；設定時每次嘗試都借用池中的連線執行
+        """
+        self._http_pool = http_pool
+        self._bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self._max_retries = max_retries
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled_seconds": 0.0,
+            "rate_limited": 0,
+            "failures": 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def acquire(self):
+        """送出一個請求前取得額度（分塊上傳的每個區塊也算一個請求）"""
+        waited = self._bucket.acquire()
+        self._count("requests")
+        DRIVE_REQUESTS.inc()
+        if waited:
+            self._count("throttled_seconds", waited)
+            DRIVE_THROTTLED_SECONDS.inc(waited)
+
+    def backoff_delay(self, attempt: int, error=None) -> float:
+        """第 attempt 次重試前的等待秒數；有 Retry-After 時以它為準"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self._max_backoff) + random.random()
+        return random.uniform(0, min(self._max_backoff, 2 ** attempt))
+
+    def should_retry(self, attempt: int, error, max_retries: int = None, fail_over=None) -> bool:
+        """
+        是否應該重試；同時記錄速率限制次數
+
+        Args:
+            fail_over: 回傳是否能改用其他 Service Account 的函式；可以時配額錯誤不在這個帳號上重試
+        """
+        if max_retries is None:
+            max_retries = self._max_retries
+        if isinstance(error, HttpError) and error.resp.status in (403, 429) and is_retryable_error(error):
+            self._count("rate_limited")
+        if quota_error_reason(error) is not None and fail_over is not None and fail_over():
+            self._count("failures")
+            return False
+        if attempt >= max_retries or not is_retryable_error(error):
+            self._count("failures")
+            return False
+        self._count("retries")
+        DRIVE_RETRIES.inc()
+        return True
+
+    def execute(self, request, description: str = "Drive 請求", fail_over=None):
+        """
+        執行 googleapiclient 的 HttpRequest
+
+        Args:
+            request: files().list(...) 等尚未執行的請求
+            description: 記錄用的說明
+            fail_over: 見 should_retry()
+
+        Returns:
+            request.execute() 的結果
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                if self._http_pool is None:
+                    return request.execute()
+                with self._http_pool.connection() as http:
+                    return request.execute(http=http)
+            except Exception as e:
+                if not self.should_retry(attempt, e, fail_over=fail_over):
+                    raise
+                attempt += 1
+                delay = self.backoff_delay(attempt, e)
+                logger.warning(f"   ⏳ {description}失敗（{type(e).__name__}），{delay:.1f} 秒後重試（第 {attempt} 次）")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        """請求數、重試數與節流等待時間"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["throttled_seconds"] = round(stats["throttled_seconds"], 3)
+        return stats
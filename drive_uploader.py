@@ -1,104 +1,251 @@
 import os
 import json
+import logging
+import threading
+import time
 from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from config import GOOGLE_SERVICE_ACCOUNT_JSON, SHARED_DRIVE_ID, UPLOAD_FOLDER_NAME
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaUpload
+from drive_accounts import DriveAccount, DriveAccountPool
+from drive_health import CircuitBreaker, DriveHealthProber
+from folder_index import FolderIndex
+from drive_scheduler import quota_error_reason, is_outage_error
+from metrics import REGISTRY, stage_timer, UPLOADED_BYTES
+from tracing import span
+from config import (
+    GOOGLE_SERVICE_ACCOUNT_JSON, SHARED_DRIVE_ID, UPLOAD_FOLDER_NAME, FOLDER_CACHE_TTL,
+    RESUMABLE_UPLOAD_THRESHOLD, UPLOAD_CHUNK_SIZE, UPLOAD_CHUNK_RETRIES,
+    DRIVE_PROBE_CACHE_FILE, DRIVE_PROBE_CACHE_TTL, DRIVE_PROBE_RETRY_SECONDS,
+    DRIVE_REQUESTS_PER_MINUTE, DRIVE_REQUEST_BURST, DRIVE_MAX_RETRIES, DRIVE_MAX_BACKOFF, DRIVE_API_ENDPOINT,
+    DRIVE_CLIENT_POOL_SIZE, DRIVE_CONNECTION_TIMEOUT, DRIVE_ACCOUNT_STRATEGY, DRIVE_ACCOUNT_COOLDOWN_SECONDS,
+    DRIVE_ACCOUNT_MAX_COOLDOWN_SECONDS, DRIVE_ACCOUNT_DAILY_UPLOAD_BYTES,
+    DRIVE_BREAKER_FAILURE_THRESHOLD, DRIVE_BREAKER_RECOVERY_SECONDS, DRIVE_HEALTH_PROBE_INTERVAL,
+)
+import hashlib
 import mimetypes
 
-# 檢查 GOOGLE_SERVICE_ACCOUNT_JSON 是檔案路徑還是 JSON 字串
-if os.path.exists(GOOGLE_SERVICE_ACCOUNT_JSON):
-    # 如果是檔案路徑
-    credentials = service_account.Credentials.from_service_account_file(
-        GOOGLE_SERVICE_ACCOUNT_JSON,
-        scopes=["https://www.googleapis.com/auth/drive"]
-    )
-else:
-    # 如果是 JSON 字串
-    credentials_info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-    credentials = service_account.Credentials.from_service_account_info(
-        credentials_info,
-        scopes=["https://www.googleapis.com/auth/drive"]
-    )
+logger = logging.getLogger(__name__)
 
-# 嘗試刷新憑證
-try:
-    credentials.refresh(Request())
-    print("✅ Google 憑證已刷新")
-except Exception as e:
-    print(f"⚠️ 憑證刷新失敗: {str(e)}")
-
-drive_service = build('drive', 'v3', credentials=credentials)
-
-# Shared Drive 偵測和驗證
-shared_drive_id = None
-try:
-    if SHARED_DRIVE_ID:
-        # 明確指定用這顆 Shared Drive
-        print(f"🔒 使用指定的 Shared Drive: {SHARED_DRIVE_ID}")
-        # 驗證是否可存取（測試寫入權限）
-        try:
-            # 先測試讀取權限
-            drive_info = drive_service.drives().get(driveId=SHARED_DRIVE_ID).execute()
-            print(f"✅ 指定 Shared Drive 可讀取: {drive_info.get('name')}")
-            
-            # 再測試寫入權限（嘗試建立測試資料夾）
-            test_folder_metadata = {
-                'name': 'TEST_WRITE_PERMISSION',
-                'mimeType': 'application/vnd.google-apps.folder',
-                'parents': [SHARED_DRIVE_ID]
-            }
-            test_folder = drive_service.files().create(
-                body=test_folder_metadata, 
-                fields='id',
-                supportsAllDrives=True
-            ).execute()
-            test_folder_id = test_folder.get('id')
-            
-            # 立即刪除測試資料夾
-            drive_service.files().delete(fileId=test_folder_id, supportsAllDrives=True).execute()
-            
-            print("✅ 指定 Shared Drive 可寫入")
-            shared_drive_id = SHARED_DRIVE_ID
-        except Exception as write_error:
-            print(f"❌ Shared Drive 寫入權限不足: {write_error}")
-            print("⚠️ 將改用個人 Google Drive（可能因配額限制失敗）")
-    else:
-        print("🔎 自動搜尋 Shared Drives...")
-        drives = drive_service.drives().list(pageSize=10).execute().get('drives', [])
-        if drives:
-            # 測試第一個 Shared Drive 的寫入權限
-            test_drive_id = drives[0]['id']
+SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+# Shared Drive 偵測結果在第一次使用時才初始化
+_shared_drive_id = None
+_shared_drive_resolved_at = None
+_probe_lock = threading.Lock()
+
+# 冷啟動成本（毫秒），由 /diag/startup 回報
+DRIVE_INIT_STATS = {
+    "credentials_ms": None,
+    "client_build_ms": None,
+    "probe_ms": None,
+    "probe_source": None,
+}
+
+def _read_json_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _load_service_account_infos():
+    """
+    讀取所有 Service Account 的憑證內容
+
+    GOOGLE_SERVICE_ACCOUNT_JSON 可以是：JSON 檔案路徑、放多個 JSON 檔的目錄、JSON 字串，
+    或多個帳號組成的 JSON 陣列（元素可以是憑證內容或檔案路徑）。
+    """
+    value = GOOGLE_SERVICE_ACCOUNT_JSON
+    if os.path.isdir(value):
+        # 目錄中的每個 .json 檔是一個帳號
+        return [_read_json_file(os.path.join(value, name)) for name in sorted(os.listdir(value))
+                if name.endswith('.json')]
+    # 檢查是檔案路徑還是 JSON 字串
+    parsed = _read_json_file(value) if os.path.exists(value) else json.loads(value)
+    entries = parsed if isinstance(parsed, list) else [parsed]
+    return [_read_json_file(entry) if isinstance(entry, str) else entry for entry in entries]
+
+def _build_accounts():
+    accounts = []
+    for index, info in enumerate(_load_service_account_infos()):
+        name = info.get('client_email') or f"account-{index}"
+        if any(account.name == name for account in accounts):
+            name = f"{name}#{index}"
+        accounts.append(DriveAccount(
+            name,
+            # 預設參數綁定這個帳號的憑證內容
+            lambda info=info: service_account.Credentials.from_service_account_info(info, scopes=SCOPES),
+            _build_service,
+            DRIVE_CLIENT_POOL_SIZE, DRIVE_REQUESTS_PER_MINUTE, DRIVE_REQUEST_BURST,
+            DRIVE_MAX_RETRIES, DRIVE_MAX_BACKOFF, DRIVE_ACCOUNT_DAILY_UPLOAD_BYTES, DRIVE_CONNECTION_TIMEOUT,
+        ))
+    return accounts
+
+def _build_service(credentials):
+    """建立 Drive client；設定 DRIVE_API_ENDPOINT 時 API 與上傳路徑都改用該 root URL"""
+    if not DRIVE_API_ENDPOINT:
+        return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+    # client_options 的 api_endpoint 不會改到上傳路徑的 scheme，所以直接改 discovery 文件
+    document = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+    document['rootUrl'] = DRIVE_API_ENDPOINT
+    document['baseUrl'] = DRIVE_API_ENDPOINT + document['servicePath']
+    return build_from_document(document, credentials=credentials)
+
+# 每個 Service Account 各自的 client、連線池與速率限制；上傳時由 account_pool 挑選帳號
+account_pool = DriveAccountPool(
+    _build_accounts(), DRIVE_ACCOUNT_STRATEGY, DRIVE_ACCOUNT_COOLDOWN_SECONDS, DRIVE_ACCOUNT_MAX_COOLDOWN_SECONDS,
+)
+
+# 資料夾查詢、Shared Drive 偵測等非上傳請求都使用第一個帳號
+scheduler = account_pool.primary.scheduler
+http_pool = account_pool.primary.http_pool
+
+# Drive 故障時上傳直接失敗，不必每個上傳都等到逾時
+breaker = CircuitBreaker(DRIVE_BREAKER_FAILURE_THRESHOLD, DRIVE_BREAKER_RECOVERY_SECONDS)
+REGISTRY.gauge("line_uploader_drive_circuit_state", "Drive 斷路器狀態（0 關閉、1 半開、2 開啟）",
+               callback=breaker.state_code)
+
+def get_drive_service():
+    """
+    取得第一個帳號的 Drive client（第一次呼叫時建立；憑證會在第一個請求時自動刷新）
+
+    client 只用來組出請求，實際送出時由 scheduler 從 http_pool 借用連線，
+    因此可以在多個執行緒間共用。
+    """
+    service = account_pool.primary.service()
+    if DRIVE_INIT_STATS["client_build_ms"] is None:
+        DRIVE_INIT_STATS.update(account_pool.primary.init_stats)
+    return service
+
+def _probe_write_access(drive_id):
+    """在 Shared Drive 建立並刪除測試資料夾，確認有寫入權限"""
+    service = get_drive_service()
+    test_folder_metadata = {
+        'name': 'TEST_WRITE_PERMISSION',
+        'mimeType': 'application/vnd.google-apps.folder',
+        'parents': [drive_id]
+    }
+    test_folder = scheduler.execute(service.files().create(
+        body=test_folder_metadata, 
+        fields='id',
+        supportsAllDrives=True
+    ), "建立測試資料夾")
+    test_folder_id = test_folder.get('id')
+    
+    # 立即刪除測試資料夾
+    scheduler.execute(service.files().delete(fileId=test_folder_id, supportsAllDrives=True), "刪除測試資料夾")
+
+def _probe_shared_drive():
+    """偵測並驗證可寫入的 Shared Drive；找不到時回傳 None"""
+    service = get_drive_service()
+    try:
+        if SHARED_DRIVE_ID:
+            # 明確指定用這顆 Shared Drive
+            logger.info(f"🔒 使用指定的 Shared Drive: {SHARED_DRIVE_ID}")
+            # 驗證是否可存取（測試寫入權限）
             try:
-                test_folder_metadata = {
-                    'name': 'TEST_WRITE_PERMISSION',
-                    'mimeType': 'application/vnd.google-apps.folder',
-                    'parents': [test_drive_id]
-                }
-                test_folder = drive_service.files().create(
-                    body=test_folder_metadata, 
-                    fields='id',
-                    supportsAllDrives=True
-                ).execute()
-                test_folder_id = test_folder.get('id')
+                # 先測試讀取權限
+                drive_info = scheduler.execute(service.drives().get(driveId=SHARED_DRIVE_ID), "讀取 Shared Drive")
+                logger.info(f"✅ 指定 Shared Drive 可讀取: {drive_info.get('name')}")
                 
-                # 立即刪除測試資料夾
-                drive_service.files().delete(fileId=test_folder_id, supportsAllDrives=True).execute()
-                
-                shared_drive_id = test_drive_id
-                print(f"✅ 偵測到可寫入的 Shared Drive：{drives[0]['name']} (ID: {shared_drive_id})")
+                # 再測試寫入權限（嘗試建立測試資料夾）
+                _probe_write_access(SHARED_DRIVE_ID)
+                logger.info("✅ 指定 Shared Drive 可寫入")
+                return SHARED_DRIVE_ID
             except Exception as write_error:
-                print(f"❌ 偵測到的 Shared Drive 寫入權限不足: {write_error}")
-                print("⚠️ 將改用個人 Google Drive（可能因配額限制失敗）")
+                logger.error(f"❌ Shared Drive 寫入權限不足: {write_error}")
+                logger.warning("⚠️ 將改用個人 Google Drive（可能因配額限制失敗）")
+        else:
+            logger.info("🔎 自動搜尋 Shared Drives...")
+            drives = scheduler.execute(service.drives().list(pageSize=10), "列出 Shared Drives").get('drives', [])
+            if drives:
+                # 測試第一個 Shared Drive 的寫入權限
+                test_drive_id = drives[0]['id']
+                try:
+                    _probe_write_access(test_drive_id)
+                    logger.info(f"✅ 偵測到可寫入的 Shared Drive：{drives[0]['name']} (ID: {test_drive_id})")
+                    return test_drive_id
+                except Exception as write_error:
+                    logger.error(f"❌ 偵測到的 Shared Drive 寫入權限不足: {write_error}")
+                    logger.warning("⚠️ 將改用個人 Google Drive（可能因配額限制失敗）")
+            else:
+                logger.warning("⚠️ 未偵測到可用 Shared Drive，將使用個人雲端（Service Account 沒配額，可能失敗）")
+    except Exception as e:
+        logger.error(f"🚨 Shared Drive 驗證失敗（權限或網域政策問題）：{e}")
+    return None
+
+def _probe_cache_key():
+    """偵測結果只對同一組設定有效（帳號或指定的 Shared Drive 改變就重新偵測）"""
+    return {
+        "service_account": account_pool.primary.name,
+        "configured_shared_drive_id": SHARED_DRIVE_ID,
+    }
+
+def _read_probe_cache():
+    """讀取未過期的偵測結果快取；沒有可用快取時回傳 None"""
+    try:
+        with open(DRIVE_PROBE_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("expires_at", 0) < time.time() or cached.get("key") != _probe_cache_key():
+        return None
+    return cached
+
+def _write_probe_cache(drive_id):
+    """把偵測結果寫入快取檔（只快取成功的結果）"""
+    if not drive_id or DRIVE_PROBE_CACHE_TTL <= 0:
+        return
+    payload = {
+        "key": _probe_cache_key(),
+        "shared_drive_id": drive_id,
+        "expires_at": time.time() + DRIVE_PROBE_CACHE_TTL,
+    }
+    tmp_path = f"{DRIVE_PROBE_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, DRIVE_PROBE_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"⚠️ 無法寫入 Shared Drive 偵測快取: {str(e)}")
+
+def _should_reprobe():
+    """沒找到可用的 Shared Drive 時（可能只是暫時連不上），隔一段時間再偵測一次"""
+    return _shared_drive_id is None and time.monotonic() - _shared_drive_resolved_at > DRIVE_PROBE_RETRY_SECONDS
+
+def get_shared_drive_id():
+    """取得已驗證可寫入的 Shared Drive ID（第一次呼叫時偵測，結果會快取到檔案）"""
+    global _shared_drive_id, _shared_drive_resolved_at
+    if _shared_drive_resolved_at is not None and not _should_reprobe():
+        return _shared_drive_id
+    with _probe_lock:
+        if _shared_drive_resolved_at is not None and not _should_reprobe():
+            return _shared_drive_id
+        get_drive_service()
+        started = time.monotonic()
+        cached = _read_probe_cache()
+        if cached:
+            drive_id = cached["shared_drive_id"]
+            DRIVE_INIT_STATS["probe_source"] = "cache"
+            logger.info(f"✅ 使用快取的 Shared Drive 偵測結果: {drive_id}")
         else:
-            print("⚠️ 未偵測到可用 Shared Drive，將使用個人雲端（Service Account 沒配額，可能失敗）")
-except Exception as e:
-    print(f"🚨 Shared Drive 驗證失敗（權限或網域政策問題）：{e}")
+            drive_id = _probe_shared_drive()
+            DRIVE_INIT_STATS["probe_source"] = "network"
+            _write_probe_cache(drive_id)
+        DRIVE_INIT_STATS["probe_ms"] = round((time.monotonic() - started) * 1000, 1)
+        _shared_drive_id = drive_id
+        _shared_drive_resolved_at = time.monotonic()
+    return _shared_drive_id
+
+def warm_up():
+    """預先建立 client 並完成 Shared Drive 偵測（供背景執行緒在啟動後呼叫）"""
+    try:
+        get_shared_drive_id()
+    except Exception as e:
+        logger.warning(f"⚠️ Drive 預熱失敗: {str(e)}")
 
 def create_folder(folder_name, parent_folder_id=None):
     """建立 Google Drive 資料夾"""
-    print(f"📁 建立資料夾: {folder_name}")
+    logger.info(f"📁 建立資料夾: {folder_name}")
     
     file_metadata = {
         'name': folder_name,
@@ -108,24 +255,24 @@ def create_folder(folder_name, parent_folder_id=None):
     # 如果有指定父資料夾，則加入
     if parent_folder_id:
         file_metadata['parents'] = [parent_folder_id]
-        print(f"   父資料夾 ID: {parent_folder_id}")
+        logger.debug(f"   父資料夾 ID: {parent_folder_id}")
     
     try:
-        folder = drive_service.files().create(
+        folder = scheduler.execute(get_drive_service().files().create(
             body=file_metadata, 
             fields='id',
             supportsAllDrives=True
-        ).execute()
+        ), "建立資料夾")
         folder_id = folder.get('id')
-        print(f"   ✅ 資料夾建立成功，ID: {folder_id}")
+        logger.debug(f"   ✅ 資料夾建立成功，ID: {folder_id}")
         return folder_id
     except Exception as e:
-        print(f"   🚨 建立資料夾失敗: {str(e)}")
+        logger.error(f"   🚨 建立資料夾失敗: {str(e)}")
         raise e
 
 def find_or_create_folder(folder_name, parent_folder_id=None):
     """尋找資料夾，如果不存在則建立"""
-    print(f"🔍 尋找資料夾: {folder_name}")
+    logger.info(f"🔍 尋找資料夾: {folder_name}")
     
     # 搜尋現有資料夾
     query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
@@ -133,49 +280,155 @@ def find_or_create_folder(folder_name, parent_folder_id=None):
         query += f" and '{parent_folder_id}' in parents"
     
     try:
-        results = drive_service.files().list(
+        results = scheduler.execute(get_drive_service().files().list(
             q=query, 
             fields="files(id, name)",
             includeItemsFromAllDrives=True,
             supportsAllDrives=True
-        ).execute()
+        ), "搜尋資料夾")
         files = results.get('files', [])
         
         if files:
             folder_id = files[0]['id']
-            print(f"   ✅ 找到現有資料夾，ID: {folder_id}")
+            logger.debug(f"   ✅ 找到現有資料夾，ID: {folder_id}")
             return folder_id
         else:
-            print(f"   📁 資料夾不存在，建立新資料夾")
+            logger.debug(f"   📁 資料夾不存在，建立新資料夾")
             return create_folder(folder_name, parent_folder_id)
     except Exception as e:
-        print(f"   ⚠️ 搜尋資料夾失敗: {str(e)}")
-        print(f"   📁 直接建立新資料夾")
+        logger.warning(f"   ⚠️ 搜尋資料夾失敗: {str(e)}")
+        logger.debug(f"   📁 直接建立新資料夾")
         return create_folder(folder_name, parent_folder_id)
 
+# 資料夾 ID 快取：(parent_folder_id, folder_name) -> (folder_id, 到期時間)
+_folder_cache = {}
+_folder_cache_lock = threading.Lock()
+# 每個 key 一把鎖，讓同時 miss 的請求共用同一次搜尋／建立（single-flight）
+_folder_key_locks = {}
+
+def _folder_key_lock(key):
+    with _folder_cache_lock:
+        return _folder_key_locks.setdefault(key, threading.Lock())
+
+def drive_file_exists(file_id):
+    """確認檔案或資料夾仍存在且未被丟進垃圾桶"""
+    try:
+        file = scheduler.execute(get_drive_service().files().get(
+            fileId=file_id,
+            fields='id, trashed',
+            supportsAllDrives=True
+        ), "讀取檔案狀態")
+        return not file.get('trashed', False)
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+
+def invalidate_folder_cache(folder_name=None, parent_folder_id=None):
+    """清除資料夾快取；不帶參數時清除全部"""
+    with _folder_cache_lock:
+        if folder_name is None:
+            _folder_cache.clear()
+        else:
+            _folder_cache.pop((parent_folder_id, folder_name), None)
+
+def _list_all_folders():
+    """以分頁列出所有資料夾（Shared Drive 內或 Service Account 可見的），給資料夾索引載入用"""
+    shared_drive_id = get_shared_drive_id()
+    params = {}
+    if shared_drive_id:
+        params = {'corpora': 'drive', 'driveId': shared_drive_id}
+    page_token = None
+    while True:
+        result = scheduler.execute(get_drive_service().files().list(
+            q="mimeType='application/vnd.google-apps.folder' and trashed=false",
+            fields="nextPageToken, files(id, name, parents, mimeType)",
+            pageSize=1000,
+            pageToken=page_token,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            **params
+        ), "列出資料夾")
+        for folder in result.get('files', []):
+            if folder.get('mimeType', 'application/vnd.google-apps.folder') == 'application/vnd.google-apps.folder':
+                yield folder
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+# 上傳資料夾底下分區資料夾（FOLDER_LAYOUT）的索引
+folder_index = FolderIndex(_list_all_folders, find_or_create_folder)
+
+def preload_folder_index():
+    """預先載入資料夾索引（供背景執行緒在啟動後呼叫）"""
+    try:
+        _, upload_folder_id = _resolve_upload_folder()
+        folder_index.ensure_loaded(upload_folder_id)
+    except Exception as e:
+        logger.warning(f"⚠️ 資料夾索引載入失敗: {str(e)}")
+
+def get_cached_folder_id(folder_name, parent_folder_id=None):
+    """
+    取得資料夾 ID（有快取）
+
+    命中快取時不需任何 API 呼叫；快取過期時先確認資料夾仍可用再續期，
+    否則重新搜尋或建立。同一個資料夾同時只會有一個請求去搜尋／建立。
+    """
+    key = (parent_folder_id, folder_name)
+    with _folder_cache_lock:
+        cached = _folder_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    with _folder_key_lock(key):
+        # 等鎖期間可能已被其他請求填入
+        with _folder_cache_lock:
+            cached = _folder_cache.get(key)
+        now = time.monotonic()
+        if cached and cached[1] > now:
+            return cached[0]
+
+        folder_id = None
+        if cached:
+            try:
+                if drive_file_exists(cached[0]):
+                    folder_id = cached[0]
+                else:
+                    logger.info(f"   🗑️ 快取的資料夾已刪除或在垃圾桶中: {cached[0]}")
+            except Exception as e:
+                logger.warning(f"   ⚠️ 無法確認資料夾狀態，沿用快取: {str(e)}")
+                folder_id = cached[0]
+        if folder_id is None:
+            folder_id = find_or_create_folder(folder_name, parent_folder_id)
+
+        with _folder_cache_lock:
+            _folder_cache[key] = (folder_id, time.monotonic() + FOLDER_CACHE_TTL)
+        return folder_id
+
 def get_shared_drives():
     """取得可用的 Shared Drives"""
-    print("🔍 搜尋可用的 Shared Drives...")
+    logger.info("🔍 搜尋可用的 Shared Drives...")
     try:
-        drives = drive_service.drives().list(fields="drives(id, name)").execute()
+        drives = scheduler.execute(get_drive_service().drives().list(fields="drives(id, name)"), "列出 Shared Drives")
         shared_drives = drives.get('drives', [])
-        print(f"   ✅ 找到 {len(shared_drives)} 個 Shared Drives")
+        logger.debug(f"   ✅ 找到 {len(shared_drives)} 個 Shared Drives")
         for drive in shared_drives:
-            print(f"      - {drive['name']} (ID: {drive['id']})")
+            logger.debug(f"      - {drive['name']} (ID: {drive['id']})")
         return shared_drives
     except Exception as e:
-        print(f"   ⚠️ 無法取得 Shared Drives: {str(e)}")
+        logger.warning(f"   ⚠️ 無法取得 Shared Drives: {str(e)}")
         return []
 
 def drive_diagnostics():
     """診斷 Shared Drive 存取狀態"""
+    shared_drive_id = get_shared_drive_id()
     info = {"shared_drive_id": shared_drive_id}
     try:
         if shared_drive_id:
-            drv = drive_service.drives().get(driveId=shared_drive_id).execute()
+            drv = scheduler.execute(get_drive_service().drives().get(driveId=shared_drive_id), "讀取 Shared Drive")
             info["shared_drive_name"] = drv.get("name")
             # 試著列第一層項目
-            children = drive_service.files().list(
+            children = scheduler.execute(get_drive_service().files().list(
                 corpora='drive',
                 driveId=shared_drive_id,
                 includeItemsFromAllDrives=True,
@@ -183,62 +436,462 @@ def drive_diagnostics():
                 q="trashed=false",
                 pageSize=10,
                 fields="files(id,name,mimeType)"
-            ).execute().get("files", [])
+            ), "列出 Shared Drive 項目").get("files", [])
             info["visible_items"] = children
         else:
             info["note"] = "未設定或偵測到 Shared Drive（將用個人雲端，Service Account 無配額）"
     except Exception as e:
         info["error"] = f"{e}"
+        # Drive 有回應（例如權限不足）時仍視為連得上，只有故障才回饋給斷路器
+        info["reachable"] = not is_outage_error(e)
     return info
 
-def upload_file_to_drive(file_path, file_name):
-    print(f"🚀 開始上傳檔案到 Google Drive")
-    print(f"   檔案路徑: {file_path}")
-    print(f"   檔案名稱: {file_name}")
-    
+# 背景定期執行 drive_diagnostics()，/diag/drive 回傳快取的結果
+health_prober = DriveHealthProber(drive_diagnostics, DRIVE_HEALTH_PROBE_INTERVAL, breaker)
+
+def _execute_resumable(request, file_name, account, fail_over=None):
+    """
+    以 account 的連線池與速率限制逐塊執行 resumable upload
+
+    發生可重試的錯誤時依排程器的退避策略等待後重試；googleapiclient 會先向伺服器查詢
+    已確認的位移，再從該位移繼續上傳，不會從頭開始。配額錯誤且 fail_over() 為真時不重試，
+    交給 _upload_with_failover 改用其他帳號。
+
+    串流來源時先讀好下一個區塊再借連線：連線只在 HTTP 請求期間占用，讀取 LINE 內容
+    與讀到 EOF 時的查重（本身也要借連線）都不會占著連線，避免連線池被自己卡死。
+
+    Returns:
+        Drive API 回傳的檔案資訊
+    """
+    started = time.monotonic()
+    retries = 0
+    response = None
+    while response is None:
+        # 每個區塊都是一次 Drive 請求，同樣受速率限制
+        account.scheduler.acquire()
+        try:
+            if isinstance(request.resumable, StreamingMedia):
+                # 預讀到下一個區塊的結尾；next_chunk() 內不再讀取來源
+                request.resumable.prefetch()
+            with account.http_pool.connection() as http:
+                status, response = request.next_chunk(http=http)
+        except (DuplicateContentError, StreamSourceError):
+            # 內容重複或 LINE 來源讀取失敗不是 Drive 的錯誤，不重試、也不計入排程器的失敗次數
+            raise
+        except Exception as e:
+            if not account.scheduler.should_retry(retries, e, UPLOAD_CHUNK_RETRIES, fail_over):
+                raise
+            retries += 1
+            delay = account.scheduler.backoff_delay(retries, e)
+            logger.warning(f"   ⚠️ 區塊上傳失敗（{type(e).__name__}），{delay:.1f} 秒後從已確認位移續傳（第 {retries} 次）")
+            time.sleep(delay)
+            continue
+        retries = 0
+        if status:
+            elapsed = max(time.monotonic() - started, 1e-6)
+            total = status.total_size
+            percent = f"{status.progress() * 100:.0f}%" if total else "?"
+            logger.debug(f"   📶 {file_name}: {status.resumable_progress / (1024 * 1024):.1f} MB ({percent})，"
+                  f"{status.resumable_progress / (1024 * 1024) / elapsed:.2f} MB/s")
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    uploaded = request.resumable.size() or request.resumable_progress
+    logger.info(f"   ⏱️ {file_name}: {uploaded / (1024 * 1024):.2f} MB，耗時 {elapsed:.2f} 秒，"
+          f"{uploaded / (1024 * 1024) / elapsed:.2f} MB/s")
+    return response
+
+@stage_timer("drive_upload")
+def _create_file(account, fd, size, file_name, mime_type, folder_id, fail_over=None):
+    """上傳檔案到指定資料夾；超過門檻的檔案改用分塊 resumable upload"""
+    file_metadata = {
+        'name': file_name,
+        'parents': [folder_id]
+    }
+    resumable = size >= RESUMABLE_UPLOAD_THRESHOLD
+    if resumable:
+        media = MediaIoBaseUpload(fd, mimetype=mime_type, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    else:
+        media = MediaIoBaseUpload(fd, mimetype=mime_type)
+    request = account.service().files().create(
+        body=file_metadata, 
+        media_body=media, 
+        fields='id, webViewLink',
+        supportsAllDrives=True
+    )
+    if resumable:
+        return _execute_resumable(request, file_name, account, fail_over)
+    return account.scheduler.execute(request, "上傳檔案", fail_over)
+
+class DuplicateContentError(Exception):
+    """串流讀完後發現內容已上傳過"""
+
+    def __init__(self, existing):
+        super().__init__(f"內容與既有檔案相同: {existing.get('file_id')}")
+        self.existing = existing
+
+class StreamSourceError(Exception):
+    """
+    串流來源（LINE 內容）讀取失敗
+
+    不是 Drive 的錯誤，排程器不會重試、斷路器也不計入；呼叫端改用暫存檔重新下載上傳。
+    """
+
+class StreamRewindError(ValueError):
+    """要重送的位移已不在串流緩衝區中（串流無法倒回，只能從頭重新下載）"""
+
+class StreamingMedia(MediaUpload):
+    """
+    把 bytes 區塊的 iterator（例如 LINE 的 iter_content()）直接串流到 Drive
+
+    以總長度未知的 resumable upload 上傳，記憶體中只保留「伺服器尚未確認」
+    以及預讀的資料（約兩個區塊），並在讀取時即時累計大小與 SHA-256。
+
+    若有提供 find_duplicate(sha256, size)，讀到 EOF 時會先查詢是否已有相同內容；
+    小於一個區塊的檔案在送出任何資料前就會完成查詢。
+
+    來源讀取失敗後，之後每次讀取都丟出同一個 StreamSourceError，
+    不會把已失效的 iterator 當成 EOF 而完成一個被截斷的檔案。
+    """
+
+    def __init__(self, chunks, mimetype, chunksize=UPLOAD_CHUNK_SIZE, find_duplicate=None):
+        self._chunks = iter(chunks)
+        self._find_duplicate = find_duplicate
+        self._sha256 = hashlib.sha256()
+        self.duplicate_of = None
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        self._buffer_start = 0   # buffer[0] 對應的檔案位移
+        self._handed_out = 0     # 已交給 googleapiclient 的最遠位移
+        self._size = None        # 讀到 EOF 後才知道總長度
+        self._source_error = None
+        self.bytes_read = 0
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def size(self):
+        # googleapiclient 在送出區塊前後（借著連線時）都會呼叫 size()，這裡不讀取來源；
+        # 預讀由 prefetch() 在借連線之前完成
+        self._raise_source_error()
+        return self._size
+
+    def can_restart(self):
+        """是否還保有從位移 0 開始的完整資料（可重新建立上傳工作階段）"""
+        return self._buffer_start == 0 and self._handed_out == 0
+
+    def getbytes(self, begin, length):
+        self._raise_source_error()
+        if begin < self._buffer_start:
+            raise StreamRewindError(f"位移 {begin} 的資料已不在串流緩衝區中，無法重送")
+        # begin 之前的資料已由伺服器確認，可以丟棄
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._handed_out = max(self._handed_out, begin + len(data))
+        return data
+
+    def _raise_source_error(self):
+        if self._source_error is not None:
+            raise self._source_error
+
+    def _fill(self, end):
+        """從來源讀取資料，直到緩衝區涵蓋到位移 end 或讀到 EOF"""
+        self._raise_source_error()
+        while self._size is None and self._buffer_start + len(self._buffer) < end:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._size = self.bytes_read
+                self._check_duplicate()
+                break
+            except Exception as e:
+                # 產生器丟出例外後就結束了，重試時 next() 會得到 StopIteration；保存錯誤，不當成 EOF
+                self._source_error = StreamSourceError(f"讀取串流來源失敗（{type(e).__name__}: {e}）")
+                self._source_error.__cause__ = e
+                raise self._source_error
+            if chunk:
+                self._buffer.extend(chunk)
+                self._sha256.update(chunk)
+                self.bytes_read += len(chunk)
+
+    @property
+    def sha256(self):
+        """內容的 SHA-256（讀完後才是完整內容的雜湊）"""
+        return self._sha256.hexdigest()
+
+    def prefetch(self):
+        """
+        預讀到下一個區塊之後，讓最後一個區塊送出時就帶上正確的總長度
+
+        每個區塊送出前呼叫；讀到 EOF 時在此完成查重。第一次呼叫時檔案小於一個區塊的內容
+        會在送出任何資料前讀完。
+        """
+        self._raise_source_error()
+        if self._size is None:
+            self._fill(self._handed_out + self._chunksize + 1)
+
+    def _check_duplicate(self):
+        if self._find_duplicate is None:
+            return
+        existing = self._find_duplicate(self.sha256, self._size)
+        if existing:
+            self.duplicate_of = existing
+            raise DuplicateContentError(existing)
+
+    def to_json(self):
+        raise NotImplementedError("StreamingMedia 無法序列化")
+
+@stage_timer("folder_lookup")
+def _resolve_upload_folder(folder_path=()):
+    """
+    取得上傳目標資料夾
+
+    Args:
+        folder_path: 上傳資料夾底下的分區資料夾路徑（各層名稱），由資料夾索引取得
+
+    Returns:
+        Tuple[父資料夾 ID, 目標資料夾 ID]
+    """
     # 使用已驗證的 Shared Drive ID
-    parent_folder_id = shared_drive_id
+    parent_folder_id = get_shared_drive_id()
     
     if parent_folder_id:
-        print(f"   📂 使用 Shared Drive ID: {parent_folder_id}")
+        logger.debug(f"   📂 使用 Shared Drive ID: {parent_folder_id}")
     else:
-        print(f"   📂 沒有找到 Shared Drive，使用個人 Google Drive")
+        logger.debug(f"   📂 沒有找到 Shared Drive，使用個人 Google Drive")
     
     # 自動建立或尋找上傳資料夾
     try:
-        upload_folder_id = find_or_create_folder(UPLOAD_FOLDER_NAME, parent_folder_id)
-        print(f"   目標資料夾 ID: {upload_folder_id}")
+        upload_folder_id = get_cached_folder_id(UPLOAD_FOLDER_NAME, parent_folder_id)
+        logger.debug(f"   目標資料夾 ID: {upload_folder_id}")
     except Exception as e:
-        print(f"   ⚠️ Shared Drive 建立資料夾失敗: {str(e)}")
-        print(f"   📂 改用個人 Google Drive")
-        upload_folder_id = find_or_create_folder(UPLOAD_FOLDER_NAME)
-        print(f"   目標資料夾 ID: {upload_folder_id}")
-    
+        logger.warning(f"   ⚠️ Shared Drive 建立資料夾失敗: {str(e)}")
+        logger.debug(f"   📂 改用個人 Google Drive")
+        parent_folder_id = None
+        upload_folder_id = get_cached_folder_id(UPLOAD_FOLDER_NAME)
+        logger.debug(f"   目標資料夾 ID: {upload_folder_id}")
+    if folder_path:
+        with span("drive.resolve_folder", path="/".join(folder_path)):
+            upload_folder_id = folder_index.resolve(upload_folder_id, folder_path)
+        logger.debug(f"   分區資料夾: {'/'.join(folder_path)}（ID: {upload_folder_id}）")
+    return parent_folder_id, upload_folder_id
+
+def _reresolve_upload_folder(parent_folder_id, folder_path):
+    """目標資料夾已不存在（上傳回傳 404）：清除快取與資料夾索引後重新取得"""
+    logger.warning(f"   🗑️ 目標資料夾不存在，重新取得資料夾")
+    invalidate_folder_cache(UPLOAD_FOLDER_NAME, parent_folder_id)
+    upload_folder_id = get_cached_folder_id(UPLOAD_FOLDER_NAME, parent_folder_id)
+    if folder_path:
+        folder_index.reset()
+        upload_folder_id = folder_index.resolve(upload_folder_id, folder_path)
+    return upload_folder_id
+
+def list_upload_folder_files():
+    """
+    列出上傳資料夾中的檔案（批次補傳時用來略過已存在的檔案）
+
+    Returns:
+        [{id, name, size, md5Checksum}, ...]
+    """
+    _, upload_folder_id = _resolve_upload_folder()
+    files = []
+    page_token = None
+    while True:
+        result = scheduler.execute(get_drive_service().files().list(
+            q=f"'{upload_folder_id}' in parents and mimeType!='application/vnd.google-apps.folder' and trashed=false",
+            fields="nextPageToken, files(id, name, size, md5Checksum)",
+            pageSize=1000,
+            pageToken=page_token,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True
+        ), "列出上傳資料夾")
+        files.extend(result.get('files', []))
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return files
+
+def _cancel_resumable(request, account):
+    """取消尚未完成的 resumable upload 工作階段，避免留下未完成的上傳"""
+    if not request.resumable_uri:
+        return
+    try:
+        with account.http_pool.connection() as http:
+            http.request(request.resumable_uri, method="DELETE")
+    except Exception as e:
+        logger.warning(f"   ⚠️ 取消上傳工作階段失敗: {str(e)}")
+
+@stage_timer("drive_upload")
+def _create_from_stream(account, media, file_name, folder_id, fail_over=None):
+    """以 StreamingMedia 上傳檔案到指定資料夾（耗時包含等待 LINE 串流內容的時間）"""
+    request = account.service().files().create(
+        body={'name': file_name, 'parents': [folder_id]},
+        media_body=media,
+        fields='id, webViewLink',
+        supportsAllDrives=True
+    )
+    try:
+        return _execute_resumable(request, file_name, account, fail_over)
+    except Exception:
+        # 內容重複或上傳失敗（之後改用其他帳號或暫存檔重新上傳）時都不會再續傳這個工作階段
+        _cancel_resumable(request, account)
+        raise
+
+def _upload_with_failover(upload, can_restart):
+    """
+    借用一個 Service Account 執行 upload(account, fail_over)
+
+    帳號回傳配額錯誤時（帳號會進入冷卻），若還能從頭重新上傳就改用其他帳號重試。
+    還有其他可用帳號時，配額錯誤不在原帳號上退避重試（fail_over() 為真），立即換帳號。
+
+    Returns:
+        Tuple[使用的帳號, upload 的回傳值]
+    """
+    tried = []
+    while True:
+        try:
+            # 內容重複、LINE 來源讀取失敗不是帳號的問題，不計入帳號的成功或失敗
+            with account_pool.lease(exclude=tried, ignore=(DuplicateContentError, StreamSourceError)) as account:
+                excluded = [*tried, account.name]
+
+                def fail_over():
+                    return can_restart() and account_pool.has_ready(exclude=excluded)
+
+                duplicate = None
+                with span("drive.upload", account=account.name, attempt=len(tried) + 1):
+                    try:
+                        return account, upload(account, fail_over)
+                    except DuplicateContentError as e:
+                        duplicate = e
+                raise duplicate
+        except HttpError as e:
+            if quota_error_reason(e) is None or len(tried) + 1 >= len(account_pool) or not can_restart():
+                raise
+            tried.append(account.name)
+            logger.warning(f"   🔀 {account.name} 配額不足，改用其他 Service Account 重新上傳")
+
+def upload_stream_to_drive(media, file_name, folder_path=()):
+    """
+    不經過暫存檔，直接把串流內容上傳到 Google Drive
+
+    Args:
+        media: StreamingMedia
+        file_name: 檔案名稱
+        folder_path: 上傳資料夾底下的分區資料夾路徑
+
+    Returns:
+        Tuple[檔案 ID, 網頁連結]；上傳大小可由 media.bytes_read 取得。
+        內容與既有檔案相同時不會上傳，回傳既有檔案並設定 media.duplicate_of
+    """
+    logger.info(f"🚀 開始串流上傳檔案到 Google Drive")
+    logger.debug(f"   檔案名稱: {file_name}")
+    logger.debug(f"   MIME 類型: {media.mimetype()}")
+
+    try:
+        # 斷路器開啟時在讀取任何內容之前就失敗，LINE 內容留待之後重新下載
+        # 讀取 LINE 內容失敗不代表 Drive 故障，不計入斷路器
+        with breaker.guard(ignore=StreamSourceError):
+            media.prefetch()
+            parent_folder_id, upload_folder_id = _resolve_upload_folder(folder_path)
+            account, result = _upload_with_failover(
+                lambda account, fail_over: _upload_stream(account, media, file_name, parent_folder_id,
+                                                          upload_folder_id, folder_path, fail_over),
+                media.can_restart,
+            )
+        account.record_upload(media.bytes_read)
+        return result
+    except DuplicateContentError as e:
+        logger.info(f"   ♻️ 內容已存在，略過上傳: {e.existing.get('file_id')}")
+        return e.existing['file_id'], e.existing['web_link']
+
+def _upload_stream(account, media, file_name, parent_folder_id, upload_folder_id, folder_path=(), fail_over=None):
+    """執行串流上傳；目標資料夾已不存在時（且尚未送出資料）重新取得資料夾後重試一次"""
+    logger.debug(f"   📤 執行串流上傳（{account.name}）...")
+    try:
+        try:
+            file = _create_from_stream(account, media, file_name, upload_folder_id, fail_over)
+        except HttpError as e:
+            if e.resp.status != 404 or not media.can_restart():
+                raise
+            upload_folder_id = _reresolve_upload_folder(parent_folder_id, folder_path)
+            file = _create_from_stream(account, media, file_name, upload_folder_id, fail_over)
+
+        file_id = file.get('id')
+        web_link = file.get('webViewLink')
+        UPLOADED_BYTES.inc(media.bytes_read)
+        logger.info(f"   ✅ 串流上傳成功！（{media.bytes_read} bytes）")
+        logger.debug(f"   檔案 ID: {file_id}")
+        logger.debug(f"   網頁連結: {web_link}")
+
+        return file_id, web_link
+    except DuplicateContentError:
+        raise
+    except Exception as e:
+        logger.error(f"   🚨 串流上傳失敗: {str(e)}")
+        raise e
+
+def upload_file_to_drive(file_path, file_name):
+    logger.debug(f"   檔案路徑: {file_path}")
     mime_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-    print(f"   MIME 類型: {mime_type}")
+    with open(file_path, 'rb') as fd:
+        return upload_fileobj_to_drive(fd, os.path.getsize(file_path), file_name, mime_type)
+
+def upload_fileobj_to_drive(fd, size, file_name, mime_type=None, folder_path=()):
+    """
+    上傳可隨機讀取的檔案物件（暫存檔或記憶體中的內容）到 Google Drive
+
+    Args:
+        fd: 檔案物件（需支援 seek）
+        size: 內容大小（bytes）
+        file_name: 檔案名稱
+        mime_type: MIME 類型；未指定時依檔名判斷
+        folder_path: 上傳資料夾底下的分區資料夾路徑
+
+    Returns:
+        Tuple[檔案 ID, 網頁連結]
+    """
+    logger.info(f"🚀 開始上傳檔案到 Google Drive")
+    logger.debug(f"   檔案名稱: {file_name}")
     
-    file_metadata = {
-        'name': file_name,
-        'parents': [upload_folder_id]
-    }
-    media = MediaFileUpload(file_path, mimetype=mime_type)
+    mime_type = mime_type or mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    logger.debug(f"   MIME 類型: {mime_type}")
     
-    print(f"   📤 執行上傳...")
+    def upload(account, fail_over):
+        logger.debug(f"   📤 執行上傳（{account.name}）...")
+        try:
+            return _create_file(account, fd, size, file_name, mime_type, upload_folder_id, fail_over)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # 快取的資料夾已不存在：清掉快取並重新取得後重試一次
+            folder_id = _reresolve_upload_folder(parent_folder_id, folder_path)
+            return _create_file(account, fd, size, file_name, mime_type, folder_id, fail_over)
+
     try:
-        file = drive_service.files().create(
-            body=file_metadata, 
-            media_body=media, 
-            fields='id, webViewLink',
-            supportsAllDrives=True
-        ).execute()
+        with breaker.guard():
+            parent_folder_id, upload_folder_id = _resolve_upload_folder(folder_path)
+            # 檔案物件可以 seek 回開頭，換帳號時一定能重新上傳
+            account, file = _upload_with_failover(upload, lambda: True)
+        account.record_upload(size)
         
         file_id = file.get('id')
         web_link = file.get('webViewLink')
-        print(f"   ✅ 上傳成功！")
-        print(f"   檔案 ID: {file_id}")
-        print(f"   網頁連結: {web_link}")
+        UPLOADED_BYTES.inc(size)
+        logger.info(f"   ✅ 上傳成功！")
+        logger.debug(f"   檔案 ID: {file_id}")
+        logger.debug(f"   網頁連結: {web_link}")
         
         return file_id, web_link
     except Exception as e:
-        print(f"   🚨 上傳失敗: {str(e)}")
+        logger.error(f"   🚨 上傳失敗: {str(e)}")
         raise e 
\ No newline at end of file
@@ -0,0 +1,428 @@
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# 模擬伺服器讀寫 body 的區塊大小；頻寬限制以區塊為單位 sleep
+IO_CHUNK_SIZE = 64 * 1024
+
+
+class FaultProfile:
+    """模擬伺服器的延遲、頻寬與錯誤注入設定"""
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503):
+        """
+        Args:
+            latency: 每個請求回應前額外等待的秒數
+            bandwidth: 傳輸 body 的頻寬上限（bytes/s），0 代表不限制
+            error_rate: 以此機率直接回傳 error_status（0～1）
+            error_status: 注入錯誤時回傳的 HTTP 狀態碼
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def throttle(self, nbytes: int):
+        if self.bandwidth > 0:
+            time.sleep(nbytes / self.bandwidth)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "bandwidth": self.bandwidth,
+            "error_rate": self.error_rate,
+            "error_status": self.error_status,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 由 _FakeServer 設定
+    service = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        parts = []
+        remaining = length
+        while remaining > 0:
+            part = self.rfile.read(min(IO_CHUNK_SIZE, remaining))
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+            self.service.faults.throttle(len(part))
+        return b"".join(parts)
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "application/json", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body or status not in (204, 308):
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _send_json(self, status: int, payload, headers=None):
+        self._send(status, json.dumps(payload).encode("utf-8"), headers=headers)
+
+    def _dispatch(self, method):
+        parsed = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        try:
+            self.service.handle(self, method, parsed.path, query)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 壓測結束時 client 關閉 keep-alive 連線屬於正常情況
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class _FakeServer:
+    """在背景執行緒跑的 HTTP 模擬伺服器"""
+
+    name = "fake"
+
+    def __init__(self, faults: FaultProfile = None, host: str = "127.0.0.1", port: int = 0):
+        self.faults = faults or FaultProfile()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "injected_errors": 0}
+        handler = type(f"{type(self).__name__}Handler", (_Handler,), {"service": self})
+        self._httpd = _QuietHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info(f"🧪 {self.name} 模擬伺服器啟動於 {self.url}")
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] = self._stats.get(key, 0) + amount
+
+    def _inject_fault(self, handler) -> bool:
+        """套用延遲；依錯誤率回傳錯誤時傳回 True"""
+        self._count("requests")
+        self.faults.delay()
+        if self.faults.should_fail():
+            self._count("injected_errors")
+            handler._read_body()
+            handler._send_json(self.faults.error_status, {
+                "error": {"code": self.faults.error_status, "message": "injected failure",
+                          "errors": [{"reason": "backendError"}]},
+                "message": "injected failure",
+            })
+            return True
+        return False
+
+    def handle(self, handler, method, path, query):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["faults"] = self.faults.to_dict()
+        return stats
+
+
+class FakeLineServer(_FakeServer):
+    """
+    模擬 LINE Messaging API
+
+    - GET /v2/bot/message/{id}/content：回傳事先以 register_content() 登記大小的內容
+    - POST /v2/bot/message/reply、/v2/bot/message/push：記錄送達時間與訊息類型
+
+    錯誤注入只套用在內容下載，回覆永遠成功，壓測才能量到每個事件的結果。
+    """
+
+    name = "fake-line"
+    _CONTENT_PATH = re.compile(r"^/v2/bot/message/([^/]+)/content$")
+
+    def __init__(self, faults: FaultProfile = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__(faults, host, port)
+        self._contents = {}
+        self._deliveries = {}
+        self._delivered = threading.Condition(self._lock)
+        # 每個位元組都不同的內容太耗 CPU；以固定的亂數區塊重複填充，開頭再加上訊息 ID 讓雜湊不同
+        self._pattern = random.Random(0).randbytes(IO_CHUNK_SIZE)
+
+    def register_content(self, message_id: str, size: int):
+        """登記訊息內容大小"""
+        with self._lock:
+            self._contents[message_id] = size
+
+    def content(self, message_id: str, size: int):
+        """產生訊息內容（逐塊）"""
+        prefix = f"{message_id}:".encode("utf-8")
+        sent = 0
+        while sent < size:
+            chunk = self._pattern if sent else prefix + self._pattern[len(prefix):]
+            chunk = chunk[:size - sent]
+            sent += len(chunk)
+            yield chunk
+
+    def handle(self, handler, method, path, query):
+        match = self._CONTENT_PATH.match(path)
+        if method == "GET" and match:
+            if self._inject_fault(handler):
+                return
+            self._serve_content(handler, match.group(1))
+        elif method == "POST" and path in ("/v2/bot/message/reply", "/v2/bot/message/push"):
+            self._count("requests")
+            self.faults.delay()
+            body = json.loads(handler._read_body() or b"{}")
+            key = body.get("replyToken") or body.get("to")
+            via = "reply" if "replyToken" in body else "push"
+            types = [message.get("type") for message in body.get("messages", [])]
+            with self._delivered:
+                self._deliveries[key] = {"at": time.monotonic(), "via": via, "types": types}
+                self._stats[f"{via}_messages"] = self._stats.get(f"{via}_messages", 0) + 1
+                self._delivered.notify_all()
+            handler._send_json(200, {})
+        else:
+            handler._read_body()
+            handler._send_json(404, {"message": "Not found"})
+
+    def _serve_content(self, handler, message_id):
+        with self._lock:
+            size = self._contents.get(message_id)
+        if size is None:
+            handler._send_json(404, {"message": "Not found"})
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/octet-stream")
+        handler.send_header("Content-Length", str(size))
+        handler.end_headers()
+        for chunk in self.content(message_id, size):
+            handler.wfile.write(chunk)
+            self.faults.throttle(len(chunk))
+        self._count("content_bytes", size)
+
+    def delivery(self, key):
+        """回覆（reply token）或推播（聊天室 ID）的送達紀錄，尚未送達時回傳 None"""
+        with self._lock:
+            return self._deliveries.get(key)
+
+    def wait_for(self, keys, timeout: float) -> dict:
+        """等待所有 key 都收到訊息或逾時，回傳已送達的紀錄"""
+        deadline = time.monotonic() + timeout
+        keys = set(keys)
+        with self._delivered:
+            while True:
+                delivered = {key: self._deliveries[key] for key in keys if key in self._deliveries}
+                remaining = deadline - time.monotonic()
+                if len(delivered) == len(keys) or remaining <= 0:
+                    return delivered
+                self._delivered.wait(min(remaining, 1.0))
+
+
+class FakeDriveServer(_FakeServer):
+    """
+    模擬 Google Drive v3 API（只實作本專案用到的部分）
+
+    - POST /token：Service Account 換發 access token（不套用錯誤注入）
+    - drives list/get、files list/get/create/delete
+    - multipart 與 resumable 上傳（含未知總長度的串流上傳與位移查詢）
+    """
+
+    name = "fake-drive"
+    _FILE_PATH = re.compile(r"^/drive/v3/files/([^/]+)$")
+    _DRIVE_PATH = re.compile(r"^/drive/v3/drives/([^/]+)$")
+    _QUERY_NAME = re.compile(r"name='((?:[^'\\]|\\.)*)'")
+    _QUERY_PARENT = re.compile(r"'([^']+)' in parents")
+    _QUERY_MIME = re.compile(r"mimeType\s*(!?=)\s*'([^']+)'")
+    _CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+    SHARED_DRIVE = {"id": "fake-shared-drive", "name": "Benchmark Shared Drive", "kind": "drive#drive"}
+
+    def __init__(self, faults: FaultProfile = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__(faults, host, port)
+        self._files = {}
+        self._sessions = {}
+
+    @property
+    def api_endpoint(self) -> str:
+        """給 DRIVE_API_ENDPOINT 使用的 root URL"""
+        return f"{self.url}/"
+
+    @property
+    def token_uri(self) -> str:
+        return f"{self.url}/token"
+
+    def _new_file(self, metadata: dict, size: int = 0) -> dict:
+        file_id = uuid.uuid4().hex
+        file = {
+            "id": file_id,
+            "name": metadata.get("name", "untitled"),
+            "mimeType": metadata.get("mimeType", "application/octet-stream"),
+            "parents": metadata.get("parents") or [],
+            "trashed": False,
+            "size": size,
+            "webViewLink": f"{self.url}/file/d/{file_id}/view",
+        }
+        with self._lock:
+            self._files[file_id] = file
+            if file["mimeType"] != "application/vnd.google-apps.folder":
+                self._stats["uploads"] = self._stats.get("uploads", 0) + 1
+                self._stats["uploaded_bytes"] = self._stats.get("uploaded_bytes", 0) + size
+        return file
+
+    def handle(self, handler, method, path, query):
+        if path == "/token":
+            handler._read_body()
+            handler._send_json(200, {"access_token": "fake-token", "expires_in": 3600, "token_type": "Bearer"})
+            return
+        if self._inject_fault(handler):
+            return
+        if path == "/drive/v3/drives" and method == "GET":
+            handler._send_json(200, {"drives": [self.SHARED_DRIVE]})
+        elif self._DRIVE_PATH.match(path) and method == "GET":
+            drive_id = self._DRIVE_PATH.match(path).group(1)
+            handler._send_json(200, dict(self.SHARED_DRIVE, id=drive_id))
+        elif path == "/drive/v3/files" and method == "GET":
+            handler._send_json(200, {"files": self._search(query.get("q", ""))})
+        elif path == "/drive/v3/files" and method == "POST":
+            handler._send_json(200, self._new_file(json.loads(handler._read_body() or b"{}")))
+        elif self._FILE_PATH.match(path) and method in ("GET", "DELETE"):
+            self._file_request(handler, method, self._FILE_PATH.match(path).group(1))
+        elif path == "/upload/drive/v3/files" and method == "POST":
+            self._start_upload(handler, query)
+        elif path == "/upload/drive/v3/files" and method == "PUT":
+            self._upload_chunk(handler, query.get("upload_id"))
+        elif path == "/upload/drive/v3/files" and method == "DELETE":
+            with self._lock:
+                self._sessions.pop(query.get("upload_id"), None)
+            handler._send(499)
+        else:
+            handler._read_body()
+            handler._send_json(404, {"error": {"code": 404, "message": f"{method} {path} not found"}})
+
+    def _search(self, q: str) -> list:
+        name = self._QUERY_NAME.search(q)
+        parent = self._QUERY_PARENT.search(q)
+        mime = self._QUERY_MIME.search(q)
+        with self._lock:
+            files = list(self._files.values())
+        return [
+            {"id": file["id"], "name": file["name"], "mimeType": file["mimeType"], "size": str(file["size"]),
+             "parents": file["parents"]}
+            for file in files
+            if not file["trashed"]
+            and (name is None or file["name"] == name.group(1).replace("\\'", "'"))
+            and (parent is None or parent.group(1) in file["parents"])
+            and (mime is None or (file["mimeType"] == mime.group(2)) == (mime.group(1) == "="))
+        ]
+
+    def _file_request(self, handler, method, file_id):
+        with self._lock:
+            file = self._files.get(file_id)
+            if file is not None and method == "DELETE":
+                del self._files[file_id]
+        if file is None:
+            handler._send_json(404, {"error": {"code": 404, "message": f"File not found: {file_id}"}})
+        elif method == "DELETE":
+            handler._send(204)
+        else:
+            handler._send_json(200, file)
+
+    def _start_upload(self, handler, query):
+        body = handler._read_body()
+        if query.get("uploadType") == "resumable":
+            upload_id = uuid.uuid4().hex
+            with self._lock:
+                self._sessions[upload_id] = {"metadata": json.loads(body or b"{}"), "received": 0}
+            location = f"{self.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+            handler._send(200, headers={"Location": location})
+            return
+        # multipart/related：第一段是 JSON metadata，第二段是檔案內容
+        boundary = re.search(r'boundary="?([^";]+)"?', handler.headers.get("Content-Type", ""))
+        metadata, size = {}, len(body)
+        if boundary:
+            parts = body.split(b"--" + boundary.group(1).encode("utf-8"))
+            # googleapiclient 以 \n 換行；每段的標頭與內容以空行分隔，內容結尾的換行屬於 boundary
+            sections = [re.split(rb"\r?\n\r?\n", part, 1)[-1] for part in parts[1:-1]]
+            sections = [section[:-2] if section.endswith(b"\r\n") else section[:-1] for section in sections]
+            if sections:
+                metadata = json.loads(sections[0] or b"{}")
+            if len(sections) > 1:
+                size = len(sections[1])
+        handler._send_json(200, self._new_file(metadata, max(size, 0)))
+
+    def _upload_chunk(self, handler, upload_id):
+        body = handler._read_body()
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None:
+            handler._send_json(404, {"error": {"code": 404, "message": "Upload session not found"}})
+            return
+        match = self._CONTENT_RANGE.match(handler.headers.get("Content-Range", ""))
+        if match is None:
+            handler._send_json(400, {"error": {"code": 400, "message": "Invalid Content-Range"}})
+            return
+        start, _end, total = match.groups()
+        if start is not None:
+            start = int(start)
+            if start > session["received"]:
+                handler._send_json(400, {"error": {"code": 400, "message": "Non-contiguous chunk"}})
+                return
+            # 從已確認位移之前開始的區塊（重送）只取新的部分
+            session["received"] = max(session["received"], start + len(body))
+        if total != "*" and session["received"] >= int(total):
+            with self._lock:
+                self._sessions.pop(upload_id, None)
+            handler._send_json(200, self._new_file(session["metadata"], session["received"]))
+            return
+        headers = {}
+        if session["received"]:
+            headers["Range"] = f"bytes=0-{session['received'] - 1}"
+        handler._send(308, headers=headers)
@@ -1,13 +1,20 @@
+import logging
 import os
-import requests
 import uuid
 from datetime import datetime
 from typing import Optional, Tuple
 from linebot.models import MessageEvent, FileMessage
 import config
 
+logger = logging.getLogger(__name__)
+
 class FileHandler:
-    def __init__(self):
+    def __init__(self, line_client):
+        """
+        Args:
+            line_client: 已啟動的 line_client.AsyncLineClient（與 main 共用同一個 session）
+        """
+        self.line_client = line_client
         # 確保暫存資料夾存在
         if not os.path.exists(config.TEMP_FOLDER):
             os.makedirs(config.TEMP_FOLDER)
@@ -26,11 +33,6 @@ class FileHandler:
             return None
             
         try:
-            # 取得檔案內容
-            file_content = self._get_file_content(message_event.message.id)
-            if not file_content:
-                return None
-            
             # 取得檔案資訊
             file_name = message_event.message.file_name or f"file_{uuid.uuid4().hex[:8]}"
             file_size = message_event.message.file_size
@@ -49,36 +51,39 @@ class FileHandler:
             unique_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{file_name}"
             file_path = os.path.join(config.TEMP_FOLDER, unique_filename)
             
-            # 儲存檔案
-            with open(file_path, 'wb') as f:
-                f.write(file_content)
+            # 串流寫入檔案
+            file_size = self._save_file_content(message_event.message.id, file_path)
+            if file_size is None:
+                return None
             
             return file_path, file_name, file_size
             
         except Exception as e:
-            print(f"下載檔案時發生錯誤: {str(e)}")
+            logger.error(f"下載檔案時發生錯誤: {str(e)}")
             return None
     
-    def _get_file_content(self, message_id: str) -> Optional[bytes]:
+    def _save_file_content(self, message_id: str, file_path: str) -> Optional[int]:
         """
-        從 LINE 取得檔案內容
+        從 LINE 串流下載檔案內容並寫入 file_path（需在 event loop 以外的執行緒呼叫）
         
         Args:
             message_id: LINE 訊息 ID
+            file_path: 寫入的檔案路徑
             
         Returns:
-            檔案內容的 bytes 或 None
+            寫入的位元組數或 None
         """
         try:
-            from linebot import LineBotApi
-            line_bot_api = LineBotApi(config.LINE_CHANNEL_ACCESS_TOKEN)
-            
-            # 取得檔案內容
-            file_content = line_bot_api.get_message_content(message_id)
-            return file_content.content
+            written = 0
+            with open(file_path, 'wb') as f:
+                for chunk in self.line_client.stream_content(message_id):
+                    f.write(chunk)
+                    written += len(chunk)
+            return written
             
         except Exception as e:
-            print(f"取得檔案內容時發生錯誤: {str(e)}")
+            logger.error(f"取得檔案內容時發生錯誤: {str(e)}")
+            self.cleanup_temp_file(file_path)
             return None
     
     def cleanup_temp_file(self, file_path: str):
@@ -91,9 +96,9 @@ class FileHandler:
         try:
             if os.path.exists(file_path):
                 os.remove(file_path)
-                print(f"已清理暫存檔案: {file_path}")
+                logger.info(f"已清理暫存檔案: {file_path}")
         except Exception as e:
-            print(f"清理檔案時發生錯誤: {str(e)}")
+            logger.error(f"清理檔案時發生錯誤: {str(e)}")
     
     def get_file_info(self, file_path: str) -> dict:
         """
@@ -113,5 +118,5 @@ class FileHandler:
                 'modified_time': datetime.fromtimestamp(stat.st_mtime)
             }
         except Exception as e:
-            print(f"取得檔案資訊時發生錯誤: {str(e)}")
+            logger.error(f"取得檔案資訊時發生錯誤: {str(e)}")
             return {} 
\ No newline at end of file
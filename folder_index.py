@@ -0,0 +1,149 @@
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+from zoneinfo import ZoneInfo
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+FOLDER_INDEX_LOOKUPS = REGISTRY.counter(
+    "line_uploader_folder_index_lookups_total", "分區資料夾查詢次數（hit 不需 API 呼叫、created 為新建立）", ["result"])
+FOLDER_INDEX_LOADS = REGISTRY.counter("line_uploader_folder_index_loads_total", "資料夾樹索引的完整載入次數")
+
+
+def partition_path(layout: str, chat: str, timestamp: float, timezone: str = "UTC") -> tuple:
+    """
+    依 FOLDER_LAYOUT 樣板產生分區資料夾路徑
+
+    Args:
+        layout: 以 / 分隔各層的樣板，可用 {chat}、{yyyy}、{mm}、{dd}，例如 "{chat}/{yyyy}-{mm}"；
+            空字串代表不分區
+        chat: 聊天室 ID（群組、多人聊天室或使用者）
+        timestamp: 訊息時間（epoch 秒）
+        timezone: 計算日期欄位用的時區（IANA 名稱），與伺服器時區無關
+
+    Returns:
+        各層資料夾名稱
+    """
+    when = datetime.datetime.fromtimestamp(timestamp, ZoneInfo(timezone))
+    fields = {"chat": chat, "yyyy": f"{when:%Y}", "mm": f"{when:%m}", "dd": f"{when:%d}"}
+    return tuple(part.strip().format(**fields) for part in layout.split("/") if part.strip())
+
+
+class FolderIndex:
+    """
+    上傳資料夾以下資料夾樹的記憶體索引
+
+    第一次使用時以分頁的 files().list 一次列出所有資料夾，只保留上傳資料夾底下的子樹；
+    之後取得分區資料夾只查索引，不需任何 API 呼叫，缺少的分區才建立並加入索引。
+    分區資料夾被刪除（上傳回傳 404）時呼叫 reset()，下次使用時重新載入。
+    """
+
+    def __init__(self, list_folders, create_folder):
+        """
+        Args:
+            list_folders: 列出所有資料夾的函式，回傳 [{id, name, parents}, ...]
+            create_folder: 尋找或建立資料夾的函式 (名稱, 父資料夾 ID) -> 資料夾 ID
+        """
+        self._list_folders = list_folders
+        self._create_folder = create_folder
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._key_locks = {}
+        self._root_id = None
+        self._children = {}  # (父資料夾 ID, 名稱) -> 資料夾 ID
+        self._loaded_at = None
+        self._load_ms = None
+        self._loads = 0
+        self._hits = 0
+        self._created = 0
+
+    def _load(self, root_id):
+        started = time.monotonic()
+        by_parent = defaultdict(list)
+        for folder in self._list_folders():
+            for parent in folder.get("parents") or ():
+                by_parent[parent].append(folder)
+
+        # 只保留上傳資料夾底下的子樹；同一層有同名資料夾時使用第一個
+        children = {}
+        pending = [root_id]
+        while pending:
+            parent = pending.pop()
+            for folder in by_parent.get(parent, ()):
+                key = (parent, folder["name"])
+                if key not in children:
+                    children[key] = folder["id"]
+                    pending.append(folder["id"])
+
+        with self._lock:
+            self._root_id = root_id
+            self._children = children
+            self._loaded_at = time.time()
+            self._load_ms = round((time.monotonic() - started) * 1000, 1)
+            self._loads += 1
+        FOLDER_INDEX_LOADS.inc()
+        logger.info(f"🗂️ 資料夾索引已載入：{len(children)} 個資料夾，耗時 {self._load_ms} ms")
+
+    def ensure_loaded(self, root_id: str):
+        """索引尚未載入（或上傳資料夾已換成別的資料夾）時載入"""
+        if self._root_id == root_id:
+            return
+        with self._load_lock:
+            if self._root_id != root_id:
+                self._load(root_id)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def resolve(self, root_id: str, path) -> str:
+        """
+        取得 root_id 底下 path（各層資料夾名稱）的資料夾 ID，缺少的層級才建立
+
+        同一個資料夾同時只會有一個請求去建立（single-flight）。
+        """
+        self.ensure_loaded(root_id)
+        parent = root_id
+        created = False
+        for name in path:
+            key = (parent, name)
+            folder_id = self._children.get(key)
+            if folder_id is None:
+                with self._key_lock(key):
+                    # 等鎖期間可能已被其他請求建立
+                    folder_id = self._children.get(key)
+                    if folder_id is None:
+                        folder_id = self._create_folder(name, parent)
+                        with self._lock:
+                            self._children[key] = folder_id
+                            self._created += 1
+                        created = True
+            parent = folder_id
+        if created:
+            FOLDER_INDEX_LOOKUPS.inc(result="created")
+        else:
+            with self._lock:
+                self._hits += 1
+            FOLDER_INDEX_LOOKUPS.inc(result="hit")
+        return parent
+
+    def reset(self):
+        """清除索引，下次使用時重新載入"""
+        with self._load_lock, self._lock:
+            self._root_id = None
+            self._children = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "root_id": self._root_id,
+                "folders": len(self._children),
+                "loads": self._loads,
+                "loaded_at": self._loaded_at,
+                "load_ms": self._load_ms,
+                "hits": self._hits,
+                "created": self._created,
+            }
@@ -0,0 +1,70 @@
+import collections
+import logging
+import threading
+from typing import List, Optional
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_EVENTS = REGISTRY.counter(
+    "line_uploader_duplicate_events_total", "略過的重複 webhook 事件數（依偵測位置）", ["layer"])
+
+
+def event_keys(event) -> List[str]:
+    """事件的冪等鍵：webhookEventId 與訊息 ID（LINE 重送時兩者都不變）"""
+    keys = []
+    if getattr(event, "webhook_event_id", None):
+        keys.append(f"event:{event.webhook_event_id}")
+    message = getattr(event, "message", None)
+    if message is not None and getattr(message, "id", None):
+        keys.append(f"message:{message.id}")
+    return keys
+
+
+class RecentEvents:
+    """
+    最近處理過的事件鍵（有上限的 LRU）
+
+    擋在 JobStore 前面，LINE 重送的事件大多在這裡就以 O(1) 判斷為重複，
+    不必查詢資料庫；其他 uvicorn worker 收過的事件則由 JobStore 的事件鍵表判斷。
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = max(1, capacity)
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = collections.Counter()
+
+    def lookup(self, keys) -> Optional[tuple]:
+        """
+        Returns:
+            (第一個已看過的鍵, 工作 ID 或 None) 或 None（沒看過）
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._keys:
+                    self._keys.move_to_end(key)
+                    return key, self._keys[key]
+        return None
+
+    def add(self, keys, job_id=None):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = job_id
+                self._keys.move_to_end(key)
+            while len(self._keys) > self._capacity:
+                self._keys.popitem(last=False)
+
+    def count_duplicate(self, layer: str, event, job_id=None):
+        """記錄略過的重複事件；layer 為 memory（LRU）或 store（JobStore）"""
+        self.duplicates[layer] += 1
+        DUPLICATE_EVENTS.inc(layer=layer)
+        redelivery = getattr(getattr(event, "delivery_context", None), "is_redelivery", False)
+        target = f"，由工作 #{job_id} 處理" if job_id else ""
+        logger.info(f"🔂 略過重複事件（{layer}{'，LINE 重送' if redelivery else ''}{target}）: "
+                    f"{getattr(event, 'webhook_event_id', None) or event.message.id}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._keys)
+        return {"capacity": self._capacity, "size": size, "duplicates": dict(self.duplicates)}
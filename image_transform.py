@@ -0,0 +1,276 @@
+import io
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from metrics import REGISTRY, stage_timer
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 為選用套件，未安裝時不轉檔
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TRANSFORMS = REGISTRY.counter(
+    "line_uploader_image_transforms_total", "圖片轉檔結果（recompressed 上傳轉檔後內容、original 保留原檔）", ["result"])
+IMAGE_BYTES_SAVED = REGISTRY.counter("line_uploader_image_bytes_saved_total", "圖片轉檔節省的上傳位元組數")
+
+# 縮圖檔名（由 ThumbnailStore.put 產生）
+_THUMBNAIL_NAME = re.compile(r"^[0-9a-f]{32}\.jpg$")
+
+# 子程序由 forkserver 建立：forkserver 是單執行緒的乾淨程序，服務執行中（已有許多背景執行緒）
+# 重建 process pool 也安全，且不會重新執行 main.py 的模組層級初始化；沒有 forkserver 的平台使用預設方式
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _MP_CONTEXT = multiprocessing.get_context("forkserver")
+    _MP_CONTEXT.set_forkserver_preload([__name__])
+else:
+    _MP_CONTEXT = multiprocessing.get_context()
+
+
+def _ready():
+    return True
+
+
+def _transform_image(source, max_dimension: int, jpeg_quality: int, thumbnail_size: int):
+    """
+    在子程序中執行的轉檔
+
+    Args:
+        source: 圖片內容（bytes）或暫存檔路徑；大圖片以路徑傳入，不經過 pickle 複製
+
+    Returns:
+        Tuple[重新壓縮後的 JPEG（不需轉檔時為 None）, 縮圖 JPEG 或 None, 是否縮小了解析度]
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as opened:
+        animated = getattr(opened, "is_animated", False)
+        # 依 EXIF 方向轉正，重新壓縮後方向資訊不會遺失
+        image = ImageOps.exif_transpose(opened)
+        exif = image.getexif()
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        thumbnail = None
+        if thumbnail_size:
+            preview = image.copy()
+            preview.thumbnail((thumbnail_size, thumbnail_size))
+            buffer = io.BytesIO()
+            preview.save(buffer, "JPEG", quality=80, optimize=True)
+            thumbnail = buffer.getvalue()
+
+        if animated:
+            # 動畫只產生縮圖，保留原檔
+            return None, thumbnail, False
+
+        resized = bool(max_dimension) and max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=jpeg_quality, optimize=True, exif=exif.tobytes() if exif else b"")
+        return buffer.getvalue(), thumbnail, resized
+
+
+class ImageTransformer:
+    """
+    圖片上傳前的轉檔：重新壓縮、限制解析度並產生 Flex 縮圖
+
+    轉檔在 ProcessPoolExecutor 中執行，多張圖片可同時使用多個 CPU 核心，
+    也不會佔住 event loop 或 GIL。設定可依聊天室覆寫；需要安裝 Pillow。
+    """
+
+    def __init__(self, workers: int, enabled: bool, max_dimension: int, jpeg_quality: int, thumbnail_size: int,
+                 overrides: dict = None, timeout: float = 60.0):
+        """
+        Args:
+            workers: 轉檔的子程序數
+            enabled: 預設是否轉檔
+            max_dimension: 長邊像素上限（0 代表不縮小）
+            jpeg_quality: 重新壓縮的 JPEG 品質
+            thumbnail_size: 縮圖長邊像素（0 代表不產生縮圖）
+            overrides: 聊天室 ID -> 要覆寫的設定（enabled、max_dimension、jpeg_quality、thumbnail_size）
+            timeout: 單張圖片的轉檔秒數上限
+        """
+        self._workers = max(1, workers)
+        self._defaults = {
+            "enabled": enabled,
+            "max_dimension": max_dimension,
+            "jpeg_quality": jpeg_quality,
+            "thumbnail_size": thumbnail_size,
+        }
+        self._overrides = overrides or {}
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {"recompressed": 0, "original": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0}
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    @property
+    def configured(self) -> bool:
+        """是否有任何聊天室會轉檔"""
+        return self._defaults["enabled"] or any(o.get("enabled") for o in self._overrides.values())
+
+    def settings_for(self, chat_id: str):
+        """聊天室的轉檔設定；不轉檔時回傳 None"""
+        settings = {**self._defaults, **self._overrides.get(chat_id, {})}
+        if not settings["enabled"] or not self.available:
+            return None
+        return settings
+
+    def start(self):
+        if not self.configured:
+            return
+        if not self.available:
+            logger.warning("⚠️ 已設定圖片轉檔但未安裝 Pillow，圖片將以原檔上傳")
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self._workers, mp_context=_MP_CONTEXT)
+                # 立即啟動 forkserver 與子程序，Pillow 有問題時在啟動時就會發現
+                self._executor.submit(_ready).result()
+        logger.info(f"🖼️ 圖片轉檔已啟用（{self._workers} 個程序）")
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _replace_pool(self, executor, terminate=False):
+        """
+        以新的 process pool 取代 executor（由 forkserver 建立子程序，從任何執行緒呼叫都安全）
+
+        Args:
+            terminate: 是否結束舊 pool 的子程序（轉檔逾時時，子程序不會自己停止）
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = ProcessPoolExecutor(self._workers, mp_context=_MP_CONTEXT)
+        if terminate:
+            # ProcessPoolExecutor 沒有公開的方法可以中止執行中的工作
+            for process in list((getattr(executor, "_processes", None) or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, source, settings):
+        with self._lock:
+            if self._executor is None:
+                raise RuntimeError("圖片轉檔尚未啟動")
+            executor = self._executor
+        future = executor.submit(_transform_image, source, settings["max_dimension"], settings["jpeg_quality"],
+                                 settings["thumbnail_size"])
+        try:
+            return future.result(timeout=self._timeout)
+        except BrokenProcessPool:
+            # 子程序異常結束（例如記憶體不足），重建 process pool 給之後的圖片使用
+            self._replace_pool(executor)
+            raise
+        except FutureTimeoutError:
+            # 結束卡住的子程序（同一個 pool 中其他進行中的轉檔會失敗並以原檔上傳）
+            self._replace_pool(executor, terminate=True)
+            raise
+
+    def transform(self, source, size: int, settings: dict) -> dict:
+        """
+        轉檔一張圖片；失敗或轉檔後沒有比較小時保留原檔
+
+        Args:
+            source: 圖片內容（bytes）或暫存檔路徑
+            size: 原檔大小（bytes）
+            settings: settings_for() 回傳的設定
+
+        Returns:
+            {"data": 轉檔後的內容（保留原檔時為 None）, "thumbnail": 縮圖或 None, "saved_bytes": 節省的位元組數}
+        """
+        try:
+            with stage_timer("image_transform"):
+                encoded, thumbnail, resized = self._submit(source, settings)
+        except Exception as e:
+            logger.warning(f"⚠️ 圖片轉檔失敗，以原檔上傳: {str(e) or type(e).__name__}")
+            with self._lock:
+                self._stats["errors"] += 1
+            IMAGE_TRANSFORMS.inc(result="error")
+            return {"data": None, "thumbnail": None, "saved_bytes": 0}
+
+        # 沒有縮小解析度時，重新壓縮比原檔大就保留原檔
+        if encoded is None or (not resized and len(encoded) >= size):
+            encoded, result = None, "original"
+        else:
+            result = "recompressed"
+        output_size = size if encoded is None else len(encoded)
+        saved = size - output_size
+        with self._lock:
+            self._stats[result] += 1
+            self._stats["bytes_in"] += size
+            self._stats["bytes_out"] += output_size
+        IMAGE_TRANSFORMS.inc(result=result)
+        if saved > 0:
+            IMAGE_BYTES_SAVED.inc(saved)
+            logger.info(f"🖼️ 圖片轉檔節省 {saved / 1024:.0f} KB（{size} → {output_size} bytes）")
+        return {"data": encoded, "thumbnail": thumbnail, "saved_bytes": saved}
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            running = self._executor is not None
+        return {
+            "available": self.available,
+            "running": running,
+            "workers": self._workers,
+            "defaults": self._defaults,
+            "overridden_chats": len(self._overrides),
+            **stats,
+            "bytes_saved": stats["bytes_in"] - stats["bytes_out"],
+        }
+
+
+class ThumbnailStore:
+    """
+    Flex 訊息 hero 圖片用的縮圖（LINE 需要以 HTTPS 網址取得圖片，由 /thumbnails/ 提供）
+
+    超過 ttl_seconds 的縮圖在之後寫入時清除。
+    """
+
+    def __init__(self, directory: str, ttl_seconds: int):
+        self.directory = directory
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        """保存縮圖，回傳檔名"""
+        name = f"{uuid.uuid4().hex}.jpg"
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+        self._prune()
+        return name
+
+    def path(self, name: str):
+        """縮圖檔案路徑；檔名不合法或檔案不存在時回傳 None"""
+        if not _THUMBNAIL_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            if now - self._pruned_at < 60:
+                return
+            self._pruned_at = now
+        for entry in os.scandir(self.directory):
+            try:
+                if _THUMBNAIL_NAME.match(entry.name) and now - entry.stat().st_mtime > self._ttl:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue
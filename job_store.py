@@ -0,0 +1,319 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+
+class JobStore:
+    """
+    持久化的上傳工作佇列（SQLite）
+
+    每個 webhook 事件在回覆 LINE 之前先寫入資料庫，程序崩潰或重新部署後
+    仍能接續處理。取出工作時會設定租約（lease），處理中的 worker 需定期續約；
+    租約過期的工作會被視為中斷並重新排入佇列，因此是 at-least-once 語意。
+
+    同一個 webhook 事件（webhookEventId、訊息 ID）只會建立一個工作：事件鍵與工作
+    在同一個交易中寫入，多個 uvicorn worker 共用同一個資料庫時也不會重複。
+
+    上傳完成但回覆還在合併視窗中的工作為 replying 狀態：回覆內容存在 reply 欄位，
+    同樣以租約保護，程序在送出回覆前結束時由 claim_replies() 取回重新送出。
+    """
+
+    def __init__(self, db_path: str, lease_seconds: int, max_attempts: int,
+                 max_running_per_source: int = 0, max_running_per_user: int = 0):
+        """
+        Args:
+            db_path: SQLite 檔案路徑
+            lease_seconds: 租約秒數
+            max_attempts: 每個工作的嘗試次數上限
+            max_running_per_source: 每個聊天室同時處理的工作數上限（0 代表不限制），超過時延後取出
+            max_running_per_user: 每個使用者同時處理的工作數上限（0 代表不限制）
+        """
+        self._db_path = db_path
+        self.lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._max_running_per_source = max_running_per_source
+        self._max_running_per_user = max_running_per_user
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT,
+                    source_type TEXT,
+                    source_id TEXT,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    lease_until REAL,
+                    last_error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "user_id" not in columns:
+                # 舊版資料庫沒有 user_id 欄位
+                conn.execute("ALTER TABLE jobs ADD COLUMN user_id TEXT")
+            if "reply" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN reply TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_source_state ON jobs (source_id, state)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_state ON jobs (user_id, state)")
+            # 已處理過的事件鍵；job_id 為 NULL 代表事件被拒絕、沒有建立工作
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS event_keys (
+                    key TEXT PRIMARY KEY,
+                    job_id INTEGER,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS event_keys_created ON event_keys (created_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, payload: dict, message_id: str = None, source_type: str = None, source_id: str = None,
+                user_id: str = None, event_keys: Iterable[str] = ()) -> Optional[int]:
+        """
+        新增一個待處理工作
+
+        Args:
+            event_keys: 事件鍵；任一個已存在時不建立工作
+
+        Returns:
+            工作 ID；事件已處理過時回傳 None
+        """
+        event_keys = list(event_keys)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if event_keys and self._find_event(conn, event_keys) is not None:
+                    conn.execute("ROLLBACK")
+                    return None
+                job_id = conn.execute(
+                    "INSERT INTO jobs (message_id, source_type, source_id, user_id, payload, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (message_id, source_type, source_id, user_id, json.dumps(payload, ensure_ascii=False), now, now),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO event_keys (key, job_id, created_at) VALUES (?, ?, ?)",
+                    [(key, job_id, now) for key in event_keys],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    @staticmethod
+    def _find_event(conn, event_keys):
+        placeholders = ", ".join("?" * len(event_keys))
+        return conn.execute(
+            f"SELECT key, job_id FROM event_keys WHERE key IN ({placeholders}) LIMIT 1", event_keys,
+        ).fetchone()
+
+    def find_event(self, event_keys: Iterable[str]) -> Optional[tuple]:
+        """
+        查詢事件是否已處理過
+
+        Returns:
+            (事件鍵, 工作 ID 或 None) 或 None（沒看過這個事件）
+        """
+        event_keys = list(event_keys)
+        if not event_keys:
+            return None
+        with self._lock, self._connect() as conn:
+            return self._find_event(conn, event_keys)
+
+    def record_event(self, event_keys: Iterable[str]) -> bool:
+        """
+        記錄沒有建立工作（例如被拒絕）的事件
+
+        Returns:
+            是否為第一次記錄；False 代表其他 worker 已處理過同一個事件
+        """
+        event_keys = list(event_keys)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._find_event(conn, event_keys) is not None:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.executemany(
+                    "INSERT INTO event_keys (key, job_id, created_at) VALUES (?, NULL, ?)",
+                    [(key, now) for key in event_keys],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def claim(self) -> Optional[dict]:
+        """
+        取出最舊的待處理工作並設定租約；沒有工作時回傳 None
+
+        所屬聊天室或使用者處理中的工作已達上限的工作會被略過，留待之後取出。
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, message_id, source_type, source_id, payload, attempts, created_at "
+                    "FROM jobs j WHERE state = 'pending' "
+                    "AND (? <= 0 OR source_id IS NULL OR (SELECT COUNT(*) FROM jobs r "
+                    "     WHERE r.source_id = j.source_id AND r.state = 'running') < ?) "
+                    "AND (? <= 0 OR user_id IS NULL OR (SELECT COUNT(*) FROM jobs r "
+                    "     WHERE r.user_id = j.user_id AND r.state = 'running') < ?) "
+                    "ORDER BY id LIMIT 1",
+                    (self._max_running_per_source, self._max_running_per_source,
+                     self._max_running_per_user, self._max_running_per_user),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (now + self.lease_seconds, now, row[0]),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {
+            "id": row[0],
+            "message_id": row[1],
+            "source_type": row[2],
+            "source_id": row[3],
+            "payload": json.loads(row[4]),
+            "attempts": row[5] + 1,
+            "created_at": row[6],
+        }
+
+    def touch(self, job_id: int):
+        """延長處理中（或等待送出回覆）工作的租約"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND state IN ('running', 'replying')",
+                (now + self.lease_seconds, now, job_id),
+            )
+
+    def hold_reply(self, job_id: int, reply: dict):
+        """
+        上傳已完成、回覆等待送出：保存回覆內容並改為 replying 狀態
+
+        replying 的工作不佔用聊天室／使用者的並行名額；送出後以 complete() 標記完成。
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'replying', reply = ?, lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND state = 'running'",
+                (json.dumps(reply, ensure_ascii=False), now + self.lease_seconds, now, job_id),
+            )
+
+    def claim_replies(self) -> list:
+        """
+        取回租約已過期的 replying 工作（送出回覆前程序已結束）並重新設定租約
+
+        Returns:
+            [{id, payload, reply}, ...]
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, payload, reply FROM jobs WHERE state = 'replying' AND lease_until < ? ORDER BY id",
+                    (now,),
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ?",
+                    [(now + self.lease_seconds, now, row[0]) for row in rows],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [{"id": row[0], "payload": json.loads(row[1]), "reply": json.loads(row[2])} for row in rows]
+
+    def complete(self, job_id: int):
+        """標記工作完成"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'done', lease_until = NULL, updated_at = ? WHERE id = ?",
+                (now, job_id),
+            )
+
+    def release(self, job_id: int):
+        """把處理中的工作放回佇列，不計入嘗試次數（工作暫時無法處理時使用）"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = MAX(attempts - 1, 0), lease_until = NULL, "
+                "updated_at = ? WHERE id = ? AND state = 'running'",
+                (now, job_id),
+            )
+
+    def fail(self, job_id: int, error: str, retry: bool = True):
+        """工作失敗；未超過重試上限時重新排入佇列，否則標記為 failed"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = CASE WHEN ? AND attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "lease_until = NULL, last_error = ?, updated_at = ? WHERE id = ?",
+                (1 if retry else 0, self._max_attempts, error, now, job_id),
+            )
+
+    def recover(self, retention_seconds: int) -> int:
+        """
+        崩潰復原：把租約已過期的處理中工作重新排入佇列，並清除過舊的已完成紀錄與事件鍵
+
+        Returns:
+            重新排入佇列的工作數
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            # 已達重試上限的工作（可能每次都讓程序崩潰）不再重試
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL, last_error = 'lease expired', updated_at = ? "
+                "WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, self._max_attempts),
+            )
+            recovered = conn.execute(
+                "UPDATE jobs SET state = 'pending', lease_until = NULL, updated_at = ? "
+                "WHERE state = 'running' AND lease_until < ?",
+                (now, now),
+            ).rowcount
+            conn.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                (now - retention_seconds,),
+            )
+            conn.execute("DELETE FROM event_keys WHERE created_at < ?", (now - retention_seconds,))
+        return recovered
+
+    def depth(self) -> int:
+        """待處理工作數"""
+        with self._lock, self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'").fetchone()[0]
+
+    def counts(self) -> dict:
+        """各狀態的工作數"""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import aiohttp
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LINE_DOWNLOADS_IN_FLIGHT = REGISTRY.gauge(
+    "line_uploader_line_downloads_in_flight", "進行中的 LINE 內容下載數")
+LINE_DOWNLOAD_WAITS = REGISTRY.counter(
+    "line_uploader_line_download_waits_total", "因同時下載數已滿而等待的下載數")
+
+
+class LineDownloadError(Exception):
+    """
+    從 LINE 下載訊息內容時的連線錯誤或逾時
+
+    包裝 aiohttp 與 socket 的例外，避免被當成 Drive 的連線問題而重試或觸發斷路器。
+    """
+
+
+class AsyncLineClient:
+    """
+    asyncio 版的 LINE Messaging API client（aiohttp）
+
+    所有請求共用同一個 ClientSession 與連線池；訊息內容以固定大小的區塊串流，
+    不會整個檔案載入記憶體，同時下載數以 semaphore 限制。
+
+    上傳 worker 在背景執行緒中執行，透過 stream_content()、reply_message_sync() 等
+    同步介面把呼叫交給 event loop（run_coroutine_threadsafe）。
+    """
+
+    def __init__(self, channel_access_token: str, endpoint: str, data_endpoint: str,
+                 max_concurrent_downloads: int, chunk_size: int = 64 * 1024, timeout: float = 60):
+        """
+        Args:
+            channel_access_token: Channel access token
+            endpoint: Messaging API 端點（reply、push）
+            data_endpoint: 內容下載端點
+            max_concurrent_downloads: 同時下載的訊息內容數上限
+            chunk_size: 串流內容的區塊大小（bytes）
+            timeout: 連線與每次讀取的逾時秒數
+        """
+        self._token = channel_access_token
+        self._endpoint = endpoint.rstrip("/")
+        self._data_endpoint = data_endpoint.rstrip("/")
+        self._max_downloads = max(1, max_concurrent_downloads)
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._session = None
+        self._loop = None
+        self._downloads = None
+
+    async def start(self):
+        """建立共用的 HTTP session（需在 event loop 中呼叫）"""
+        self._loop = asyncio.get_running_loop()
+        self._downloads = asyncio.Semaphore(self._max_downloads)
+        self._session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self._token}"},
+            # 下載之外還要留連線給 reply／push
+            connector=aiohttp.TCPConnector(limit=self._max_downloads * 2, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self._timeout, sock_read=self._timeout),
+        )
+        logger.info(f"🌐 LINE client 已啟動（同時下載上限 {self._max_downloads}）")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    async def _raise_for_status(response):
+        if 200 <= response.status < 300:
+            return
+        try:
+            payload = await response.json(content_type=None)
+        except (ValueError, aiohttp.ClientError):
+            payload = {"message": await response.text()}
+        raise LineBotApiError(
+            status_code=response.status,
+            headers=dict(response.headers),
+            request_id=response.headers.get("X-Line-Request-Id"),
+            accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+            error=Error.new_from_json_dict(payload or {}),
+        )
+
+    async def iter_content(self, message_id: str):
+        """以區塊串流訊息內容（async generator）"""
+        if self._downloads.locked():
+            LINE_DOWNLOAD_WAITS.inc()
+        async with self._downloads:
+            with LINE_DOWNLOADS_IN_FLIGHT.track_in_progress():
+                url = f"{self._data_endpoint}/v2/bot/message/{message_id}/content"
+                async with self._session.get(url) as response:
+                    await self._raise_for_status(response)
+                    async for chunk in response.content.iter_chunked(self._chunk_size):
+                        yield chunk
+
+    async def _post(self, path: str, payload: dict, headers=None):
+        data = json.dumps(payload)
+        async with self._session.post(f"{self._endpoint}{path}", data=data, headers={
+            "Content-Type": "application/json", **(headers or {}),
+        }) as response:
+            await self._raise_for_status(response)
+
+    async def reply_message(self, reply_token: str, messages):
+        """以 reply token 回覆訊息（messages 為 linebot.models 的 SendMessage 或其 list）"""
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        await self._post("/v2/bot/message/reply", {
+            "replyToken": reply_token,
+            "messages": [message.as_json_dict() for message in messages],
+        })
+
+    async def push_message(self, to: str, messages, retry_key: str = None):
+        """
+        推播訊息給使用者、群組或聊天室
+
+        Args:
+            retry_key: X-Line-Retry-Key（UUID）；重送同一個 key 時 LINE 只會送達一次
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        await self._post("/v2/bot/message/push", {
+            "to": to,
+            "messages": [message.as_json_dict() for message in messages],
+        }, headers=headers)
+
+    # 以下為給背景執行緒使用的同步介面
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    @staticmethod
+    async def _next_chunk(chunks):
+        return await chunks.__anext__()
+
+    def stream_content(self, message_id: str):
+        """
+        同步的區塊 iterator；每次取下一個區塊時才從網路讀取，記憶體只保留一個區塊
+
+        需在 event loop 以外的執行緒中使用。連線錯誤與逾時以 LineDownloadError 丟出。
+        """
+        chunks = self.iter_content(message_id)
+        try:
+            while True:
+                try:
+                    yield self._run(self._next_chunk(chunks))
+                except StopAsyncIteration:
+                    return
+                except (aiohttp.ClientError, TimeoutError, ConnectionError) as e:
+                    raise LineDownloadError(f"下載 LINE 訊息內容失敗（{type(e).__name__}: {e}）") from e
+        finally:
+            # 提前結束時關閉連線並釋放下載名額
+            self._run(chunks.aclose())
+
+    def reply_message_sync(self, reply_token: str, messages):
+        self._run(self.reply_message(reply_token, messages))
+
+    def push_message_sync(self, to: str, messages, retry_key: str = None):
+        self._run(self.push_message(to, messages, retry_key))
@@ -0,0 +1,66 @@
+import json
+import logging
+import sys
+from tracing import current_trace_id
+
+# LogRecord 內建欄位；其餘欄位（透過 extra= 傳入）會原樣輸出到 JSON
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """每筆日誌輸出為一行 JSON，方便集中收集與查詢"""
+
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage().strip(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TraceIdFilter(logging.Filter):
+    """在 trace 中產生的日誌加上 trace_id 欄位"""
+
+    def filter(self, record):
+        trace_id = current_trace_id()
+        if trace_id:
+            record.trace_id = trace_id
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """人類閱讀的格式；有 trace_id 時附在 logger 名稱後面"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s%(trace)s: %(message)s")
+
+    def format(self, record):
+        trace_id = getattr(record, "trace_id", None)
+        record.trace = f" [{trace_id[:12]}]" if trace_id else ""
+        return super().format(record)
+
+
+def setup_logging(level: str = "INFO", fmt: str = "text"):
+    """
+    設定 root logger
+
+    Args:
+        level: DEBUG 會輸出每個事件的詳細資訊；正式環境建議 INFO 或 WARNING
+        fmt: text（人類閱讀）或 json（結構化）
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+    handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
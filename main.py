@@ -1,15 +1,180 @@
+import time
+
+# 冷啟動計時起點（包含載入各模組的時間）
+_import_started = time.monotonic()
+
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from linebot import LineBotApi, WebhookHandler
+from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, FileMessage, ImageMessage, FlexSendMessage, TextSendMessage
-from config import LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET
-from drive_uploader import upload_file_to_drive, drive_diagnostics
-from message_formatter import create_flex_message
-import tempfile, os, datetime
+from config import (
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, UPLOAD_WORKERS,
+    STREAM_UPLOAD_MAX_SIZE, DRIVE_WARMUP_ON_STARTUP, DEDUP_ENABLED, DEDUP_DB_PATH, DEDUP_VERIFY_ON_HIT,
+    JOB_DB_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETENTION_SECONDS, REPLY_TOKEN_TTL_SECONDS,
+    LOG_LEVEL, LOG_FORMAT, LINE_API_ENDPOINT, LINE_DATA_ENDPOINT,
+    LINE_MAX_CONCURRENT_DOWNLOADS, LINE_DOWNLOAD_CHUNK_SIZE, LINE_HTTP_TIMEOUT,
+    REPLY_COALESCE_WINDOW_MS, REPLY_COALESCE_MAX_ITEMS, MAX_FILE_SIZE, SUPPORTED_EXTENSIONS,
+    QUOTA_WINDOW_SECONDS, USER_QUOTA_BYTES, GROUP_QUOTA_BYTES, USER_MAX_CONCURRENT_UPLOADS,
+    GROUP_MAX_CONCURRENT_UPLOADS, SHED_QUEUE_DEPTH, SHED_TEMP_DISK_PERCENT, TEMP_FOLDER, SPOOL_BUDGET_BYTES,
+    SPOOL_MEMORY_THRESHOLD, SPOOL_WAIT_SECONDS, SPOOL_SWEEP_INTERVAL, SPOOL_ORPHAN_SECONDS,
+    IDEMPOTENCY_CACHE_SIZE, DRIVE_HEALTH_PROBE_INTERVAL, FOLDER_LAYOUT, FOLDER_TIMEZONE, IMAGE_TRANSFORM_ENABLED,
+    IMAGE_TRANSFORM_WORKERS, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_THUMBNAIL_SIZE,
+    IMAGE_TRANSFORM_OVERRIDES, PUBLIC_BASE_URL, THUMBNAIL_FOLDER, THUMBNAIL_TTL_SECONDS, ADMIN_TOKEN, PROFILE_FOLDER,
+)
+from admission import AdmissionController
+from dedup_index import DedupIndex
+from drive_health import DriveUnavailableError
+from drive_scheduler import is_retryable_error
+from drive_uploader import (
+    upload_fileobj_to_drive, upload_stream_to_drive, drive_file_exists,
+    StreamingMedia, StreamSourceError, StreamRewindError, DRIVE_INIT_STATS, warm_up, account_pool as drive_accounts,
+    breaker as drive_breaker, health_prober as drive_health, folder_index, preload_folder_index,
+)
+from folder_index import partition_path
+from idempotency import RecentEvents, event_keys
+from image_transform import ImageTransformer, ThumbnailStore
+from job_store import JobStore
+from line_client import AsyncLineClient
+from log_utils import setup_logging
+from metrics import (
+    REGISTRY, STAGE_SECONDS, EVENTS_RECEIVED, DOWNLOADED_BYTES, UPLOADS_TOTAL, UPLOADS_IN_FLIGHT,
+    TimedIterator, stage_timer,
+)
+from message_formatter import create_flex_message, create_bubble, create_error_bubble, create_carousel_message
+from profiling import SamplingProfiler
+from reply_coalescer import ReplyCoalescer
+from spool import SpoolManager, SpoolFullError
+from tracing import trace, span, current_trace_id, exporter as span_exporter
+from upload_queue import UploadQueue, JobDeferred
+import asyncio, os, io, datetime, mimetypes, threading, hashlib, hmac, logging, uuid
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+STARTUP_STATS = {"app_ready_ms": None}
+
+line_client = AsyncLineClient(
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_API_ENDPOINT, LINE_DATA_ENDPOINT,
+    LINE_MAX_CONCURRENT_DOWNLOADS, LINE_DOWNLOAD_CHUNK_SIZE, LINE_HTTP_TIMEOUT,
+)
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+dedup_index = DedupIndex(DEDUP_DB_PATH) if DEDUP_ENABLED else None
+spool = SpoolManager(
+    TEMP_FOLDER, SPOOL_BUDGET_BYTES, SPOOL_MEMORY_THRESHOLD, SPOOL_WAIT_SECONDS,
+    SPOOL_ORPHAN_SECONDS, SPOOL_SWEEP_INTERVAL,
+)
+# 圖片上傳前的轉檔；縮圖要有對外網址才能放進 Flex 訊息，未設定 PUBLIC_BASE_URL 時不產生
+image_transformer = ImageTransformer(
+    IMAGE_TRANSFORM_WORKERS, IMAGE_TRANSFORM_ENABLED, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY,
+    IMAGE_THUMBNAIL_SIZE if PUBLIC_BASE_URL else 0, IMAGE_TRANSFORM_OVERRIDES,
+)
+thumbnails = ThumbnailStore(THUMBNAIL_FOLDER, THUMBNAIL_TTL_SECONDS) if PUBLIC_BASE_URL else None
+# 由管理 API 開啟的取樣 profiling（量測背景上傳工作）
+profiler = SamplingProfiler(PROFILE_FOLDER)
+
+def is_upload_event(event):
+    """是否為需要上傳的檔案或圖片訊息"""
+    return isinstance(event, MessageEvent) and isinstance(event.message, (FileMessage, ImageMessage))
+
+def get_chat_id(source):
+    """取得事件來源的聊天室 ID（群組、多人聊天室或使用者）"""
+    if source.type == 'group':
+        return source.group_id
+    if source.type == 'room':
+        return source.room_id
+    return source.user_id
+
+def event_trace_id(event):
+    """
+    事件的 trace ID：使用 LINE 的 webhookEventId，webhook 與背景 worker 各自開始的 trace 因此能串在一起
+
+    舊版 webhook 沒有 webhookEventId 時以訊息 ID 代替。
+    """
+    return getattr(event, 'webhook_event_id', None) or f"message-{event.message.id}"
+
+def upload_folder_path(event):
+    """依 FOLDER_LAYOUT 決定上傳資料夾底下的分區資料夾路徑（以訊息時間分月）"""
+    return partition_path(FOLDER_LAYOUT, get_chat_id(event.source), event.timestamp / 1000, FOLDER_TIMEZONE)
+
+# FOLDER_LAYOUT 有未知的欄位或 FOLDER_TIMEZONE 無效時在啟動時就失敗，而不是每個上傳都失敗
+partition_path(FOLDER_LAYOUT, "", 0, FOLDER_TIMEZONE)
+
+def process_job(job):
+    """
+    在背景 worker 中處理單一上傳工作
+
+    Returns:
+        回覆送出後完成的 Future（回覆在合併視窗結束後才送出，送出後工作才標記完成）
+    """
+    event = MessageEvent.new_from_json_dict(job['payload'])
+    if job['attempts'] > 1:
+        logger.info(f"🔁 重新處理工作 #{job['id']}（第 {job['attempts']} 次）")
+    # 還能重試時，暫存空間不足的工作交回佇列稍後再處理，而不是回覆失敗
+    can_retry = job['attempts'] < JOB_MAX_ATTEMPTS
+    trace_id = event_trace_id(event)
+    # worker 執行緒不會帶著 webhook 的 context，以同一個 trace ID 開始這次工作的 trace
+    with trace("upload.job", trace_id=trace_id, job_id=job['id'], attempt=job['attempts']), \
+            profiler.maybe_profile(trace_id), UPLOADS_IN_FLIGHT.track_in_progress():
+        if isinstance(event.message, FileMessage):
+            return handle_file_message(event, can_retry, job['id'])
+        if isinstance(event.message, ImageMessage):
+            return handle_image_message(event, can_retry, job['id'])
 
-app = FastAPI()
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+def redeliver_reply(job):
+    """重新送出程序結束前還沒送出的回覆（reply token 多半已過期，會改用 push）"""
+    event = MessageEvent.new_from_json_dict(job['payload'])
+    logger.info(f"📨 重新送出工作 #{job['id']} 的回覆")
+    # job_id 決定 push 的 retry key，崩潰前已送達的 push 不會重複送出
+    return reply_coalescer.add(event, get_chat_id(event.source), {**job['reply'], "job_id": job['id']})
+
+job_store = JobStore(
+    JOB_DB_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS,
+    max_running_per_source=GROUP_MAX_CONCURRENT_UPLOADS, max_running_per_user=USER_MAX_CONCURRENT_UPLOADS,
+)
+# Drive 斷路器開啟時暫停取出工作，工作留在佇列等 Drive 恢復
+upload_queue = UploadQueue(
+    process_job, job_store, UPLOAD_WORKERS, JOB_RETENTION_SECONDS,
+    gate=drive_breaker.accepting, redeliver=redeliver_reply,
+)
+REGISTRY.gauge("line_uploader_queue_depth", "待處理的上傳工作數", callback=job_store.depth)
+admission = AdmissionController(
+    MAX_FILE_SIZE, SUPPORTED_EXTENSIONS, USER_QUOTA_BYTES, GROUP_QUOTA_BYTES, QUOTA_WINDOW_SECONDS,
+    SHED_QUEUE_DEPTH, SHED_TEMP_DISK_PERCENT, TEMP_FOLDER,
+)
+recent_events = RecentEvents(IDEMPOTENCY_CACHE_SIZE)
+# 背景送出的拒絕回覆（保留參照，避免 task 被回收）
+_rejection_replies = set()
+
+@asynccontextmanager
+async def lifespan(app):
+    # 轉檔子程序要在其他背景執行緒啟動前建立
+    image_transformer.start()
+    await line_client.start()
+    spool.start()
+    await upload_queue.start()
+    if DRIVE_HEALTH_PROBE_INTERVAL > 0:
+        # 背景健康檢查的第一次檢查同時預熱 Drive client，不阻塞服務啟動
+        drive_health.start(run_immediately=DRIVE_WARMUP_ON_STARTUP)
+    elif DRIVE_WARMUP_ON_STARTUP:
+        # 在背景預熱 Drive client，不阻塞服務啟動
+        threading.Thread(target=warm_up, name="drive-warmup", daemon=True).start()
+    if FOLDER_LAYOUT and DRIVE_WARMUP_ON_STARTUP:
+        # 在背景載入分區資料夾索引，之後取得目標資料夾不需 API 呼叫
+        threading.Thread(target=preload_folder_index, name="folder-index", daemon=True).start()
+    STARTUP_STATS["app_ready_ms"] = round((time.monotonic() - _import_started) * 1000, 1)
+    logger.info(f"🚀 服務啟動完成，耗時 {STARTUP_STATS['app_ready_ms']} ms")
+    yield
+    # 送出還在合併視窗中的回覆，送出後工作才標記完成
+    await upload_queue.stop(flush=reply_coalescer.flush_all)
+    await line_client.close()
+    await asyncio.to_thread(spool.stop)
+    await asyncio.to_thread(drive_health.stop)
+    await asyncio.to_thread(image_transformer.stop)
+    span_exporter.close()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 async def root():
@@ -17,148 +182,546 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.datetime.now().isoformat(),
+        "queue_depth": await upload_queue.depth(),
+        "drive": drive_breaker.state,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    # 佇列深度等 gauge 會查詢 SQLite，不在 event loop 上執行
+    return PlainTextResponse(await asyncio.to_thread(REGISTRY.render), media_type="text/plain; version=0.0.4")
 
 @app.get("/diag/drive")
-async def diag_drive():
-    return JSONResponse(drive_diagnostics())
+async def diag_drive(refresh: bool = False):
+    """最近一次背景健康檢查的結果；refresh=1 時立即重新檢查"""
+    result = drive_health.latest()
+    if refresh or result is None:
+        result = await asyncio.to_thread(drive_health.run_once)
+    return JSONResponse({**result, "circuit": drive_breaker.stats()})
+
+@app.get("/diag/drive/scheduler")
+async def diag_drive_scheduler():
+    return {account.name: account.scheduler.stats() for account in drive_accounts.accounts}
+
+@app.get("/diag/drive/pool")
+async def diag_drive_pool():
+    return {account.name: account.http_pool.stats() for account in drive_accounts.accounts}
+
+@app.get("/diag/drive/accounts")
+async def diag_drive_accounts():
+    return drive_accounts.stats()
+
+@app.get("/diag/drive/folders")
+async def diag_drive_folders():
+    return {"layout": FOLDER_LAYOUT or None, **folder_index.stats()}
+
+@app.get("/diag/images")
+async def diag_images():
+    return image_transformer.stats()
+
+@app.get("/thumbnails/{name}")
+async def thumbnail(name: str):
+    path = thumbnails.path(name) if thumbnails is not None else None
+    if path is None:
+        return PlainTextResponse("Not found", status_code=404)
+    return FileResponse(path, media_type="image/jpeg")
+
+@app.get("/diag/startup")
+async def diag_startup():
+    return {**STARTUP_STATS, "drive": DRIVE_INIT_STATS}
+
+@app.get("/diag/dedup")
+async def diag_dedup():
+    if dedup_index is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(dedup_index.stats)}
+
+@app.get("/diag/queue")
+async def diag_queue():
+    stats = await asyncio.to_thread(upload_queue.stats)
+    return {**stats, "replies": reply_coalescer.stats(), "idempotency": recent_events.stats()}
+
+@app.get("/diag/spool")
+async def diag_spool():
+    return spool.stats()
+
+@app.get("/diag/admission")
+async def diag_admission():
+    return admission.stats()
+
+def _admin_rejection(request):
+    """檢查管理 API 的 token；未設定 ADMIN_TOKEN 時管理 API 不存在"""
+    if not ADMIN_TOKEN:
+        return PlainTextResponse("Not found", status_code=404)
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        logger.warning("🔒 管理 API token 錯誤")
+        return PlainTextResponse("Unauthorized", status_code=401)
+    return None
+
+@app.get("/admin/profiling")
+async def admin_profiling(request: Request):
+    rejection = _admin_rejection(request)
+    if rejection is not None:
+        return rejection
+    return profiler.stats()
+
+@app.post("/admin/profiling")
+async def admin_configure_profiling(request: Request, enabled: bool = None, sample_rate: float = None,
+                                    max_profiles: int = None):
+    """開關取樣 profiling，例如 POST /admin/profiling?enabled=1&sample_rate=0.2&max_profiles=10"""
+    rejection = _admin_rejection(request)
+    if rejection is not None:
+        return rejection
+    return profiler.configure(enabled, sample_rate, max_profiles)
 
 @app.post("/callback")
 async def callback(request: Request):
     body = await request.body()
     signature = request.headers['X-Line-Signature']
-    handler.handle(body.decode('utf-8'), signature)
+    try:
+        with stage_timer("webhook_parse"):
+            events = parser.parse(body.decode('utf-8'), signature)
+    except InvalidSignatureError:
+        logger.error("🚨 Webhook 簽章驗證失敗")
+        return PlainTextResponse("Invalid signature", status_code=400)
+    for event in events:
+        EVENTS_RECEIVED.inc(type=event.type)
+
+    upload_events = [event for event in events if is_upload_event(event)]
+    for event in events:
+        if not is_upload_event(event):
+            logger.info(f"ℹ️ 略過未處理的事件: {event.type}")
+
+    # 下載前先依事件中繼資料做准入檢查；被拒絕的事件立即回覆原因，不進入佇列
+    depth = await upload_queue.depth() if upload_events else 0
+    for event in upload_events:
+        with trace("webhook.event", trace_id=event_trace_id(event), message_id=event.message.id) as attrs:
+            # LINE 重送或重複的事件交給原本的工作處理，不重複上傳、不重用 reply token
+            keys = event_keys(event)
+            seen, layer = recent_events.lookup(keys), "memory"
+            if seen is None:
+                seen, layer = await asyncio.to_thread(job_store.find_event, keys), "store"
+            if seen is not None:
+                recent_events.add(keys, seen[1])
+                recent_events.count_duplicate(layer, event, seen[1])
+                attrs["outcome"] = "duplicate"
+                continue
+
+            chat_id = get_chat_id(event.source)
+            rejection = admission.check(event, chat_id, depth)
+            if rejection is not None:
+                reason, message = rejection
+                first_time = await asyncio.to_thread(job_store.record_event, keys)
+                recent_events.add(keys)
+                attrs["outcome"] = f"rejected:{reason}"
+                if not first_time:
+                    recent_events.count_duplicate("store", event)
+                    continue
+                if reason in ("queue_backlog", "temp_disk"):
+                    upload_queue.reject()
+                send_rejection(event, message)
+                continue
+            # 先寫入磁碟上的工作佇列再回覆 200，程序中途結束也不會遺失
+            with span("queue.submit"):
+                job_id = await upload_queue.submit(
+                    event.as_json_dict(),
+                    message_id=event.message.id,
+                    source_type=event.source.type,
+                    source_id=chat_id,
+                    user_id=getattr(event.source, 'user_id', None),
+                    event_keys=keys,
+                )
+            recent_events.add(keys, job_id)
+            if job_id is None:
+                # 其他 uvicorn worker 同時收到同一個事件，配額由收下事件的程序計入
+                admission.refund(event.message.id)
+                recent_events.count_duplicate("store", event)
+                attrs["outcome"] = "duplicate"
+                continue
+            attrs.update(outcome="queued", job_id=job_id)
+            depth += 1
     return 'OK'
 
-@handler.add(MessageEvent, message=FileMessage)
-def handle_file_message(event):
+def send_rejection(event, message):
+    """在背景以 reply token 回覆拒絕原因，不延遲 webhook 回應"""
+    async def reply():
+        try:
+            await line_client.reply_message(event.reply_token, TextSendMessage(text=message))
+        except LineBotApiError as e:
+            logger.warning(f"⚠️ 回覆拒絕原因失敗: {e.status_code} {e.error.message}")
+        except Exception as e:
+            logger.warning(f"⚠️ 回覆拒絕原因失敗: {str(e)}")
+    task = asyncio.create_task(reply())
+    _rejection_replies.add(task)
+    task.add_done_callback(_rejection_replies.discard)
+
+def find_duplicate(sha256, size):
+    """查詢去重索引；命中但 Drive 檔案已被刪除時移除該筆並視為未命中"""
+    if dedup_index is None:
+        return None
+    with span("dedup.lookup", size=size) as attrs:
+        existing = dedup_index.lookup(sha256, size)
+        attrs["hit"] = existing is not None
+        if existing and DEDUP_VERIFY_ON_HIT:
+            try:
+                if not drive_file_exists(existing['file_id']):
+                    logger.info(f"🗑️ 去重索引指向的檔案已刪除，重新上傳: {existing['file_id']}")
+                    dedup_index.forget(existing['file_id'])
+                    attrs["hit"] = False
+                    return None
+            except Exception as e:
+                logger.warning(f"⚠️ 無法確認既有檔案，沿用索引: {str(e)}")
+        return existing
+
+def _record_upload(sha256, size, file_id, web_link, file_name):
+    if dedup_index is not None:
+        try:
+            dedup_index.record(sha256, size, file_id, web_link, file_name)
+        except Exception as e:
+            logger.warning(f"⚠️ 寫入去重索引失敗: {str(e)}")
+
+@contextmanager
+def line_content(message_id):
+    """下載 LINE 訊息內容的區塊 iterator；結束時記錄下載耗時與位元組數"""
+    content = line_client.stream_content(message_id)
+    chunks = TimedIterator(content, stage="line_download")
+    # span 涵蓋整段串流（包含等待 Drive 消化區塊的時間）；wait_ms 是實際等 LINE 回應的時間
+    with span("line.download", message_id=message_id) as attrs:
+        try:
+            yield chunks
+        finally:
+            # 沒讀完就結束時也要關閉連線、釋放下載名額
+            content.close()
+            STAGE_SECONDS.observe(chunks.seconds, stage="line_download")
+            DOWNLOADED_BYTES.inc(chunks.bytes)
+            attrs.update(bytes=chunks.bytes, wait_ms=round(chunks.seconds * 1000, 3))
+
+def _upload_via_temp_file(message_id, file_name, declared_size=None, folder_path=()):
+    """
+    先把 LINE 內容寫入暫存空間再上傳（大檔案或串流失敗時使用）
+
+    小檔案留在記憶體；其餘寫入受預算限制的暫存目錄，空間不足時等待，
+    逾時則丟出 SpoolFullError。
+    """
+    sha256 = hashlib.sha256()
+    with span("spool", declared_size=declared_size), \
+            spool.open(os.path.splitext(file_name)[1], declared_size) as spooled:
+        with line_content(message_id) as chunks:
+            for chunk in chunks:
+                spooled.write(chunk)
+                sha256.update(chunk)
+
+        file_size = spooled.size
+        existing = find_duplicate(sha256.hexdigest(), file_size)
+        if existing:
+            logger.info(f"♻️ 內容已存在，略過上傳: {existing['file_id']}")
+            return existing['file_id'], existing['web_link'], file_size, True
+
+        with spooled.reader() as fd:
+            file_id, web_link = upload_fileobj_to_drive(fd, file_size, file_name, folder_path=folder_path)
+        _record_upload(sha256.hexdigest(), file_size, file_id, web_link, file_name)
+        return file_id, web_link, file_size, False
+
+def _temp_file_can_fix(error):
+    """
+    串流上傳失敗後，改用暫存檔重新上傳是否有機會成功
+
+    LINE 串流中斷、串流無法倒回重送，或 Drive 暫時性的錯誤（5xx、逾時）才值得重新下載；
+    400、權限、配額、404 等錯誤用暫存檔上傳也會以同樣方式失敗。
+    """
+    return isinstance(error, (StreamSourceError, StreamRewindError)) or is_retryable_error(error)
+
+def transfer_to_drive(message_id, file_name, declared_size=None, folder_path=()):
+    """
+    把 LINE 訊息內容上傳到 Google Drive（folder_path 為上傳資料夾底下的分區資料夾）
+
+    預設把 LINE 的內容串流直接送進 Drive，不落地；已知超過
+    STREAM_UPLOAD_MAX_SIZE 的檔案，或串流途中發生暫存檔能解決的錯誤時，改用暫存檔上傳。
+
+    內容與先前上傳過的檔案相同時（以 SHA-256 與大小比對）不重新上傳，直接回傳既有檔案。
+
+    Returns:
+        Tuple[檔案 ID, 網頁連結, 檔案大小 (bytes), 是否為重複內容]
+    """
+    # Drive 故障中（斷路器開啟）時不必下載內容
+    drive_breaker.ensure_available()
+    if declared_size is not None and declared_size > STREAM_UPLOAD_MAX_SIZE:
+        logger.info(f"💾 檔案較大（{declared_size / (1024 * 1024):.1f} MB），使用暫存檔上傳")
+        return _upload_via_temp_file(message_id, file_name, declared_size, folder_path)
+
+    mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    try:
+        with line_content(message_id) as chunks:
+            media = StreamingMedia(chunks, mime_type, find_duplicate=find_duplicate)
+            file_id, web_link = upload_stream_to_drive(media, file_name, folder_path)
+        if media.duplicate_of:
+            return file_id, web_link, media.bytes_read, True
+        _record_upload(media.sha256, media.bytes_read, file_id, web_link, file_name)
+        return file_id, web_link, media.bytes_read, False
+    except Exception as e:
+        if isinstance(e, DriveUnavailableError) or not _temp_file_can_fix(e):
+            raise
+        logger.warning(f"⚠️ 串流上傳失敗，改用暫存檔重新上傳: {str(e)}")
+        return _upload_via_temp_file(message_id, file_name, declared_size, folder_path)
+
+def transfer_image_to_drive(message_id, file_name, chat_id, folder_path=()):
+    """
+    上傳圖片訊息；聊天室啟用轉檔時，先下載整張圖片在 process pool 中轉檔再上傳
+
+    下載的圖片與其他上傳一樣寫入暫存空間（受 SPOOL_BUDGET_BYTES 限制），大圖片以檔案路徑交給
+    轉檔程序。去重以原始內容比對，相同的圖片再次傳來時不會重新轉檔。
+
+    Returns:
+        Tuple[檔案 ID, 網頁連結, 上傳大小 (bytes), 是否為重複內容, 縮圖網址或 None]
+    """
+    settings = image_transformer.settings_for(chat_id)
+    if settings is None:
+        return (*transfer_to_drive(message_id, file_name, folder_path=folder_path), None)
+
+    drive_breaker.ensure_available()
+    sha256 = hashlib.sha256()
+    with span("spool"), spool.open(os.path.splitext(file_name)[1]) as spooled:
+        with line_content(message_id) as chunks:
+            for chunk in chunks:
+                spooled.write(chunk)
+                sha256.update(chunk)
+        size = spooled.size
+        existing = find_duplicate(sha256.hexdigest(), size)
+        if existing:
+            logger.info(f"♻️ 內容已存在，略過上傳: {existing['file_id']}")
+            return existing['file_id'], existing['web_link'], size, True, None
+
+        with spooled.reader() as original:
+            source = original.getvalue() if spooled.in_memory else spooled.path
+            with span("image.transform", bytes_in=size) as attrs:
+                result = image_transformer.transform(source, size, settings)
+                attrs["bytes_out"] = size if result["data"] is None else len(result["data"])
+            thumbnail_url = None
+            if result["thumbnail"] and thumbnails is not None:
+                thumbnail_url = f"{PUBLIC_BASE_URL}/thumbnails/{thumbnails.put(result['thumbnail'])}"
+            if result["data"] is None:
+                content, content_size = original, size
+            else:
+                content, content_size = io.BytesIO(result["data"]), len(result["data"])
+            file_id, web_link = upload_fileobj_to_drive(
+                content, content_size, file_name, 'image/jpeg', folder_path=folder_path)
+    _record_upload(sha256.hexdigest(), size, file_id, web_link, file_name)
+    return file_id, web_link, content_size, False, thumbnail_url
+
+def _reply_token_usable(event):
+    """reply token 只在收到事件後短時間內有效"""
+    return event.reply_token and time.time() - event.timestamp / 1000 < REPLY_TOKEN_TTL_SECONDS
+
+def _push_retry_key(items, purpose):
+    """
+    由批次中的工作 ID 產生固定的 push retry key（UUID）
+
+    程序在 push 送出後、工作完成前結束時，重啟後重送的回覆帶同一個 key，LINE 不會重複送達。
+    同一批結果的 Flex 與備用文字訊息是不同的訊息，以 purpose 區分。
+    """
+    job_ids = sorted(item["job_id"] for item in items if item.get("job_id") is not None)
+    if not job_ids:
+        return None
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"line-uploader:reply-{','.join(map(str, job_ids))}:{purpose}"))
+
+def send_message(event, message, retry_key=None):
+    """
+    回覆訊息給事件來源
+
+    reply token 仍有效時使用 reply_message；工作排隊或重試太久導致 token 過期時，
+    改用 push_message 傳給原本的使用者或群組。retry_key 相同的 push 已被 LINE 接受時（409）視為已送出。
+    """
+    if _reply_token_usable(event):
+        try:
+            line_client.reply_message_sync(event.reply_token, message)
+            return
+        except LineBotApiError as e:
+            if e.status_code != 400 or 'reply token' not in (e.error.message or '').lower():
+                raise
+            logger.warning(f"⚠️ reply token 已失效，改用 push 傳送")
+    else:
+        logger.info(f"⏰ reply token 已過期，改用 push 傳送")
+    try:
+        line_client.push_message_sync(get_chat_id(event.source), message, retry_key)
+    except LineBotApiError as e:
+        if e.status_code != 409 or retry_key is None:
+            raise
+        logger.info(f"📨 相同 retry key 的訊息已送出過，不重複送出（{e.accepted_request_id}）")
+
+def _queue_reply(event, item, job_id=None):
+    """
+    把結果交給合併器；回覆送出前先把內容存進工作，程序在合併視窗內結束時重啟後仍會送出
+
+    Returns:
+        回覆送出後完成的 Future
+    """
+    if job_id is not None:
+        item["job_id"] = job_id
+        job_store.hold_reply(job_id, item)
+    return reply_coalescer.add(event, get_chat_id(event.source), item)
+
+def reply_upload_result(event, file_name, file_size_bytes, web_link, kind, duplicate=False, thumbnail_url=None,
+                        job_id=None):
+    """把上傳結果交給合併器，同一個聊天室短時間內的結果會合併成一則回覆"""
+    return _queue_reply(event, {
+        "file_name": file_name,
+        "size_bytes": file_size_bytes,
+        "web_link": web_link,
+        "kind": kind,
+        "duplicate": duplicate,
+        "thumbnail_url": thumbnail_url,
+        "uploaded_at": datetime.datetime.now().strftime('%Y/%m/%d %H:%M'),
+        "error": False,
+        "trace_id": current_trace_id(),
+    }, job_id)
+
+def reply_upload_error(event, file_name, error, kind, job_id=None):
+    """記錄上傳失敗並交給合併器回覆；沒有上傳的檔案不佔用配額"""
+    admission.refund(event.message.id)
+    logger.error(f"🚨 {kind}上傳失敗: {str(error)}")
+    logger.debug(f"   錯誤類型: {type(error).__name__}")
+    logger.debug(f"   檔案名稱: {file_name}")
+    return _queue_reply(event, {
+        "file_name": file_name,
+        "kind": kind,
+        "error": True,
+        "trace_id": current_trace_id(),
+    }, job_id)
+
+def _result_bubble(item):
+    if item["error"]:
+        return create_error_bubble(item["file_name"], item["kind"] or "檔案")
+    return create_bubble(item["file_name"], item["size_bytes"] / (1024 * 1024), item["web_link"],
+                         item["uploaded_at"], duplicate=item["duplicate"], thumbnail_url=item["thumbnail_url"])
+
+def send_upload_results(events, items):
+    """
+    送出一批上傳結果
+
+    單筆結果沿用原本的 Flex 或錯誤文字訊息；多筆結果合併成一則 carousel，
+    只用一次 reply（或 push）。Flex 送出失敗時改回覆文字訊息。
+    """
+    # 最新事件的 reply token 最可能仍有效
+    event = max(events, key=lambda e: e.timestamp)
+    # 合併的回覆記在最後一筆結果的 trace 中，其餘結果的 trace ID 記在 links
+    trace_ids = [item["trace_id"] for item in items if item.get("trace_id")]
+    with trace("line.reply", trace_id=trace_ids[-1] if trace_ids else None, items=len(items), links=trace_ids[:-1]):
+        _send_upload_results(event, items)
+
+def _send_upload_results(event, items):
+    if len(items) == 1 and items[0]["error"]:
+        try:
+            send_message(event, TextSendMessage(text=f"❌ {items[0]['kind']}上傳失敗，請聯絡管理員"),
+                         _push_retry_key(items, "error"))
+            logger.info(f"✅ 成功回覆錯誤訊息")
+        except Exception as reply_error:
+            logger.error(f"🚨 回覆錯誤訊息失敗: {str(reply_error)}")
+        return
+
+    with span("flex.build", items=len(items)):
+        if len(items) == 1:
+            item = items[0]
+            flex = create_flex_message(item["file_name"], item["size_bytes"] / (1024 * 1024), item["web_link"],
+                                       item["uploaded_at"], duplicate=item["duplicate"],
+                                       thumbnail_url=item["thumbnail_url"])
+            fallback = f"❌ {item['kind']}上傳成功，但回覆訊息失敗。請聯絡管理員"
+        else:
+            failed = sum(1 for item in items if item["error"])
+            alt_text = f"已上傳 {len(items) - failed} 個檔案" + (f"，{failed} 個失敗" if failed else "")
+            flex = create_carousel_message([_result_bubble(item) for item in items], alt_text)
+            fallback = f"❌ {alt_text}，但回覆訊息失敗。請聯絡管理員"
+
+    logger.debug("📝 準備回覆 Flex 訊息（%d 筆結果）...", len(items))
+    logger.debug("   Flex 內容: %s", flex)
+    
+    try:
+        with stage_timer("flex_reply"), span("line.send"):
+            send_message(event, FlexSendMessage.new_from_json_dict(flex), _push_retry_key(items, "flex"))
+        logger.info("✅ 成功回覆 Flex 訊息")
+    except Exception as e:
+        logger.error(f"❌ Flex 回覆失敗：{e}")
+        logger.debug(f"   錯誤類型: {type(e).__name__}")
+        try:
+            send_message(event, TextSendMessage(text=fallback), _push_retry_key(items, "fallback"))
+            logger.info("✅ 已回覆備用文字訊息")
+        except Exception as backup_error:
+            logger.error(f"🚨 備用訊息也失敗: {str(backup_error)}")
+
+reply_coalescer = ReplyCoalescer(REPLY_COALESCE_WINDOW_MS, REPLY_COALESCE_MAX_ITEMS, send_upload_results)
+
+def handle_file_message(event, can_retry=False, job_id=None):
     # Debug 訊息
     source_type = event.source.type
     user_id = event.source.user_id if hasattr(event.source, 'user_id') else 'N/A'
     group_id = event.source.group_id if hasattr(event.source, 'group_id') else 'N/A'
     
-    print(f"📥 收到 FileMessage")
-    print(f"   檔案名稱: {event.message.file_name}")
-    print(f"   來源類型: {source_type}")
-    print(f"   使用者 ID: {user_id}")
-    print(f"   群組 ID: {group_id}")
+    logger.info(f"📥 收到 FileMessage")
+    logger.debug(f"   檔案名稱: {event.message.file_name}")
+    logger.debug(f"   來源類型: {source_type}")
+    logger.debug(f"   使用者 ID: {user_id}")
+    logger.debug(f"   群組 ID: {group_id}")
     
     file_name = event.message.file_name
-    file_content = line_bot_api.get_message_content(event.message.id)
     
     try:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            for chunk in file_content.iter_content():
-                tmp.write(chunk)
-            tmp_path = tmp.name
-
-        file_size = os.path.getsize(tmp_path) / (1024 * 1024)  # MB
-        uploaded_at = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
-        
-        print(f"📤 開始上傳檔案: {file_name}")
-        file_id, web_link = upload_file_to_drive(tmp_path, file_name)
-        flex = create_flex_message(file_name, file_size, web_link, uploaded_at)
-
-        print(f"📝 準備回覆 Flex 訊息...")
-        print(f"   Flex 內容: {flex}")
-        
-        try:
-            line_bot_api.reply_message(event.reply_token, FlexSendMessage.new_from_json_dict(flex))
-            print("✅ 成功回覆 Flex 訊息")
-        except Exception as e:
-            print(f"❌ Flex 回覆失敗：{e}")
-            print(f"   錯誤類型: {type(e).__name__}")
-            try:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 上傳成功，但回覆訊息失敗。請聯絡管理員"))
-                print("✅ 已回覆備用文字訊息")
-            except Exception as backup_error:
-                print(f"🚨 備用訊息也失敗: {str(backup_error)}")
-        
+        logger.info(f"📤 開始上傳檔案: {file_name}")
+        file_id, web_link, file_size, duplicate = transfer_to_drive(
+            event.message.id, file_name, event.message.file_size, upload_folder_path(event))
+        UPLOADS_TOTAL.inc(kind="file", result="duplicate" if duplicate else "success")
+        return reply_upload_result(event, file_name, file_size, web_link, "", duplicate, job_id=job_id)
+    except DriveUnavailableError as e:
+        logger.warning(f"🔌 Drive 暫時無法使用，工作留在佇列: {file_name}")
+        raise JobDeferred(str(e)) from e
+    except SpoolFullError as e:
+        if can_retry:
+            logger.warning(f"⏳ 暫存空間不足，稍後重試: {file_name}")
+            raise
+        UPLOADS_TOTAL.inc(kind="file", result="error")
+        return reply_upload_error(event, file_name, e, "檔案", job_id)
     except Exception as e:
-        error_msg = f"❌ 檔案上傳失敗，請聯絡管理員"
-        print(f"🚨 上傳失敗: {str(e)}")
-        print(f"   錯誤類型: {type(e).__name__}")
-        print(f"   檔案名稱: {file_name}")
-        
-        try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=error_msg))
-            print(f"✅ 成功回覆錯誤訊息")
-        except Exception as reply_error:
-            print(f"🚨 回覆錯誤訊息失敗: {str(reply_error)}")
-    
-    finally:
-        # 清理臨時檔案
-        if 'tmp_path' in locals():
-            try:
-                os.remove(tmp_path)
-                print(f"🧹 已清理臨時檔案: {tmp_path}")
-            except Exception as cleanup_error:
-                print(f"⚠️ 清理臨時檔案失敗: {str(cleanup_error)}")
+        UPLOADS_TOTAL.inc(kind="file", result="error")
+        return reply_upload_error(event, file_name, e, "檔案", job_id)
 
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event):
+def handle_image_message(event, can_retry=False, job_id=None):
     # Debug 訊息
     source_type = event.source.type
     user_id = event.source.user_id if hasattr(event.source, 'user_id') else 'N/A'
     group_id = event.source.group_id if hasattr(event.source, 'group_id') else 'N/A'
     
-    print(f"📸 收到 ImageMessage")
-    print(f"   來源類型: {source_type}")
-    print(f"   使用者 ID: {user_id}")
-    print(f"   群組 ID: {group_id}")
+    logger.info(f"📸 收到 ImageMessage")
+    logger.debug(f"   來源類型: {source_type}")
+    logger.debug(f"   使用者 ID: {user_id}")
+    logger.debug(f"   群組 ID: {group_id}")
     
     # 為圖片生成檔案名稱（使用時間戳記）
     timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    file_name = f"LINE_圖片_{timestamp}.jpg"
+    image_set = getattr(event.message, 'image_set', None)
+    if image_set is not None and image_set.index:
+        # 同一批傳送的圖片通常在同一秒內處理，加上序號避免同名
+        file_name = f"LINE_圖片_{timestamp}_{image_set.index}.jpg"
+    else:
+        file_name = f"LINE_圖片_{timestamp}.jpg"
     
     try:
-        # 下載圖片內容
-        image_content = line_bot_api.get_message_content(event.message.id)
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
-            for chunk in image_content.iter_content():
-                tmp.write(chunk)
-            tmp_path = tmp.name
-
-        file_size = os.path.getsize(tmp_path) / (1024 * 1024)  # MB
-        uploaded_at = datetime.datetime.now().strftime('%Y/%m/%d %H:%M')
-        
-        print(f"📤 開始上傳圖片: {file_name}")
-        file_id, web_link = upload_file_to_drive(tmp_path, file_name)
-        flex = create_flex_message(file_name, file_size, web_link, uploaded_at)
-
-        print(f"📝 準備回覆 Flex 訊息...")
-        print(f"   Flex 內容: {flex}")
-        
-        try:
-            line_bot_api.reply_message(event.reply_token, FlexSendMessage.new_from_json_dict(flex))
-            print("✅ 成功回覆 Flex 訊息")
-        except Exception as e:
-            print(f"❌ Flex 回覆失敗：{e}")
-            print(f"   錯誤類型: {type(e).__name__}")
-            try:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 圖片上傳成功，但回覆訊息失敗。請聯絡管理員"))
-                print("✅ 已回覆備用文字訊息")
-            except Exception as backup_error:
-                print(f"🚨 備用訊息也失敗: {str(backup_error)}")
-        
+        logger.info(f"📤 開始上傳圖片: {file_name}")
+        file_id, web_link, file_size, duplicate, thumbnail_url = transfer_image_to_drive(
+            event.message.id, file_name, get_chat_id(event.source), upload_folder_path(event))
+        UPLOADS_TOTAL.inc(kind="image", result="duplicate" if duplicate else "success")
+        return reply_upload_result(event, file_name, file_size, web_link, "圖片", duplicate, thumbnail_url,
+                                   job_id=job_id)
+    except DriveUnavailableError as e:
+        logger.warning(f"🔌 Drive 暫時無法使用，工作留在佇列: {file_name}")
+        raise JobDeferred(str(e)) from e
+    except SpoolFullError as e:
+        if can_retry:
+            logger.warning(f"⏳ 暫存空間不足，稍後重試: {file_name}")
+            raise
+        UPLOADS_TOTAL.inc(kind="image", result="error")
+        return reply_upload_error(event, file_name, e, "圖片", job_id)
     except Exception as e:
-        error_msg = f"❌ 圖片上傳失敗，請聯絡管理員"
-        print(f"🚨 圖片上傳失敗: {str(e)}")
-        print(f"   錯誤類型: {type(e).__name__}")
-        print(f"   檔案名稱: {file_name}")
-        
-        try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=error_msg))
-            print(f"✅ 成功回覆錯誤訊息")
-        except Exception as reply_error:
-            print(f"🚨 回覆錯誤訊息失敗: {str(reply_error)}")
-    
-    finally:
-        # 清理臨時檔案
-        if 'tmp_path' in locals():
-            try:
-                os.remove(tmp_path)
-                print(f"🧹 已清理臨時圖片檔案: {tmp_path}")
-            except Exception as cleanup_error:
-                print(f"⚠️ 清理臨時圖片檔案失敗: {str(cleanup_error)}") 
\ No newline at end of file
+        UPLOADS_TOTAL.inc(kind="image", result="error")
+        return reply_upload_error(event, file_name, e, "圖片", job_id)
@@ -1,33 +1,78 @@
-def create_flex_message(file_name, file_size_mb, web_link, uploaded_at):
+def create_bubble(file_name, file_size_mb, web_link, uploaded_at, duplicate=False, thumbnail_url=None):
+    body_contents = [
+        {"type": "text", "text": "☁️ 已上傳雲端", "weight": "bold", "size": "xl"},
+        {"type": "text", "text": f"檔案名稱：{file_name}", "wrap": True},
+        {"type": "text", "text": f"大小：{file_size_mb:.2f} MB"},
+        {"type": "text", "text": f"上傳時間：{uploaded_at}"}
+    ]
+    if duplicate:
+        # 相同內容已上傳過，連結指向既有檔案
+        body_contents.append({"type": "text", "text": "♻️ 相同檔案已在雲端，直接提供既有連結", "size": "sm", "wrap": True})
+    bubble = {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": body_contents
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "primary",
+                    "action": {
+                        "type": "uri",
+                        "label": "開啟檔案",
+                        "uri": web_link
+                    }
+                }
+            ]
+        }
+    }
+    if thumbnail_url:
+        # 圖片縮圖，點擊開啟檔案
+        bubble["hero"] = {
+            "type": "image",
+            "url": thumbnail_url,
+            "size": "full",
+            "aspectRatio": "20:13",
+            "aspectMode": "cover",
+            "action": {"type": "uri", "uri": web_link}
+        }
+    return bubble
+
+def create_error_bubble(file_name, kind):
+    """上傳失敗的 bubble（放在 carousel 中，沒有開啟按鈕）"""
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": f"❌ {kind}上傳失敗", "weight": "bold", "size": "xl"},
+                {"type": "text", "text": f"檔案名稱：{file_name}", "wrap": True},
+                {"type": "text", "text": "請稍後重新傳送，或聯絡管理員", "size": "sm", "wrap": True}
+            ]
+        }
+    }
+
+def create_flex_message(file_name, file_size_mb, web_link, uploaded_at, duplicate=False, thumbnail_url=None):
     return {
         "type": "flex",
         "altText": f"已上傳檔案：{file_name}",
+        "contents": create_bubble(file_name, file_size_mb, web_link, uploaded_at, duplicate=duplicate,
+                                  thumbnail_url=thumbnail_url)
+    }
+
+def create_carousel_message(bubbles, alt_text):
+    """把多個 bubble 合併成一則 carousel（最多 12 個）"""
+    return {
+        "type": "flex",
+        "altText": alt_text,
         "contents": {
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": "☁️ 已上傳雲端", "weight": "bold", "size": "xl"},
-                    {"type": "text", "text": f"檔案名稱：{file_name}"},
-                    {"type": "text", "text": f"大小：{file_size_mb:.2f} MB"},
-                    {"type": "text", "text": f"上傳時間：{uploaded_at}"}
-                ]
-            },
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "button",
-                        "style": "primary",
-                        "action": {
-                            "type": "uri",
-                            "label": "開啟檔案",
-                            "uri": web_link
-                        }
-                    }
-                ]
-            }
+            "type": "carousel",
+            "contents": bubbles[:12]
         }
-    } 
\ No newline at end of file
+    }
@@ -0,0 +1,230 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# 各階段延遲的 histogram 區間（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.label_names and self.type_name != "histogram":
+            # 沒有標籤的 counter／gauge 一開始就輸出 0
+            self._values[()] = 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} 需要標籤 {self.label_names}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+
+class Counter(_Metric):
+    """只增不減的計數器"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可減的量測值；也可以給定 callback 在輸出時即時取值"""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        super().__init__(name, documentation, label_names)
+        self._callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        """進入時 +1、離開時 -1"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self):
+        if self._callback is not None:
+            try:
+                self.set(self._callback())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(_Metric):
+    """延遲分佈"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """量測 with 區塊的執行時間"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, state):
+        lines = []
+        for bound, count in zip(self.buckets, state["buckets"]):
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', bound))} {count}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', '+Inf'))} {state['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {state['sum']}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state['count']}")
+        return lines
+
+
+class Registry:
+    """收集所有 metric，輸出 Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=(), callback=None):
+        return self._register(Gauge(name, documentation, label_names, callback))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 上傳流程各階段：webhook_parse、line_download、folder_lookup、drive_upload、flex_reply
+STAGE_SECONDS = REGISTRY.histogram(
+    "line_uploader_stage_seconds", "各處理階段耗時（秒）", ["stage"])
+STAGE_ERRORS = REGISTRY.counter(
+    "line_uploader_errors_total", "各處理階段的錯誤次數（依例外類型）", ["stage", "exception"])
+EVENTS_RECEIVED = REGISTRY.counter(
+    "line_uploader_webhook_events_total", "收到的 webhook 事件數", ["type"])
+DOWNLOADED_BYTES = REGISTRY.counter(
+    "line_uploader_line_download_bytes_total", "從 LINE 下載的位元組數")
+UPLOADED_BYTES = REGISTRY.counter(
+    "line_uploader_drive_upload_bytes_total", "上傳到 Drive 的位元組數")
+UPLOADS_TOTAL = REGISTRY.counter(
+    "line_uploader_uploads_total", "完成的上傳數", ["kind", "result"])
+UPLOADS_IN_FLIGHT = REGISTRY.gauge(
+    "line_uploader_uploads_in_flight", "處理中的上傳數")
+
+
+@contextmanager
+def stage_timer(stage):
+    """量測一個階段的耗時，發生例外時依類型計數"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=stage, exception=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+class TimedIterator:
+    """包裝 bytes 區塊的 iterator，累計等待來源的時間與位元組數"""
+
+    def __init__(self, chunks, stage=None):
+        self._chunks = iter(chunks)
+        self._stage = stage
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            raise
+        except Exception as e:
+            if self._stage:
+                STAGE_ERRORS.inc(stage=self._stage, exception=type(e).__name__)
+            raise
+        finally:
+            self.seconds += time.perf_counter() - started
+        self.bytes += len(chunk)
+        return chunk
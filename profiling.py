@@ -0,0 +1,121 @@
+import collections
+import cProfile
+import datetime
+import logging
+import os
+import random
+import re
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE_CHARS = re.compile(r"[^0-9A-Za-z_-]")
+
+
+class SamplingProfiler:
+    """
+    依取樣率以 cProfile 量測背景工作，結果存成 .prof 檔供離線分析
+
+    預設關閉，由管理 API 開啟；存滿 max_profiles 個檔案後自動關閉。cProfile 同時只能有一個
+    在執行，取樣到的工作遇到另一個正在量測的工作時略過。
+
+        python -m pstats profiles/20240101-120000-<trace>.prof
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._running = threading.Lock()
+        self._enabled = False
+        self._sample_rate = 0.1
+        self._remaining = 0
+        self._profiled = 0
+        self._skipped_busy = 0
+        self._recent = collections.deque(maxlen=50)
+
+    def configure(self, enabled: bool = None, sample_rate: float = None, max_profiles: int = None) -> dict:
+        """
+        變更設定
+
+        Args:
+            enabled: 是否開啟
+            sample_rate: 取樣比例（0～1）
+            max_profiles: 開啟後最多存幾個檔案
+        """
+        with self._lock:
+            if sample_rate is not None:
+                self._sample_rate = min(1.0, max(0.0, sample_rate))
+            if max_profiles is not None:
+                self._remaining = max(0, max_profiles)
+            if enabled is not None:
+                self._enabled = enabled
+                if enabled and not self._remaining:
+                    self._remaining = 20
+        logger.info(f"🔬 Profiling {'開啟' if self._enabled else '關閉'}（取樣 {self._sample_rate:.0%}，"
+                    f"最多 {self._remaining} 個）")
+        return self.stats()
+
+    def _should_sample(self):
+        with self._lock:
+            return self._enabled and random.random() < self._sample_rate
+
+    def _claim(self):
+        # 取得 _running 之後才扣除額度：因為忙碌而略過的取樣不會用掉 max_profiles
+        with self._lock:
+            if not self._enabled or self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self._enabled = False
+            return True
+
+    @contextmanager
+    def maybe_profile(self, label: str):
+        """依取樣率量測這段程式（只量測目前的執行緒）"""
+        if not self._should_sample():
+            yield
+            return
+        if not self._running.acquire(blocking=False):
+            with self._lock:
+                self._skipped_busy += 1
+            yield
+            return
+        try:
+            if not self._claim():
+                yield
+                return
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                self._dump(profiler, label)
+        finally:
+            self._running.release()
+
+    def _dump(self, profiler, label):
+        name = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{_UNSAFE_CHARS.sub('_', label)[:64]}.prof"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.directory, name))
+        except Exception as e:
+            logger.warning(f"⚠️ 儲存 profile 失敗: {str(e)}")
+            return
+        with self._lock:
+            self._profiled += 1
+            self._recent.append(name)
+        logger.info(f"🔬 已儲存 profile: {name}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self._enabled,
+                "sample_rate": self._sample_rate,
+                "remaining": self._remaining,
+                "profiled": self._profiled,
+                "skipped_busy": self._skipped_busy,
+                "directory": self.directory,
+                "recent": list(self._recent),
+            }
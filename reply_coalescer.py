@@ -0,0 +1,135 @@
+import logging
+import threading
+from concurrent.futures import Future
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+REPLY_BATCHES = REGISTRY.counter("line_uploader_reply_batches_total", "送出的上傳結果回覆數（合併後）")
+REPLY_BATCH_ITEMS = REGISTRY.counter("line_uploader_reply_batch_items_total", "合併進回覆的上傳結果數")
+
+# Flex carousel 最多 12 個 bubble
+MAX_CAROUSEL_ITEMS = 12
+
+
+class _Batch:
+    def __init__(self, key, expected=None):
+        self.key = key
+        self.expected = expected
+        self.events = []
+        self.items = []
+        self.deliveries = []
+        self.timer = None
+
+
+class ReplyCoalescer:
+    """
+    把同一個聊天室短時間內完成的上傳結果合併成一則回覆
+
+    第一個結果進來後開始計時，視窗結束或累積到 max_items 筆時一次送出。
+    同一個圖片集（image set）的圖片另外分組：每收到一張就重新計時，
+    收齊 total 張時立即送出。
+
+    add() 回傳的 Future 在這筆結果送出（或送出失敗）後完成，呼叫端可以等到那時
+    才把工作標記為完成。
+    """
+
+    def __init__(self, window_ms: int, max_items: int, send_batch):
+        """
+        Args:
+            window_ms: 合併視窗（毫秒）；0 代表不合併，每個結果立即送出
+            max_items: 單一回覆的結果數上限（最多 12，Flex carousel 的限制）
+            send_batch: 送出一批結果的函式，參數為 (events, items)
+        """
+        self._window = window_ms / 1000
+        self._max_items = max(1, min(max_items, MAX_CAROUSEL_ITEMS))
+        self._send_batch = send_batch
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _group(event, chat_id):
+        image_set = getattr(event.message, "image_set", None)
+        if image_set is not None and image_set.id:
+            return ("image_set", chat_id, image_set.id), image_set.total
+        return ("chat", chat_id), None
+
+    def add(self, event, chat_id: str, item: dict):
+        """
+        加入一筆上傳結果
+
+        Args:
+            event: 原始的 MessageEvent（用來回覆或推播）
+            chat_id: 聊天室 ID
+            item: 上傳結果（交給 send_batch 組訊息）
+
+        Returns:
+            這筆結果送出後完成的 Future
+        """
+        delivery = Future()
+        if self._window <= 0:
+            self._send([event], [item], [delivery])
+            return delivery
+        key, expected = self._group(event, chat_id)
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch(key, expected)
+                self._arm(batch)
+            elif key[0] == "image_set":
+                # 圖片集的圖片可能分散在不同 worker，每收到一張就延長等待
+                batch.timer.cancel()
+                self._arm(batch)
+            batch.events.append(event)
+            batch.items.append(item)
+            batch.deliveries.append(delivery)
+            full = len(batch.items) >= self._max_items or (
+                batch.expected is not None and len(batch.items) >= batch.expected)
+            if full:
+                batch.timer.cancel()
+                del self._batches[key]
+        if full:
+            self._send(batch.events, batch.items, batch.deliveries)
+        return delivery
+
+    def _arm(self, batch):
+        batch.timer = threading.Timer(self._window, self._flush, args=(batch,))
+        batch.timer.daemon = True
+        batch.timer.start()
+
+    def _flush(self, batch):
+        with self._lock:
+            if self._batches.get(batch.key) is not batch:
+                return
+            del self._batches[batch.key]
+        self._send(batch.events, batch.items, batch.deliveries)
+
+    def _send(self, events, items, deliveries):
+        REPLY_BATCHES.inc()
+        REPLY_BATCH_ITEMS.inc(len(items))
+        try:
+            self._send_batch(events, items)
+        except Exception as e:
+            logger.error(f"🚨 送出合併回覆失敗: {str(e)}")
+        finally:
+            for delivery in deliveries:
+                delivery.set_result(None)
+
+    def flush_all(self):
+        """立即送出所有等待中的結果（服務關閉時使用）"""
+        with self._lock:
+            batches = list(self._batches.values())
+            self._batches.clear()
+        for batch in batches:
+            batch.timer.cancel()
+            self._send(batch.events, batch.items, batch.deliveries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = sum(len(batch.items) for batch in self._batches.values())
+            return {
+                "window_ms": int(self._window * 1000),
+                "max_items": self._max_items,
+                "open_batches": len(self._batches),
+                "pending_items": pending,
+            }
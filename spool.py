@@ -0,0 +1,317 @@
+import io
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DISK_BYTES = REGISTRY.gauge("line_uploader_spool_disk_bytes", "暫存目錄中預留給進行中檔案的位元組數")
+SPOOL_MEMORY_BYTES = REGISTRY.gauge("line_uploader_spool_memory_bytes", "保留在記憶體中的暫存內容位元組數")
+SPOOL_FILES = REGISTRY.gauge("line_uploader_spool_files", "進行中的暫存檔數（含記憶體中的）", ["storage"])
+SPOOL_WAITS = REGISTRY.counter("line_uploader_spool_waits_total", "因暫存空間不足而等待的次數")
+SPOOL_REJECTED = REGISTRY.counter("line_uploader_spool_rejected_total", "等待逾時仍無暫存空間而放棄的次數")
+SPOOL_ORPHANS_REMOVED = REGISTRY.counter("line_uploader_spool_orphans_removed_total", "清除的遺留暫存檔數")
+
+# 檔名帶有建立者的 PID，清理時可判斷建立者是否還在執行
+_SPOOL_NAME = re.compile(r"^spool-(\d+)-[0-9a-f]{32}")
+
+# 大小未知的內容每次多預留的空間
+_RESERVE_STEP = 8 * 1024 * 1024
+
+
+class SpoolFullError(Exception):
+    """暫存空間預算已滿，等待逾時"""
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SpoolFile:
+    """
+    暫存內容：小於記憶體門檻時留在記憶體，超過時寫入暫存目錄
+
+    由 SpoolManager.open() 建立；寫完後用 reader() 讀回，close() 時刪除檔案並歸還預算。
+    """
+
+    def __init__(self, manager, suffix, expected_size):
+        self._manager = manager
+        self._suffix = suffix
+        self._buffer = io.BytesIO()
+        self._file = None
+        self.path = None
+        self.size = 0
+        self._reserved = 0
+        self._closed = False
+        SPOOL_FILES.inc(storage="memory")
+        if expected_size is not None and expected_size > manager.memory_threshold:
+            # 已知會超過門檻的內容直接寫入磁碟，一開始就預留全部空間
+            try:
+                self._roll_over(expected_size)
+            except BaseException:
+                self.close()
+                raise
+
+    @property
+    def in_memory(self) -> bool:
+        return self._buffer is not None
+
+    def _roll_over(self, reserve):
+        self._reserve(reserve)
+        self.path = self._manager._new_path(self._suffix)
+        self._file = open(self.path, "wb")
+        buffered = self._buffer.getvalue()
+        self._file.write(buffered)
+        SPOOL_MEMORY_BYTES.dec(len(buffered))
+        self._buffer = None
+        SPOOL_FILES.dec(storage="memory")
+        SPOOL_FILES.inc(storage="disk")
+
+    def _reserve(self, total):
+        if total > self._reserved:
+            self._manager._acquire(total - self._reserved)
+            self._reserved = total
+
+    def write(self, data: bytes):
+        if self.in_memory:
+            if self.size + len(data) <= self._manager.memory_threshold:
+                self._buffer.write(data)
+                SPOOL_MEMORY_BYTES.inc(len(data))
+                self.size += len(data)
+                return
+            self._roll_over(self.size + len(data) + _RESERVE_STEP)
+        elif self.size + len(data) > self._reserved:
+            # 實際內容比宣告的大，或大小未知：再多預留一段
+            self._reserve(self.size + len(data) + _RESERVE_STEP)
+        self._file.write(data)
+        self.size += len(data)
+
+    def reader(self):
+        """結束寫入，回傳從頭讀取內容的檔案物件（由呼叫端關閉）"""
+        if self.in_memory:
+            return io.BytesIO(self._buffer.getvalue())
+        self._file.close()
+        return open(self.path, "rb")
+
+    def close(self):
+        """刪除暫存內容並歸還預算"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.in_memory:
+            SPOOL_MEMORY_BYTES.dec(self.size)
+            SPOOL_FILES.dec(storage="memory")
+            self._buffer = None
+            if self.path is not None:
+                # 轉存到磁碟途中失敗；留下的檔案由背景清理
+                if self._file is not None:
+                    self._file.close()
+                self._manager._forget(self.path)
+        else:
+            self._file.close()
+            try:
+                os.remove(self.path)
+                logger.debug(f"🧹 已清理暫存檔: {self.path}")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"⚠️ 清理暫存檔失敗（之後由背景清理）: {str(e)}")
+            SPOOL_FILES.dec(storage="disk")
+            self._manager._forget(self.path)
+        self._manager._release(self._reserved)
+        self._reserved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpoolManager:
+    """
+    上傳用暫存空間的管理
+
+    - 小於 memory_threshold 的內容留在記憶體，不落地
+    - 其餘寫入專用的暫存目錄；所有進行中檔案預留的空間合計不超過 budget_bytes，
+      不足時等待其他上傳完成，等待逾時則丟出 SpoolFullError
+    - 預算只在本程序內計算；多個 worker 共用同一目錄時各自擁有一份 budget_bytes
+    - 背景執行緒定期清除崩潰的程序留下的暫存檔
+    """
+
+    def __init__(self, directory: str, budget_bytes: int, memory_threshold: int, wait_seconds: float,
+                 orphan_age_seconds: int, sweep_interval: int):
+        """
+        Args:
+            directory: 暫存目錄
+            budget_bytes: 暫存目錄的位元組預算（0 代表不限制）
+            memory_threshold: 小於此大小的內容留在記憶體（bytes）
+            wait_seconds: 預算不足時最多等待的秒數
+            orphan_age_seconds: 不屬於任何執行中程序、且超過此秒數未修改的檔案視為遺留檔
+            sweep_interval: 背景清理的間隔秒數
+        """
+        self.directory = directory
+        self.memory_threshold = memory_threshold
+        self._budget = budget_bytes
+        self._wait_seconds = wait_seconds
+        self._orphan_age = orphan_age_seconds
+        self._sweep_interval = sweep_interval
+        self._reserved = 0
+        self._active = set()
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._sweeper = None
+        self._waits = 0
+        self._rejected = 0
+        self._orphans_removed = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, suffix: str = "", expected_size: int = None) -> SpoolFile:
+        """
+        建立暫存內容
+
+        Args:
+            suffix: 暫存檔副檔名
+            expected_size: 預期大小（bytes）；已知超過記憶體門檻時直接預留磁碟空間
+
+        Raises:
+            SpoolFullError: 等待逾時仍無足夠的暫存空間
+        """
+        return SpoolFile(self, suffix, expected_size)
+
+    def _new_path(self, suffix):
+        path = os.path.join(self.directory, f"spool-{os.getpid()}-{uuid.uuid4().hex}{suffix}")
+        with self._condition:
+            # 先登記再建立檔案，背景清理不會刪到正在寫入的檔案
+            self._active.add(path)
+        return path
+
+    def _forget(self, path):
+        with self._condition:
+            self._active.discard(path)
+
+    def _acquire(self, amount):
+        if not self._budget:
+            with self._condition:
+                self._reserved += amount
+            SPOOL_DISK_BYTES.inc(amount)
+            return
+        if amount > self._budget:
+            self._reject(f"需要 {amount} bytes，超過暫存預算 {self._budget} bytes")
+        deadline = time.monotonic() + self._wait_seconds
+        with self._condition:
+            if self._reserved + amount > self._budget:
+                self._waits += 1
+                SPOOL_WAITS.inc()
+                logger.info(f"⏳ 暫存空間不足，等待其他上傳完成（需要 {amount / (1024 * 1024):.1f} MB）")
+            while self._reserved + amount > self._budget:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._reject(f"等待 {self._wait_seconds:.0f} 秒後暫存空間仍不足")
+                self._condition.wait(remaining)
+            self._reserved += amount
+        SPOOL_DISK_BYTES.inc(amount)
+
+    def _reject(self, reason):
+        self._rejected += 1
+        SPOOL_REJECTED.inc()
+        raise SpoolFullError(reason)
+
+    def _release(self, amount):
+        if not amount:
+            return
+        with self._condition:
+            self._reserved -= amount
+            self._condition.notify_all()
+        SPOOL_DISK_BYTES.dec(amount)
+
+    def sweep(self) -> int:
+        """
+        清除遺留的暫存檔
+
+        本程序建立但已不在使用中、或建立者已不在執行的檔案立即清除；
+        無法判斷建立者的檔案在超過 orphan_age_seconds 未修改後清除。
+
+        Returns:
+            清除的檔案數
+        """
+        removed = 0
+        now = time.time()
+        own_pid = os.getpid()
+        with self._condition:
+            active = set(self._active)
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.path in active:
+                continue
+            match = _SPOOL_NAME.match(entry.name)
+            try:
+                if match:
+                    pid = int(match.group(1))
+                    if pid != own_pid and _pid_alive(pid):
+                        continue
+                    # 本程序的檔案在登記後才建立，不在 active 代表已遺留；
+                    # 重新確認一次，避免與剛完成的上傳競爭
+                    with self._condition:
+                        if entry.path in self._active:
+                            continue
+                elif now - entry.stat().st_mtime < self._orphan_age:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning(f"⚠️ 清除遺留暫存檔失敗: {entry.name} ({str(e)})")
+                continue
+            removed += 1
+            logger.info(f"🧹 清除遺留暫存檔: {entry.name}")
+        if removed:
+            self._orphans_removed += removed
+            SPOOL_ORPHANS_REMOVED.inc(removed)
+        return removed
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self._sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"⚠️ 暫存目錄清理失敗: {str(e)}")
+
+    def start(self):
+        """清除上次崩潰留下的暫存檔並啟動背景清理"""
+        try:
+            self.sweep()
+        except Exception as e:
+            logger.warning(f"⚠️ 暫存目錄清理失敗: {str(e)}")
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="spool-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def stats(self) -> dict:
+        """暫存空間狀態"""
+        with self._condition:
+            return {
+                "directory": self.directory,
+                "budget_bytes": self._budget,
+                "reserved_bytes": self._reserved,
+                "active_files": len(self._active),
+                "memory_threshold": self.memory_threshold,
+                "waits": self._waits,
+                "rejected": self._rejected,
+                "orphans_removed": self._orphans_removed,
+            }
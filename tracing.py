@@ -0,0 +1,112 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from config import TRACE_EXPORT_PATH
+
+logger = logging.getLogger(__name__)
+
+# 目前的 (trace ID, span ID)；asyncio task 與 asyncio.to_thread 會自動帶著，
+# 其他執行緒（上傳 worker、回覆合併器）要自己開始新的 trace
+_current = contextvars.ContextVar("line_uploader_span", default=None)
+
+
+class SpanExporter:
+    """把結束的 span 逐行寫成 JSON Lines（path 為空時不輸出）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self.exported = 0
+
+    def export(self, record: dict):
+        if not self.path:
+            return
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                if self._file is None:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(line + "\n")
+                self._file.flush()
+                self.exported += 1
+            except Exception as e:
+                logger.warning(f"⚠️ 寫入 span 失敗: {str(e)}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+exporter = SpanExporter(TRACE_EXPORT_PATH)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+def current_trace_id():
+    """目前的 trace ID；不在任何 trace 中時回傳 None"""
+    current = _current.get()
+    return current[0] if current else None
+
+
+@contextmanager
+def span(name: str, trace_id: str = None, **attrs):
+    """
+    記錄一個階段的耗時
+
+    指定 trace_id 時開始一個新的 trace（此 span 為根）；否則成為目前 span 的子 span，
+    不在任何 trace 中時不記錄。回傳的字典可以再加入屬性（例如位元組數）。
+
+    Args:
+        name: 階段名稱，例如 drive.upload
+        trace_id: 開始新 trace 時使用的 ID
+        attrs: 要記錄的屬性
+    """
+    parent = _current.get()
+    if trace_id is None:
+        if parent is None:
+            yield attrs
+            return
+        trace_id, parent_id = parent
+    else:
+        parent_id = None
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set((trace_id, span_id))
+    started_at = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"[:300]
+        raise
+    finally:
+        _current.reset(token)
+        exporter.export({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "start": round(started_at, 6),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+            "error": error,
+        })
+
+
+def trace(name: str, trace_id: str = None, **attrs):
+    """開始一個新的 trace（未指定 trace_id 時自動產生）"""
+    return span(name, trace_id=trace_id or new_trace_id(), **attrs)
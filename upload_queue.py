@@ -0,0 +1,241 @@
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobDeferred(Exception):
+    """工作暫時無法處理（例如 Drive 斷路器開啟），放回佇列稍後再處理，不計入嘗試次數"""
+
+
+class UploadQueue:
+    """
+    上傳工作佇列
+
+    /callback 只負責驗證簽章並把事件寫入 JobStore，由固定數量的 worker
+    在背景執行緒中處理下載、上傳與回覆，避免阻塞 event loop。
+    工作存放在磁碟上，程序重啟後會接續處理未完成的工作。
+
+    JobStore 是同步的 SQLite（寫入競爭時可能等待鎖），所有存取都交給執行緒，不在 event loop 上執行。
+    """
+
+    # 沒有收到新工作通知時，多久檢查一次資料庫（其他程序寫入的工作）
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, process, store, workers: int, retention_seconds: int, gate=None, redeliver=None):
+        """
+        Args:
+            process: 處理單一工作的同步函式，參數為 JobStore.claim() 回傳的字典；
+                丟出 JobDeferred 時工作放回佇列。回傳 concurrent.futures.Future 代表回覆還沒送出
+                （工作已由 process 以 JobStore.hold_reply() 保存回覆），Future 完成後才標記完成
+            store: JobStore
+            workers: 同時處理的 worker 數量（並行上限）
+            retention_seconds: 已完成工作紀錄的保留秒數
+            gate: 回傳 False 時暫停取出新工作的函式（例如 Drive 斷路器開啟時）
+            redeliver: 重新送出回覆的同步函式，參數為 JobStore.claim_replies() 回傳的字典，
+                回傳送出後完成的 Future；用於送出回覆前程序就結束的工作
+        """
+        self._process = process
+        self._gate = gate
+        self._redeliver = redeliver
+        self._store = store
+        self._workers = max(1, workers)
+        self._retention_seconds = retention_seconds
+        self._tasks = []
+        self._recovery_task = None
+        self._deliveries = set()
+        self._stopping = False
+        self._executor = None
+        self._wakeup = None
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._recovered = 0
+        self._deferred = 0
+
+    async def start(self):
+        """崩潰復原並啟動 worker"""
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="upload-worker")
+        await self._recover_all()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        self._recovery_task = asyncio.create_task(self._recovery_loop())
+        logger.info(f"🧵 已啟動 {self._workers} 個上傳 worker")
+
+    async def stop(self, flush=None):
+        """
+        停止取出新工作，並等待執行中的工作結束
+
+        執行中的工作完成後仍會標記為完成，重啟後不會被當成中斷的工作再處理一次（重複回覆）。
+
+        Args:
+            flush: worker 結束後呼叫的同步函式，立即送出還在等待的回覆（例如合併器的 flush_all）
+        """
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._recovery_task is not None:
+            self._recovery_task.cancel()
+            await asyncio.gather(self._recovery_task, return_exceptions=True)
+            self._recovery_task = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if flush is not None:
+            await asyncio.to_thread(flush)
+        # 等回覆送出、工作標記完成
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._executor:
+            # 在另一個執行緒等待，執行中的工作可能還需要 event loop（例如串流下載 LINE 內容）
+            await asyncio.to_thread(self._executor.shutdown, wait=True)
+            self._executor = None
+
+    async def depth(self) -> int:
+        """待處理的工作數"""
+        return await asyncio.to_thread(self._store.depth)
+
+    async def submit(self, payload: dict, **meta) -> Optional[int]:
+        """
+        寫入一個工作並喚醒 worker
+
+        Args:
+            payload: 工作內容（可序列化為 JSON）
+            meta: message_id、source_type、source_id、user_id、event_keys 等索引欄位
+
+        Returns:
+            工作 ID；事件已處理過（event_keys 重複）時回傳 None
+        """
+        job_id = await asyncio.to_thread(self._store.enqueue, payload, **meta)
+        if job_id is not None and self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def reject(self, count: int = 1):
+        """記錄因佇列積壓（降載）而被拒絕的工作數"""
+        self._rejected += count
+
+    def stats(self) -> dict:
+        """佇列狀態（會查詢 JobStore，在 event loop 中請以 asyncio.to_thread 呼叫）"""
+        return {
+            "workers": self._workers,
+            "depth": self._store.depth(),
+            "in_flight": self._in_flight,
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "recovered": self._recovered,
+            "deferred": self._deferred,
+            "awaiting_reply": len(self._deliveries),
+            "jobs": self._store.counts(),
+        }
+
+    def _recover(self):
+        recovered = self._store.recover(self._retention_seconds)
+        if recovered:
+            self._recovered += recovered
+            logger.info(f"♻️ 重新排入 {recovered} 個中斷的工作")
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _recover_all(self):
+        await asyncio.to_thread(self._recover)
+        if self._redeliver is None:
+            return
+        jobs = await asyncio.to_thread(self._store.claim_replies)
+        if jobs:
+            logger.info(f"📨 重新送出 {len(jobs)} 個中斷前未送出的回覆")
+        loop = asyncio.get_running_loop()
+        for job in jobs:
+            try:
+                delivery = await loop.run_in_executor(self._executor, self._redeliver, job)
+            except Exception as e:
+                logger.error(f"🚨 重新送出工作 #{job['id']} 的回覆失敗: {str(e)}")
+                await asyncio.to_thread(self._store.complete, job["id"])
+                continue
+            self._complete_after_delivery(job, delivery)
+
+    def _complete_after_delivery(self, job, delivery):
+        task = asyncio.create_task(self._await_delivery(job, delivery))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _await_delivery(self, job, delivery):
+        # 回覆在合併視窗結束後才送出；等待期間續約，送出後才標記完成
+        waiting = asyncio.wrap_future(delivery)
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiting), timeout=self._store.lease_seconds / 3)
+                break
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._store.touch, job["id"])
+        await asyncio.to_thread(self._store.complete, job["id"])
+
+    async def _recovery_loop(self):
+        # 定期回收其他程序崩潰後留下、租約已過期的工作
+        while True:
+            await asyncio.sleep(self._store.lease_seconds / 2)
+            try:
+                await self._recover_all()
+            except Exception as e:
+                logger.warning(f"⚠️ 工作復原失敗: {str(e)}")
+
+    async def _next_job(self):
+        """取出下一個工作；停止中時回傳 None"""
+        while not self._stopping:
+            if self._gate is not None and not self._gate():
+                await asyncio.sleep(self.POLL_INTERVAL)
+                continue
+            job = await asyncio.to_thread(self._store.claim)
+            if job is not None:
+                return job
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if not self._stopping:
+                self._wakeup.clear()
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._next_job()
+            if job is None:
+                return
+            self._in_flight += 1
+            try:
+                future = loop.run_in_executor(self._executor, self._process, job)
+                # 處理期間定期續約，避免長時間上傳被當成中斷的工作
+                while True:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future), timeout=self._store.lease_seconds / 3)
+                        break
+                    except asyncio.TimeoutError:
+                        await asyncio.to_thread(self._store.touch, job["id"])
+                result = future.result()
+                if isinstance(result, Future):
+                    self._complete_after_delivery(job, result)
+                else:
+                    await asyncio.to_thread(self._store.complete, job["id"])
+                self._processed += 1
+                # 同一個聊天室被延後的工作現在可能可以取出
+                self._wakeup.set()
+            except asyncio.CancelledError:
+                raise
+            except JobDeferred as e:
+                self._deferred += 1
+                await asyncio.to_thread(self._store.release, job["id"])
+                logger.info(f"⏸️ 工作 #{job['id']} 延後處理: {str(e)}")
+                # 稍等再取下一個工作，避免同一個工作立即被取回
+                await asyncio.sleep(self.POLL_INTERVAL)
+            except Exception as e:
+                self._failed += 1
+                await asyncio.to_thread(self._store.fail, job["id"], f"{type(e).__name__}: {e}")
+                self._wakeup.set()
+                logger.error(f"🚨 背景工作失敗: {str(e)}")
+                logger.debug(f"   錯誤類型: {type(e).__name__}")
+            finally:
+                self._in_flight -= 1